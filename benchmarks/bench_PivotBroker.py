@@ -0,0 +1,174 @@
+"""
+Scaling benchmark for PivotBroker.get_pivot.
+
+Every case is timed on a broker with caching disabled, so each run computes the pivot from
+the flat data. Wall time is the median of `--repeat` runs; peak memory is measured with
+tracemalloc in one extra run, because tracing slows down the timed runs.
+
+Usage:
+    python benchmarks/bench_PivotBroker.py --rows 1e3 1e4 1e5 1e6 --out before.json
+    python benchmarks/bench_PivotBroker.py --rows 1e3 1e4 1e5 1e6 --compare before.json
+    python benchmarks/bench_PivotBroker.py --rows 1e6 --cardinality Fruit=10000 Year=50 --cases filter
+    python benchmarks/bench_PivotBroker.py --rows 1e6 --compact --compare before.json
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import List, Dict
+
+import pandas as pd
+import numpy as np
+
+from swisscontrols.controls.PivotCtrl.DataSource import get_flat_data
+from swisscontrols.controls.PivotCtrl.PivotBroker import PivotBroker
+from swisscontrols.controls.UserScripts.user_scripts import create_lambda_from_checklist, create_lambda_from_expression, get_filter_key
+
+# opaque filters call a Python function per row, so they are skipped above this size
+MAX_OPAQUE_ROWS = 100_000
+
+def get_cases() -> Dict[str, Dict]:
+    """
+    The benchmarked pivot configurations, by name.
+    """
+    checklist = create_lambda_from_checklist('Fruit', ['Apple', 'Pear', 'Cherry'])
+    expression = create_lambda_from_expression('2022 < Year <= 2025 or Quarter == 1', ['Year', 'Quarter'])
+    opaque = lambda row: row['Quarter'] > 2
+
+    return {
+        'empty aggs': dict(rows=['Fruit', 'Shape'], cols=['(Data)'], aggs=[]),
+        'empty rows+cols': dict(rows=[], cols=['(Data)'], aggs=['Weight', 'Volume', 'Price/kg']),
+        'single level': dict(rows=['Fruit'], cols=['(Data)'], aggs=['Weight', 'Volume']),
+        'data in rows': dict(rows=['Fruit', '(Data)'], cols=['Year'], aggs=['Weight', 'Volume']),
+        'multi-level cols': dict(rows=['Fruit'], cols=['Year', '(Data)', 'Quarter'], aggs=['Weight', 'Volume']),
+        'weighted average': dict(rows=['Fruit', 'Shape'], cols=['(Data)', 'Year'], aggs=['Price/kg']),
+        'filter checklist': dict(rows=['Fruit', 'Shape'], cols=['(Data)', 'Year'], aggs=['Weight', 'Price/kg'], filters=[checklist]),
+        'filter expression': dict(rows=['Fruit', 'Shape'], cols=['(Data)', 'Year'], aggs=['Weight', 'Price/kg'], filters=[expression]),
+        'filter opaque': dict(rows=['Fruit', 'Shape'], cols=['(Data)', 'Year'], aggs=['Weight', 'Price/kg'], filters=[opaque]),
+    }
+
+def run_case(broker: PivotBroker, case: Dict, repeat: int) -> Dict:
+    def run():
+        broker.mask_cache.clear()
+        return broker.get_pivot(filters=case.get('filters'), rows=case['rows'], cols=case['cols'], aggs=case['aggs'])
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = run()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'wall_s': statistics.median(timings),
+        'wall_min_s': min(timings),
+        'peak_bytes': peak,
+        'result_shape': list(result.shape),
+    }
+
+def run_benchmarks(row_counts: List[int], cardinality: Dict[str, int], case_names: List[str], repeat: int, seed: int,
+                   compact: bool = False) -> List[Dict]:
+    cases = get_cases()
+    results = []
+    for n_rows in row_counts:
+        df = get_flat_data(n_rows=n_rows, cardinality=cardinality, seed=seed)
+        broker = PivotBroker(cache_entries=0, compact=compact)
+        broker.set_data(df)
+        data_bytes = int(broker.df.memory_usage(index=True, deep=True).sum())
+        if compact:
+            print(broker.compact_report, flush=True)
+
+        for name in case_names:
+            case = cases[name]
+            if n_rows > MAX_OPAQUE_ROWS and any(get_filter_key(f) is None for f in case.get('filters', [])):
+                continue
+            stats = run_case(broker, case, repeat)
+            stats.update(case=name, n_rows=n_rows, data_bytes=data_bytes, 
+                         rows_per_s=n_rows / stats['wall_s'] if stats['wall_s'] else None)
+            results.append(stats)
+            print(f"{name:<20} {n_rows:>10,} rows  {stats['wall_s'] * 1000:>10.2f} ms  "
+                  f"{stats['peak_bytes'] / 2**20:>9.1f} MB peak  {stats['rows_per_s'] / 1e6:>8.2f} M rows/s", flush=True)
+        broker.shutdown()
+    return results
+
+def get_metadata(cardinality: Dict[str, int], repeat: int, seed: int, compact: bool = False) -> Dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'commit': commit,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': sys.version.split()[0],
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cardinality': cardinality,
+        'repeat': repeat,
+        'seed': seed,
+        'compact': compact,
+    }
+
+def compare(results: List[Dict], baseline: Dict):
+    """
+    Print the wall time and peak memory of each case relative to a previous run.
+    """
+    previous = {(r['case'], r['n_rows']): r for r in baseline['results']}
+    print(f"\ncompared to {baseline['meta'].get('commit')}  (ratio < 1 is faster / smaller)")
+    for r in results:
+        before = previous.get((r['case'], r['n_rows']))
+        if before is None:
+            continue
+        time_ratio = r['wall_s'] / before['wall_s'] if before['wall_s'] else float('nan')
+        memory_ratio = r['peak_bytes'] / before['peak_bytes'] if before['peak_bytes'] else float('nan')
+        print(f"{r['case']:<20} {r['n_rows']:>10,} rows  time x{time_ratio:.2f}  peak memory x{memory_ratio:.2f}")
+
+def parse_cardinality(items: List[str]) -> Dict[str, int]:
+    cardinality = {}
+    for item in items:
+        field, _, value = item.partition('=')
+        cardinality[field] = int(float(value))
+    return cardinality
+
+def main(argv: List[str] = None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', nargs='+', default=['1e3', '1e4', '1e5', '1e6'],
+                        help="Row counts to benchmark, e.g. 1e3 1e7")
+    parser.add_argument('--cardinality', nargs='*', default=[],
+                        help="Distinct values per GroupBy field, e.g. Fruit=1000 Year=20")
+    parser.add_argument('--cases', nargs='*', default=None,
+                        help="Only run the cases whose name contains one of these strings")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compact', action='store_true', help="Store the flat data in compact dtypes, see PivotCompact")
+    parser.add_argument('--out', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="A JSON file from a previous run to compare with")
+    args = parser.parse_args(argv)
+
+    row_counts = [int(float(n)) for n in args.rows]
+    cardinality = parse_cardinality(args.cardinality)
+    case_names = [name for name in get_cases()
+                  if not args.cases or any(pattern in name for pattern in args.cases)]
+
+    results = run_benchmarks(row_counts, cardinality, case_names, args.repeat, args.seed, args.compact)
+    report = {'meta': get_metadata(cardinality, args.repeat, args.seed, args.compact), 'results': results}
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+Peak memory of PivotBroker.get_pivot versus `chunk_rows`.
+
+Each chunk size is measured in a fresh process, so the peaks don't mask each other. The child
+generates the data, resets the peak RSS of the process where the OS allows it (Linux), and reports
+how far the RSS rose above its level before the pivot. Without the reset, the peak of the whole
+process is reported instead and includes generating the data. The tracemalloc peak of one more
+run is reported too, it only counts Python and numpy allocations.
+
+Usage:
+    python benchmarks/bench_chunked.py --rows 5e6 --chunk-rows none 1e4 1e5 1e6
+    python benchmarks/bench_chunked.py --rows 5e6 --cases expression --out chunked.json
+"""
+
+import argparse
+import gc
+import json
+import subprocess
+import sys
+import time
+import tracemalloc
+from typing import List, Dict, Optional
+
+from swisscontrols.controls.PivotCtrl.DataSource import get_flat_data, get_peak_rss
+from swisscontrols.controls.PivotCtrl.PivotBroker import PivotBroker
+from swisscontrols.controls.UserScripts.user_scripts import create_lambda_from_checklist, create_lambda_from_expression
+
+def get_cases() -> Dict[str, Dict]:
+    """
+    The benchmarked pivot configurations, by name.
+    """
+    checklist = create_lambda_from_checklist('Fruit', ['Apple', 'Pear', 'Cherry'])
+    expression = create_lambda_from_expression('2022 < Year <= 2025 or Quarter == 1', ['Year', 'Quarter'])
+
+    return {
+        'no filter': dict(rows=['Fruit', 'Shape'], cols=['(Data)', 'Year'], aggs=['Weight', 'Price/kg']),
+        'filter checklist': dict(rows=['Fruit', 'Shape'], cols=['(Data)', 'Year'], aggs=['Weight', 'Price/kg'], filters=[checklist]),
+        'filter expression': dict(rows=['Fruit', 'Shape'], cols=['(Data)', 'Year'], aggs=['Weight', 'Price/kg'], filters=[expression, checklist]),
+    }
+
+def read_proc_status(field: str) -> Optional[int]:
+    """
+    Return a memory field of /proc/self/status in bytes, e.g. 'VmRSS' or 'VmHWM', or None off Linux.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def reset_peak_rss() -> bool:
+    """
+    Reset the peak RSS (VmHWM) of this process to its current RSS. Returns False where that isn't possible.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def run_child(n_rows: int, chunk_rows: Optional[int], case_name: str, seed: int) -> Dict:
+    """
+    Measure one case in this process. Runs in the child process.
+    """
+    case = get_cases()[case_name]
+    broker = PivotBroker(cache_entries=0, chunk_rows=chunk_rows)
+    broker.set_data(get_flat_data(n_rows=n_rows, seed=seed))
+    broker.get_unique_counts(case['rows'][0])   # build the unique index outside the measurement
+    gc.collect()
+
+    def run():
+        broker.mask_cache.clear()
+        return broker.get_pivot(filters=case.get('filters'), rows=case['rows'], cols=case['cols'], aggs=case['aggs'])
+
+    reset = reset_peak_rss()
+    rss_before = read_proc_status('VmRSS')
+    start = time.perf_counter()
+    result = run()
+    wall = time.perf_counter() - start
+
+    if reset and rss_before is not None:
+        peak_rss, peak_rss_scope = read_proc_status('VmHWM') - rss_before, 'pivot'
+    else:
+        peak_rss, peak_rss_scope = get_peak_rss(), 'process'
+
+    gc.collect()
+    tracemalloc.start()
+    run()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'case': case_name,
+        'n_rows': n_rows,
+        'chunk_rows': chunk_rows,
+        'wall_s': wall,
+        'peak_rss_bytes': peak_rss,
+        'peak_rss_scope': peak_rss_scope,
+        'traced_peak_bytes': traced_peak,
+        'data_bytes': int(broker.df.memory_usage(index=True, deep=True).sum()),
+        'result_shape': list(result.shape),
+    }
+
+def run_benchmarks(row_counts: List[int], chunk_sizes: List[Optional[int]], case_names: List[str], seed: int) -> List[Dict]:
+    results = []
+    for n_rows in row_counts:
+        for name in case_names:
+            for chunk_rows in chunk_sizes:
+                output = subprocess.run([sys.executable, __file__, '--child', str(n_rows), str(chunk_rows), name, str(seed)],
+                                        capture_output=True, text=True, check=True).stdout
+                stats = json.loads(output.strip().splitlines()[-1])
+                results.append(stats)
+                label = 'none' if chunk_rows is None else f'{chunk_rows:,}'
+                print(f"{name:<18} {n_rows:>10,} rows  chunk {label:>10}  {stats['wall_s'] * 1000:>9.1f} ms  "
+                      f"{stats['peak_rss_bytes'] / 2**20:>8.1f} MB peak RSS ({stats['peak_rss_scope']})  "
+                      f"{stats['traced_peak_bytes'] / 2**20:>8.1f} MB traced", flush=True)
+    return results
+
+def parse_chunk_rows(value: str) -> Optional[int]:
+    return None if value.lower() == 'none' else int(float(value))
+
+def main(argv: List[str] = None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == '--child':
+        n_rows, chunk_rows, case_name, seed = argv[1:5]
+        print(json.dumps(run_child(int(n_rows), parse_chunk_rows(chunk_rows), case_name, int(seed))))
+        return
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', nargs='+', default=['1e6'], help="Row counts to benchmark, e.g. 1e6 5e6")
+    parser.add_argument('--chunk-rows', nargs='+', default=['none', '1e4', '1e5', '1e6'],
+                        help="Chunk sizes to compare, 'none' evaluates the whole frame at once")
+    parser.add_argument('--cases', nargs='*', default=None,
+                        help="Only run the cases whose name contains one of these strings")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help="Write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    row_counts = [int(float(n)) for n in args.rows]
+    chunk_sizes = [parse_chunk_rows(value) for value in args.chunk_rows]
+    case_names = [name for name in get_cases()
+                  if not args.cases or any(pattern in name for pattern in args.cases)]
+
+    results = run_benchmarks(row_counts, chunk_sizes, case_names, args.seed)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump({'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+                                'seed': args.seed}, 'results': results}, f, indent=2)
+
+if __name__ == '__main__':
+    main()
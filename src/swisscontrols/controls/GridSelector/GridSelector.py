@@ -53,15 +53,30 @@ def index_to_nested_index(index, dims):
         return ret
 
 class GridSelector:
-    def __init__(self, table_id, width, height):
+    def __init__(self, table_id, width, height, table_offset=None):
+        """
+        :param table_id: The table that holds the cells
+        :param width: The number of columns of the grid
+        :param height: The number of rows of the grid
+        :param table_offset: (row, column) of the first cell of the grid in `table_id`, when every cell 
+                             lives in that one table. Cells are then highlighted by their position, 
+                             otherwise through `dpg_lookup`.
+
+        The grid can show a window of a larger sheet, see `set_origin`. The selected range is kept 
+        in sheet coordinates, so it stays on the same data when the window moves.
+        """
         self.table_id = table_id
+        self.table_offset = table_offset
         self.width = width
         self.height = height
         
         self.widget_grid = [[None for _ in range(width)] for _ in range(height)]
         self.dpg_lookup = [[(0,0,0) for _ in range(width)] for _ in range(height)] # [table_id, i, j] for each cell
         self.mouse_drag_coords = [[0,0], [0,0]] # pixel coords
-        self.range_coords = [[0,0], [0,0]] # index coords
+        self.range_coords = [[0,0], [0,0]] # index coords in the sheet, [column, row]
+        self.has_range = False
+        self._has_highlight = False
+        self.origin = (0, 0) # (row, column) of the sheet shown by the first cell
         self.is_dragging_range = False
         self._is_paused = False
         self.mouse_registry = -1
@@ -75,6 +90,61 @@ class GridSelector:
     def __del__(self):
         self.deregister()
 
+    def resize(self, width, height):
+        """
+        Change the size of the grid, keeping the cells that are still inside it.
+        New cells are empty until their widgets are assigned, call `highlight` once they are.
+        """
+        self.widget_grid = [[self.widget_grid[j][i] if j < self.height and i < self.width else None for i in range(width)] for j in range(height)]
+        self.dpg_lookup = [[self.dpg_lookup[j][i] if j < self.height and i < self.width else (0,0,0) for i in range(width)] for j in range(height)]
+        self.width = width
+        self.height = height
+        self.is_dragging_range = False
+
+    def set_origin(self, row, column):
+        """
+        Show the sheet from (row, column) on: the grid scrolled, and the selection is highlighted 
+        on the cells that now show it.
+        """
+        self.origin = (row, column)
+        self.highlight()
+
+    def clear(self):
+        """
+        Drop the selection, e.g. when the grid shows other data.
+        """
+        self.range_coords = [[0,0], [0,0]]
+        self.has_range = False
+        self.is_dragging_range = False
+        self.highlight()
+
+    def highlight(self):
+        """
+        Highlight the cells that show the selected range of the sheet, and unhighlight the others.
+        """
+        if not self.has_range and not self._has_highlight:
+            # nothing to draw or erase
+            return
+        self._has_highlight = self.has_range
+        for j,i in itertools.product(range(self.height), range(self.width)):
+            if self.widget_grid[j][i] is None:
+                continue
+            table_id, table_j, table_i = self.get_table_cell(j, i)
+            row, column = self.origin[0] + j, self.origin[1] + i
+            if self.has_range and is_between(self.range_coords[0][0], column, self.range_coords[1][0]) and is_between(self.range_coords[0][1], row, self.range_coords[1][1]):
+                dpg.highlight_table_cell(table_id, table_j, table_i, [34, 83, 118, 100])
+            else:
+                dpg.unhighlight_table_cell(table_id, table_j, table_i)
+                dpg.set_value(self.widget_grid[j][i], False)
+
+    def get_table_cell(self, j, i):
+        """
+        Return [table_id, row, column] of the table cell that shows row j, column i of the grid.
+        """
+        if self.table_offset is None:
+            return self.dpg_lookup[j][i]
+        return [self.table_id, self.table_offset[0] + j, self.table_offset[1] + i]
+
     def is_empty(self):
         return (len(self.widget_grid) == 0 or len(self.widget_grid[0]) == 0)
 
@@ -107,7 +177,7 @@ class GridSelector:
             widget_heights = [dpg.get_item_rect_size(r[0])[1] for r in self.widget_grid] # y element of (first item in each row)
             column = int(np.searchsorted(np.cumsum(widget_widths), mouse_pos[0] - rect_min[0]))
             row = int(np.searchsorted(np.cumsum(widget_heights), mouse_pos[1] - rect_min[1]))
-            self.range_coords[0] = [column, row]
+            self.range_coords[0] = [column + self.origin[1], row + self.origin[0]]
             
             print(f"Mouse down: {column}, {row}")
 
@@ -136,16 +206,9 @@ class GridSelector:
             widget_heights = [dpg.get_item_rect_size(r[0])[1] for r in self.widget_grid]
             column = int(np.searchsorted(np.cumsum(widget_widths), mouse_pos[0] - rect_min[0]))
             row = int(np.searchsorted(np.cumsum(widget_heights), mouse_pos[1] - rect_min[1]))
-            self.range_coords[1] = [column, row]
-
-            for j,i in itertools.product(range(self.height), range(self.width)):
-                
-                table_id, table_j, table_i = self.dpg_lookup[j][i]
-                if is_between(self.range_coords[0][0], i, self.range_coords[1][0]) and is_between(self.range_coords[0][1], j, self.range_coords[1][1]):
-                    dpg.highlight_table_cell(table_id, table_j, table_i, [34, 83, 118, 100])
-                else:
-                    dpg.unhighlight_table_cell(table_id, table_j, table_i)
-                    dpg.set_value(self.widget_grid[j][i], False)
+            self.range_coords[1] = [column + self.origin[1], row + self.origin[0]]
+            self.has_range = True
+            self.highlight()
 
             return row, column
         else:
@@ -1,10 +1,405 @@
-import random
-from typing import Dict
+import ast
+import sys
+import time
+import dataclasses
+from functools import reduce
+from typing import Callable, Dict, List, Optional, Tuple
 
 import pandas as pd
 import numpy as np
 
 from swisscontrols.controls.PivotCtrl.PivotField import PivotField, PivotFieldType
+from swisscontrols.controls.UserScripts.user_scripts import COMPARE_OPS, create_combined_mask, is_literal_container, get_filter_key, get_filter_columns
+
+"""
+Data sources load flat data for PivotBroker and describe its fields.
+
+    broker = PivotBroker(data_source=ParquetDataSource("trades.parquet"))
+    print(broker.load_stats)
+
+Parquet and Feather sources need the optional `pyarrow` dependency (`pip install swisscontrols[arrow]`).
+
+`scan(columns, filters)` reads only some columns and the rows selected by some filters. 
+Parquet and Feather sources push the filters into the Arrow reader, where Parquet row groups 
+whose min/max statistics can't match are skipped; CSV sources filter each chunk as it is read.
+"""
+
+@dataclasses.dataclass
+class LoadStats:
+    source: str
+    rows: int
+    columns: int
+    seconds: float
+    memory_bytes: int               # df.memory_usage(deep=True) of the loaded frame
+    peak_rss_bytes: Optional[int]   # process high-water mark after loading, None if unavailable
+    peak_rss_increase_bytes: Optional[int] # how much loading raised the high-water mark
+
+def get_peak_rss() -> Optional[int]:
+    """
+    Return the peak resident set size of this process in bytes, or None where the 
+    `resource` module is not available (Windows).
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def infer_field_type(dtype):
+    """
+    Guess a PivotFieldType from a column dtype. 
+    
+    Floats are aggregated, integers and dates are ordinal groupings, everything else is a category.
+    """
+    if pd.api.types.is_float_dtype(dtype):
+        return PivotFieldType.Aggregate.SUM
+    if pd.api.types.is_bool_dtype(dtype):
+        return PivotFieldType.GroupBy.CATEGORY
+    if pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_datetime64_any_dtype(dtype):
+        return PivotFieldType.GroupBy.ORDINAL
+    return PivotFieldType.GroupBy.CATEGORY
+
+def infer_field_data(dtypes: Dict[str, object]) -> Dict[str, PivotField]:
+    return {name: PivotField(name, infer_field_type(dtype)) for name, dtype in dtypes.items()}
+
+def concat_chunks(chunks: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenate chunks of the same table, merging categorical columns whose chunks 
+    have different categories (plain pd.concat would fall back to object dtype).
+    """
+    if not chunks:
+        return pd.DataFrame()
+    if len(chunks) == 1:
+        return chunks[0].reset_index(drop=True)
+
+    columns = {}
+    for name in chunks[0].columns:
+        parts = [chunk[name] for chunk in chunks]
+        if all(isinstance(part.dtype, pd.CategoricalDtype) for part in parts):
+            columns[name] = pd.Series(pd.api.types.union_categoricals(parts, sort_categories=True))
+        else:
+            columns[name] = pd.concat(parts, ignore_index=True)
+    return pd.DataFrame(columns)
+
+def get_scan_columns(columns: Optional[List[str]], filters: List[Callable]) -> Optional[List[str]]:
+    """
+    Return `columns` plus the columns read by `filters`, or None (all columns) if a filter is opaque.
+    """
+    filter_columns = get_filter_columns(filters)
+    if columns is None or filter_columns is None:
+        return None
+    return list(dict.fromkeys(list(columns) + sorted(filter_columns)))
+
+def apply_filters(df: pd.DataFrame, filters: List[Callable], columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """
+    Keep the rows of `df` selected by `filters`, then only `columns`.
+    """
+    if filters:
+        df = df[create_combined_mask(filters, df)].reset_index(drop=True)
+    return df if columns is None else df[list(columns)]
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.compute
+        import pyarrow.dataset
+        import pyarrow.parquet
+        import pyarrow.feather
+    except ImportError as e:
+        raise ImportError("Reading Parquet or Feather files requires pyarrow: pip install pyarrow") from e
+    return pyarrow
+
+def get_arrow_dtypes(schema) -> Dict[str, object]:
+    pa = import_pyarrow()
+    dtypes = {}
+    for field in schema:
+        if pa.types.is_dictionary(field.type):
+            dtypes[field.name] = pd.CategoricalDtype()
+            continue
+        try:
+            dtypes[field.name] = field.type.to_pandas_dtype()
+        except NotImplementedError:
+            dtypes[field.name] = np.dtype(object)
+    return dtypes
+
+def expression_to_arrow(node):
+    """
+    Convert a parsed filter expression to a pyarrow compute expression.
+
+    Returns:
+        (expression, exact): `expression` selects a superset of the rows, None if nothing 
+        could be converted. `exact` is False if some part of the filter was left out.
+    """
+    if isinstance(node, ast.Expression):
+        return expression_to_arrow(node.body)
+    elif isinstance(node, ast.BoolOp):
+        converted = [expression_to_arrow(value) for value in node.values]
+        exact = all(part_exact for _, part_exact in converted)
+        parts = [part for part, _ in converted if part is not None]
+        if isinstance(node.op, ast.And):
+            # leaving out a term of an AND only selects more rows
+            return (reduce(lambda a, b: a & b, parts) if parts else None), exact and len(parts) == len(converted)
+        if len(parts) < len(converted):
+            return None, False
+        return reduce(lambda a, b: a | b, parts), exact
+    elif isinstance(node, ast.Compare):
+        # a chain like `2022 < Year <= 2024` is an AND of its comparisons
+        operands = [node.left] + node.comparators
+        return expression_to_arrow(ast.BoolOp(op=ast.And(), values=[
+            ast.Compare(left=left, ops=[op], comparators=[right])
+            for left, op, right in zip(operands[:-1], node.ops, operands[1:])])) if len(node.ops) > 1 \
+            else compare_to_arrow(node.left, node.ops[0], node.comparators[0])
+    return None, False
+
+def compare_to_arrow(left, op, right):
+    pa = import_pyarrow()
+    if isinstance(op, ast.In) and isinstance(left, ast.Name) and is_literal_container(right):
+        return pa.compute.field(left.id).isin(list(ast.literal_eval(right))), True
+    # missing values compare differently in pandas and Arrow for != and `not in`, so they are left to pandas
+    if type(op) not in COMPARE_OPS or isinstance(op, ast.NotEq):
+        return None, False
+    if isinstance(left, ast.Name) and isinstance(right, ast.Constant):
+        return COMPARE_OPS[type(op)][0](pa.compute.field(left.id), right.value), True
+    if isinstance(right, ast.Name) and isinstance(left, ast.Constant):
+        return COMPARE_OPS[type(op)][1](pa.compute.field(right.id), left.value), True
+    return None, False
+
+def key_to_arrow(key):
+    """
+    Convert a filter key to a pyarrow compute expression, see `expression_to_arrow`.
+    """
+    pa = import_pyarrow()
+    kind = key[0]
+    if kind == 'accept all':
+        return None, True
+    elif kind == 'is in':
+        return pa.compute.field(key[1]).isin(list(key[2])), True
+    elif kind == 'expression':
+        return expression_to_arrow(ast.parse(key[1], mode='eval'))
+    elif kind == 'and':
+        converted = [key_to_arrow(k) for k in key[1]]
+        parts = [part for part, _ in converted if part is not None]
+        exact = all(part_exact for _, part_exact in converted)
+        return (reduce(lambda a, b: a & b, parts) if parts else None), exact
+    return None, False
+
+def get_arrow_filter(filters: List[Callable]):
+    """
+    Split filters into a pyarrow expression to push into the reader, and the filters that 
+    still have to be applied to the loaded rows (opaque callables and parts Arrow can't express).
+
+    Returns:
+        (expression or None, residual filters)
+    """
+    parts, residual = [], []
+    for f in filters or []:
+        key = get_filter_key(f)
+        part, exact = key_to_arrow(key) if key is not None else (None, False)
+        if part is not None:
+            parts.append(part)
+        if not exact:
+            residual.append(f)
+    return (reduce(lambda a, b: a & b, parts) if parts else None), residual
+
+def scan_arrow(read_table: Callable, columns: Optional[List[str]], filters: Optional[List[Callable]]) -> pd.DataFrame:
+    """
+    Read an Arrow table with the filters pushed down where possible, see `get_arrow_filter`.
+
+    :param read_table: read_table(columns, expression) -> pyarrow.Table
+    """
+    pa = import_pyarrow()
+    expression, residual = get_arrow_filter(filters)
+    read_columns = get_scan_columns(columns, residual)
+    try:
+        table = read_table(read_columns, expression)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+        # e.g. a constant that can't be compared with the column's type, let pandas decide
+        residual = list(filters)
+        table = read_table(get_scan_columns(columns, residual), None)
+    return apply_filters(table.to_pandas().reset_index(drop=True), residual, columns)
+
+class DataSource:
+    """
+    Base class for the flat data behind a PivotBroker.
+
+    Subclasses implement `load` and `get_dtypes`. The field catalog is either passed in
+    explicitly or inferred from the column dtypes, see `infer_field_type`.
+    """
+
+    def __init__(self, field_data: Optional[Dict[str, PivotField]] = None):
+        self.field_data = field_data
+
+    def load(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Return the flat data as a DataFrame with a RangeIndex, optionally only `columns`.
+        """
+        raise NotImplementedError
+
+    def get_dtypes(self) -> Dict[str, object]:
+        """
+        Return {column name: dtype} without loading all of the data.
+        """
+        raise NotImplementedError
+
+    def scan(self, columns: Optional[List[str]] = None, filters: Optional[List[Callable]] = None) -> pd.DataFrame:
+        """
+        Return only `columns` of the rows selected by `filters`, with a RangeIndex.
+
+        Sources that can skip data while reading override this. The default loads 
+        the columns that are needed and filters them in memory.
+        """
+        df = self.load(columns=get_scan_columns(columns, filters))
+        return apply_filters(df, filters, columns)
+
+    def get_field_data(self) -> Dict[str, PivotField]:
+        if self.field_data is None:
+            self.field_data = infer_field_data(self.get_dtypes())
+        return self.field_data
+
+    def load_with_stats(self, columns: Optional[List[str]] = None) -> Tuple[pd.DataFrame, LoadStats]:
+        """
+        Load the data and measure wall time, frame memory and peak RSS.
+        """
+        peak_before = get_peak_rss()
+        start = time.perf_counter()
+        df = self.load(columns=columns)
+        seconds = time.perf_counter() - start
+        peak_after = get_peak_rss()
+
+        stats = LoadStats(
+            source=repr(self),
+            rows=len(df),
+            columns=len(df.columns),
+            seconds=seconds,
+            memory_bytes=int(df.memory_usage(index=True, deep=True).sum()),
+            peak_rss_bytes=peak_after,
+            peak_rss_increase_bytes=None if peak_after is None else peak_after - peak_before,
+        )
+        return df, stats
+
+class RandomDataSource(DataSource):
+    """
+    Random fruit data, see `get_flat_data`.
+    """
+
+    def __init__(self, n_rows: int = 10, cardinality: Optional[Dict[str, int]] = None, seed: Optional[int] = None):
+        super().__init__(field_data=get_field_data())
+        self.n_rows = n_rows
+        self.cardinality = cardinality
+        self.seed = seed
+
+    def __repr__(self):
+        return f"RandomDataSource(n_rows={self.n_rows}, cardinality={self.cardinality}, seed={self.seed})"
+
+    def load(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        df = get_flat_data(n_rows=self.n_rows, cardinality=self.cardinality, seed=self.seed)
+        return df if columns is None else df[columns]
+
+    def get_dtypes(self) -> Dict[str, object]:
+        return get_flat_data(n_rows=1).dtypes.to_dict()
+
+class CsvDataSource(DataSource):
+    """
+    Load a CSV file in chunks. 
+    
+    Pass explicit `dtype`s where you can: it skips type inference, and columns read as 
+    'category' are dictionary-encoded chunk by chunk, so the full strings never exist at once.
+    Object columns are also converted to categoricals per chunk.
+    """
+
+    def __init__(self, path: str, dtype: Optional[Dict[str, object]] = None, chunksize: int = 1_000_000,
+                 field_data: Optional[Dict[str, PivotField]] = None, **read_csv_kwargs):
+        super().__init__(field_data=field_data)
+        self.path = path
+        self.dtype = dtype
+        self.chunksize = chunksize
+        self.read_csv_kwargs = read_csv_kwargs
+
+    def __repr__(self):
+        return f"CsvDataSource('{self.path}')"
+
+    def load(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        return self.scan(columns=columns)
+
+    def scan(self, columns: Optional[List[str]] = None, filters: Optional[List[Callable]] = None) -> pd.DataFrame:
+        # filter each chunk as it is read, so rows that are filtered out are never held all at once
+        chunks = []
+        reader = pd.read_csv(self.path, dtype=self.dtype, usecols=get_scan_columns(columns, filters), chunksize=self.chunksize, **self.read_csv_kwargs)
+        with reader:
+            for chunk in reader:
+                chunk = apply_filters(chunk, filters)
+                for name in chunk.columns:
+                    if chunk[name].dtype == object or pd.api.types.is_string_dtype(chunk[name].dtype):
+                        chunk[name] = chunk[name].astype('category')
+                chunks.append(chunk)
+        df = concat_chunks(chunks)
+        return df if columns is None else df[columns]
+
+    def get_dtypes(self) -> Dict[str, object]:
+        # infer from a sample, then apply the explicit dtypes on top
+        sample = pd.read_csv(self.path, nrows=1000, **self.read_csv_kwargs)
+        dtypes = sample.dtypes.to_dict()
+        dtypes.update(self.dtype or {})
+        return dtypes
+
+class ParquetDataSource(DataSource):
+    """
+    Load a Parquet file through a memory-mapped read. Requires pyarrow.
+    """
+
+    def __init__(self, path: str, field_data: Optional[Dict[str, PivotField]] = None):
+        super().__init__(field_data=field_data)
+        self.path = path
+
+    def __repr__(self):
+        return f"ParquetDataSource('{self.path}')"
+
+    def load(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        pa = import_pyarrow()
+        table = pa.parquet.read_table(self.path, columns=columns, memory_map=True)
+        return table.to_pandas().reset_index(drop=True)
+
+    def scan(self, columns: Optional[List[str]] = None, filters: Optional[List[Callable]] = None) -> pd.DataFrame:
+        pa = import_pyarrow()
+        return scan_arrow(lambda read_columns, expression: pa.parquet.read_table(
+            self.path, columns=read_columns, filters=expression, memory_map=True), columns, filters)
+
+    def get_dtypes(self) -> Dict[str, object]:
+        pa = import_pyarrow()
+        return get_arrow_dtypes(pa.parquet.read_schema(self.path, memory_map=True))
+
+class FeatherDataSource(DataSource):
+    """
+    Load a Feather (Arrow IPC) file through a memory-mapped read. Requires pyarrow.
+
+    Uncompressed Feather files are read without copying the file into memory first,
+    compressed files are decompressed on read.
+    """
+
+    def __init__(self, path: str, field_data: Optional[Dict[str, PivotField]] = None):
+        super().__init__(field_data=field_data)
+        self.path = path
+
+    def __repr__(self):
+        return f"FeatherDataSource('{self.path}')"
+
+    def load(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        pa = import_pyarrow()
+        table = pa.feather.read_table(self.path, columns=columns, memory_map=True)
+        return table.to_pandas().reset_index(drop=True)
+
+    def scan(self, columns: Optional[List[str]] = None, filters: Optional[List[Callable]] = None) -> pd.DataFrame:
+        pa = import_pyarrow()
+        # Feather files have no statistics to skip data with, but rows are filtered batch by batch while reading
+        return scan_arrow(lambda read_columns, expression: pa.dataset.dataset(self.path, format='feather').to_table(
+            columns=read_columns, filter=expression), columns, filters)
+
+    def get_dtypes(self) -> Dict[str, object]:
+        pa = import_pyarrow()
+        with pa.memory_map(self.path) as source:
+            return get_arrow_dtypes(pa.ipc.open_file(source).schema)
 
 def get_field_data() -> Dict[str, PivotField]:
     return {
@@ -20,35 +415,55 @@ def get_field_data() -> Dict[str, PivotField]:
 
     
 
-def get_flat_data():
-    # Number of rows to generate
-    n_rows = 10
+# the values of the GroupBy fields of `get_flat_data` at their default cardinality
+FLAT_DATA_VALUES = {
+    'Year': [2022, 2023, 2024, 2025, 2026, 2027],
+    'Quarter': [1, 2, 3, 4],
+    'Fruit': ["Apple", "Pear", "Cherry", "Fig", "Banana"],
+    'Shape': ["Round", "Square", "Star", "Cone", "Torus"],
+    'Vibe': ["Relaxing", "Ambient", "Chill", "Flawless"],
+}
+
+def get_field_values(field: str, cardinality: int) -> list:
+    """
+    Return `cardinality` distinct values for a GroupBy field of `get_flat_data`.
+    Numeric fields count up from their first value, text fields get numbered variants, e.g. 'Apple 3'.
+    """
+    values = FLAT_DATA_VALUES[field]
+    if cardinality <= len(values):
+        return values[:cardinality]
+    if isinstance(values[0], str):
+        return values + [f"{values[i % len(values)]} {i // len(values)}" for i in range(len(values), cardinality)]
+    return list(range(values[0], values[0] + cardinality))
+
+def get_flat_data(n_rows: int = 10, cardinality: Optional[Dict[str, int]] = None, seed: Optional[int] = None):
+    """
+    Random fruit data.
+
+    :param n_rows: The number of rows
+    :param cardinality: The number of distinct values of some GroupBy fields, e.g. {'Fruit': 1000}
+    :param seed: Seed of the random generator, for reproducible data
+    """
+    rng = np.random.default_rng(seed)
+    cardinality = cardinality or {}
 
-    # Random fruits
-    vibe = random.choices(["Relaxing", "Ambient", "Chill", "Flawless"], k=n_rows)
-    fruits = random.choices(["Apple", "Pear", "Cherry", "Fig", "Banana"], k=n_rows)
-    grade = random.choices(["Round", "Square", "Star", "Cone", "Torus"], k=n_rows)
+    unknown = set(cardinality) - set(FLAT_DATA_VALUES)
+    if unknown:
+        raise ValueError(f"Unknown GroupBy fields {sorted(unknown)}, expected some of {list(FLAT_DATA_VALUES)}.")
 
-    # Random years and months
-    years = random.choices([2022, 2023, 2024, 2025, 2026, 2027], k=n_rows)
-    quarters = random.choices(np.arange(1,5), k=n_rows)
+    # Random fruits, years and quarters
+    columns = {}
+    for field, values in FLAT_DATA_VALUES.items():
+        values = get_field_values(field, cardinality.get(field, len(values)))
+        columns[field] = np.asarray(values, dtype=object if isinstance(values[0], str) else np.int64)[rng.integers(0, len(values), n_rows)]
 
     # Random weights and volumes
-    weights = np.random.rand(n_rows)
-    volumes = np.random.rand(n_rows)
-    price = np.random.rand(n_rows)
+    columns['Weight'] = rng.random(n_rows)
+    columns['Volume'] = rng.random(n_rows)
+    columns['Price/kg'] = rng.random(n_rows)
 
     # Create DataFrame
-    df = pd.DataFrame({
-        'Year': years,
-        'Quarter': quarters,
-        'Fruit': fruits,
-        'Shape': grade,
-        'Vibe': vibe,
-        'Weight': weights,
-        'Volume': volumes,
-        'Price/kg': price,
-    })
+    df = pd.DataFrame(columns)
 
     return df
 
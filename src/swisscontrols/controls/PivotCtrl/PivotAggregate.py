@@ -0,0 +1,364 @@
+from typing import List, Dict, Callable
+
+import pandas as pd
+import numpy as np
+
+from swisscontrols.controls.PivotCtrl.PivotField import PivotField, PivotFieldType
+from swisscontrols.controls.PivotCtrl.PivotSketch import DistinctSet, HyperLogLog, ExactQuantiles, QuantileSketch, merge_summaries
+
+"""
+Aggregations are computed in two steps.
+
+1. Each aggregate field is turned into one or more "state" columns that can be summed:
+    - SUM              -> sum(x)
+    - COUNT            -> sum(x is not null)
+    - WEIGHTED_AVERAGE -> sum(w*x), sum(w)
+2. After grouping, the summed states are turned back into one value per field,
+   e.g. WEIGHTED_AVERAGE = sum(w*x) / sum(w).
+
+Because every state is a plain sum, all fields of a pivot are aggregated by a single
+`groupby().sum()` pass, and partial states of the same groups can be merged by adding them.
+
+Distinct counts and quantiles can't be summed. Their state is a summary object per group, 
+exact or a bounded-size sketch (see PivotSketch), and partial states are merged with `merge`:
+    - DISTINCT_COUNT   -> 'distinct'  (DistinctSet or HyperLogLog)
+    - MEDIAN           -> 'quantiles' (ExactQuantiles or QuantileSketch)
+    - PERCENTILE       -> 'quantiles'
+
+State columns are labelled with (field, state) tuples, e.g. ('Price/kg', 'wx').
+
+Subtotals and grand totals are more groupings of the same states ("grouping sets"): each one is 
+rolled up from the next finer one, see `rollup_grouping_sets`, so they cost no extra scan of the data.
+"""
+
+AGGREGATE_STATES = {
+    PivotFieldType.Aggregate.SUM: ['sum'],
+    PivotFieldType.Aggregate.COUNT: ['count'],
+    PivotFieldType.Aggregate.WEIGHTED_AVERAGE: ['wx', 'w'],
+    PivotFieldType.Aggregate.DISTINCT_COUNT: ['distinct'],
+    PivotFieldType.Aggregate.MEDIAN: ['quantiles'],
+    PivotFieldType.Aggregate.PERCENTILE: ['quantiles'],
+}
+
+# states that hold a summary object per group instead of a number
+SUMMARY_STATES = ('distinct', 'quantiles')
+
+# the group key of subtotals and grand totals
+TOTAL_LABEL = 'Total'
+
+def is_summary_field(field: PivotField) -> bool:
+    return any(state in SUMMARY_STATES for state in AGGREGATE_STATES.get(field.field_type, []))
+
+def get_summary_type(field: PivotField) -> type:
+    if field.field_type == PivotFieldType.Aggregate.DISTINCT_COUNT:
+        return HyperLogLog if field.approximate else DistinctSet
+    return QuantileSketch if field.approximate else ExactQuantiles
+
+def group_summaries(values: pd.Series, grouped, summarize) -> list:
+    """
+    Apply `summarize` to the values of each group of `grouped`, a GroupBy over the same rows as `values`.
+    
+    Returns:
+        list: One summary per group, in the order of the groups in `grouped.sum()`.
+    """
+    ids = grouped.ngroup().to_numpy()
+    n_groups = grouped.ngroups
+    if n_groups == 0:
+        return []
+    # rows with missing keys belong to no group
+    selected = ids >= 0
+    ids, values = ids[selected], values.to_numpy()[selected]
+    order = np.argsort(ids, kind='stable')
+    bounds = np.cumsum(np.bincount(ids, minlength=n_groups))[:-1]
+    return [summarize(group) for group in np.split(values[order], bounds)]
+
+def get_source_columns(aggs: List[str], field_data: Dict[str, PivotField]) -> List[str]:
+    """
+    Return the columns needed to aggregate `aggs`: the fields themselves and their weight fields.
+    """
+    weights = [field_data[field].weight_field for field in aggs
+               if field_data[field].field_type == PivotFieldType.Aggregate.WEIGHTED_AVERAGE]
+    return list(dict.fromkeys(aggs + weights))
+
+def widen(values: pd.Series) -> pd.Series:
+    """
+    Convert compact numeric columns (see PivotCompact) to 64 bits, so that states can't overflow, 
+    are summed at full precision and hash the same way however the column is stored.
+    """
+    dtype = values.dtype
+    if isinstance(dtype, np.dtype) and dtype.itemsize < 8:
+        if dtype.kind == 'f':
+            return values.astype(np.float64)
+        if dtype.kind in 'iu':
+            return values.astype(np.int64)
+    return values
+
+def widen_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Return `df` with its compact numeric columns widened, see `widen`. Used before evaluating 
+    opaque row filters, so that they compute on 64-bit values.
+    """
+    narrow = [name for name, dtype in df.dtypes.items() 
+              if isinstance(dtype, np.dtype) and dtype.kind in 'iuf' and dtype.itemsize < 8]
+    if not narrow:
+        return df
+    return df.assign(**{name: widen(df[name]) for name in narrow})
+
+def get_row_states(df: pd.DataFrame, aggs: List[str], field_data: Dict[str, PivotField]) -> pd.DataFrame:
+    """
+    Compute the state columns for each row of `df`.
+
+    Args:
+        df: The (filtered) flat data.
+        aggs: The aggregate fields to compute states for.
+        field_data: The field catalog, used to look up field types and weight fields.
+
+    Returns:
+        pd.DataFrame: A frame with the same index as `df` and one column per state.
+    """
+    columns = {}
+    for field in aggs:
+        field_type = field_data[field].field_type
+        values = widen(df[field])
+
+        if field_type == PivotFieldType.Aggregate.SUM:
+            columns[(field, 'sum')] = values
+        elif field_type == PivotFieldType.Aggregate.COUNT:
+            columns[(field, 'count')] = values.notna().astype(np.int64)
+        elif field_type == PivotFieldType.Aggregate.WEIGHTED_AVERAGE:
+            # rows with a missing value do not contribute to the weight either
+            weights = widen(df[field_data[field].weight_field]).where(values.notna(), 0)
+            columns[(field, 'wx')] = values * weights
+            columns[(field, 'w')] = weights
+        else:
+            raise Exception(f"Unsupported aggregation '{field_type}' for field '{field}'.")
+
+    return pd.DataFrame(columns, index=df.index)
+
+def aggregate_states(df: pd.DataFrame, keys: List[str], aggs: List[str], field_data: Dict[str, PivotField]) -> pd.DataFrame:
+    """
+    Group `df` by `keys` and sum the state columns of `aggs` in one pass.
+
+    Returns:
+        pd.DataFrame: Summed states indexed by the group keys.
+        If `keys` is empty, a single row with index [0].
+        If `aggs` is empty, a frame with no columns whose index lists the non-empty groups.
+    """
+    summary_aggs = [field for field in aggs if is_summary_field(field_data[field])]
+    states = get_row_states(df, [field for field in aggs if field not in summary_aggs], field_data)
+
+    if not keys:
+        states = states.sum().to_frame().T
+        for field in summary_aggs:
+            summarize = get_summary_type(field_data[field]).from_values
+            states[(field, AGGREGATE_STATES[field_data[field].field_type][0])] = [summarize(widen(df[field]).to_numpy())]
+    else:
+        grouper = [df[key] for key in keys]
+        grouped = states.groupby(grouper, observed=True)
+        states = grouped.sum()
+        for field in summary_aggs:
+            summarize = get_summary_type(field_data[field]).from_values
+            states[(field, AGGREGATE_STATES[field_data[field].field_type][0])] = group_summaries(widen(df[field]), grouped, summarize)
+
+    return states[[column for field in aggs for column in states.columns if column[0] == field]] if summary_aggs else states
+
+def aggregate_blocks(df: pd.DataFrame, keys: List[str], aggs: List[str], field_data: Dict[str, PivotField],
+                     block_rows: int, mask_func: Callable[[pd.DataFrame], np.ndarray] = None,
+                     on_block: Callable[[], None] = None) -> pd.DataFrame:
+    """
+    Compute `aggregate_states` of the selected rows of `df` one block of rows at a time.
+
+    Only one block is filtered and copied at a time, and the partial states of the blocks are merged
+    as they accumulate, so the extra memory depends on `block_rows` and the number of groups,
+    not on the length of `df`.
+
+    Args:
+        block_rows: The number of rows per block.
+        mask_func: mask_func(block) returns a boolean array selecting the rows of a block to aggregate.
+                   All rows are aggregated if None.
+        on_block: Called after each block, e.g. to stop early by raising.
+    """
+    columns = list(dict.fromkeys(keys + get_source_columns(aggs, field_data)))
+    states, pending, pending_rows = None, [], 0
+
+    for start in range(0, max(len(df), 1), block_rows):
+        block = df.iloc[start:start + block_rows]
+        selected = block[columns]
+        if mask_func is not None:
+            selected = selected[mask_func(block)]
+        pending.append(aggregate_states(selected, keys=keys, aggs=aggs, field_data=field_data))
+        pending_rows += len(pending[-1])
+
+        # merging costs O(groups), so merge once the pending parts are as large as the merged states
+        if states is None or pending_rows >= len(states):
+            states = merge_states(([] if states is None else [states]) + pending, keys=keys)
+            pending, pending_rows = [], 0
+        if on_block is not None:
+            on_block()
+
+    return merge_states([states] + pending, keys=keys) if pending else states
+
+def rollup_states(states: pd.DataFrame, keys: List[str], aggs: List[str] = None) -> pd.DataFrame:
+    """
+    Merge summed states into a coarser grouping.
+
+    Args:
+        states: Summed states indexed by group keys, e.g. from `aggregate_states`.
+        keys: A subset of the index levels of `states` to group by.
+        aggs: Only keep the states of these aggregate fields, all of them if None.
+
+    Returns:
+        pd.DataFrame: Summed states indexed by `keys`, in the same format as `aggregate_states`.
+    """
+    if aggs is not None:
+        columns = [column for column in states.columns if column[0] in aggs]
+        # keep the columns flat when nothing is selected, like `get_row_states` does for no aggs
+        states = states[columns] if columns else pd.DataFrame(index=states.index)
+
+    summary_columns = [column for column in states.columns if column[1] in SUMMARY_STATES]
+    if not summary_columns:
+        if not keys:
+            return states.sum().to_frame().T
+        return states.groupby(level=keys, observed=True).sum()
+
+    sums = states.drop(columns=summary_columns)
+    if not keys:
+        merged = sums.sum().to_frame().T
+        for column in summary_columns:
+            merged[column] = [merge_summaries(states[column].tolist())]
+    else:
+        grouped = sums.groupby(level=keys, observed=True)
+        merged = grouped.sum()
+        for column in summary_columns:
+            merged[column] = group_summaries(states[column], grouped, lambda group: merge_summaries(list(group)))
+
+    return merged[list(states.columns)]
+
+def merge_states(states_list: List[pd.DataFrame], keys: List[str]) -> pd.DataFrame:
+    """
+    Merge partial states of the same grouping, e.g. the states of an appended batch of rows
+    into the states of the existing rows. Groups present in several parts are added up.
+    """
+    non_empty = [states for states in states_list if len(states)]
+    if not non_empty:
+        # keep the columns and index names of the (empty) parts
+        return states_list[0] if states_list else pd.DataFrame()
+    if len(non_empty) == 1:
+        return non_empty[0]
+    return rollup_states(pd.concat(non_empty), keys=keys)
+
+def get_total_dtype(values: pd.Index, name: str, label: str = TOTAL_LABEL) -> pd.CategoricalDtype:
+    """
+    Return the categorical dtype of a group key level with `label` added as its last category, 
+    so that totals sort after the groups they add up.
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        categories, ordered = values.dtype.categories, values.dtype.ordered
+    else:
+        categories, ordered = values.unique(), False
+        try:
+            categories = categories.sort_values()
+        except TypeError:
+            pass
+    if label in categories:
+        raise ValueError(f"'{label}' is a value of the field '{name}' and can't label its totals.")
+    return pd.CategoricalDtype(categories=categories.append(pd.Index([label])), ordered=ordered)
+
+def rollup_grouping_sets(states: pd.DataFrame, rows: List[str], cols: List[str], label: str = TOTAL_LABEL) -> pd.DataFrame:
+    """
+    Add subtotals and grand totals to summed states, for every prefix of `rows` combined 
+    with every prefix of `cols`.
+
+    Each grouping set is rolled up from the next finer one, so the work shrinks with every level.
+    In the keys of a total, the levels that were rolled up are `label`.
+
+    Args:
+        states: Summed states indexed by `rows + cols`, e.g. from `aggregate_states`.
+        rows: The row fields, outermost first.
+        cols: The column fields, outermost first.
+
+    Returns:
+        pd.DataFrame: `states` and its totals, indexed by `rows + cols` with categorical levels 
+                      where `label` sorts last.
+    """
+    keys = rows + cols
+    index = states.index
+    dtypes = {name: get_total_dtype(index.get_level_values(name), name, label) for name in keys}
+
+    # sets[(i, j)] is grouped by rows[:i] + cols[:j]
+    sets = {(len(rows), len(cols)): states}
+    for j in range(len(cols), -1, -1):
+        for i in range(len(rows), -1, -1):
+            if (i, j) not in sets:
+                finer = sets[(i + 1, j)] if i < len(rows) else sets[(i, j + 1)]
+                sets[(i, j)] = rollup_states(finer, keys=rows[:i] + cols[:j])
+
+    parts = list(sets.values())
+    codes = {name: [] for name in keys}
+    for (i, j), part in sets.items():
+        grouped = rows[:i] + cols[:j]
+        for name in keys:
+            if name in grouped:
+                codes[name].append(pd.Categorical(part.index.get_level_values(name), dtype=dtypes[name]).codes)
+            else:
+                codes[name].append(np.full(len(part), len(dtypes[name].categories) - 1, dtype=np.int64))
+
+    levels = [pd.Categorical.from_codes(np.concatenate(codes[name]), dtype=dtypes[name]) for name in keys]
+    result = pd.concat([part.reset_index(drop=True) for part in parts], ignore_index=True)
+    if len(keys) == 1:
+        result.index = pd.CategoricalIndex(levels[0], name=keys[0])
+    else:
+        result.index = pd.MultiIndex.from_arrays(levels, names=keys)
+    # put each subtotal after the groups it adds up
+    return result.sort_index()
+
+def recast_states_index(states: pd.DataFrame, dtypes: Dict[str, pd.CategoricalDtype]) -> pd.DataFrame:
+    """
+    Convert the group key levels of `states` to new categorical dtypes, 
+    e.g. after new values were added to the categories of a GroupBy field.
+    """
+    index = states.index
+    if isinstance(index, pd.MultiIndex):
+        levels = [level.astype(dtypes[name]) if name in dtypes else level 
+                  for name, level in zip(index.names, index.levels)]
+        index = index.set_levels(levels)
+    elif index.name in dtypes:
+        index = index.astype(dtypes[index.name])
+    return states.set_axis(index, axis=0)
+
+def finalize_states(states: pd.DataFrame, aggs: List[str], field_data: Dict[str, PivotField]) -> pd.DataFrame:
+    """
+    Turn summed states back into one column per aggregate field.
+
+    Returns:
+        pd.DataFrame: A frame with the same index as `states` and columns `aggs`.
+    """
+    columns = {}
+    for field in aggs:
+        field_type = field_data[field].field_type
+
+        if field_type == PivotFieldType.Aggregate.SUM:
+            columns[field] = states[(field, 'sum')]
+        elif field_type == PivotFieldType.Aggregate.COUNT:
+            columns[field] = states[(field, 'count')]
+        elif field_type == PivotFieldType.Aggregate.WEIGHTED_AVERAGE:
+            columns[field] = states[(field, 'wx')] / states[(field, 'w')]
+        elif field_type == PivotFieldType.Aggregate.DISTINCT_COUNT:
+            columns[field] = [summary.count() for summary in states[(field, 'distinct')]]
+        elif field_type == PivotFieldType.Aggregate.MEDIAN:
+            columns[field] = [summary.quantile(0.5) for summary in states[(field, 'quantiles')]]
+        elif field_type == PivotFieldType.Aggregate.PERCENTILE:
+            q = field_data[field].percentile / 100
+            columns[field] = [summary.quantile(q) for summary in states[(field, 'quantiles')]]
+
+    return pd.DataFrame(columns, index=states.index)
+
+def get_states_nbytes(states: pd.DataFrame) -> int:
+    """
+    Estimate the memory held by summed states, including the summaries of distinct counts and quantiles.
+    """
+    nbytes = int(states.memory_usage(index=True, deep=False).sum())
+    for column in states.columns:
+        if column[1] in SUMMARY_STATES:
+            nbytes += sum(summary.nbytes for summary in states[column])
+    return nbytes
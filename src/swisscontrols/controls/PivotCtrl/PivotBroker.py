@@ -1,14 +1,46 @@
 
 import dataclasses
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
 from enum import Enum
-from typing import List, Dict, Callable
+from typing import List, Dict, Callable, Tuple, Optional
 
 import pandas as pd
 import numpy as np
 
-from swisscontrols.controls.PivotCtrl.DataSource import get_flat_data, get_field_data
+from swisscontrols.controls.PivotCtrl.DataSource import DataSource, RandomDataSource, LoadStats
 from swisscontrols.controls.PivotCtrl.PivotField import PivotField, PivotFieldType
-from swisscontrols.controls.UserScripts.user_scripts import create_combined_lambdas
+from swisscontrols.controls.PivotCtrl.PivotAggregate import aggregate_states, aggregate_blocks, finalize_states, get_source_columns, rollup_grouping_sets
+from swisscontrols.controls.PivotCtrl.PivotCompact import CompactReport, compact_frame, compact_batch
+from swisscontrols.controls.PivotCtrl.PivotCache import PivotCache, FilterMaskCache, get_pivot_key, get_filters_key
+from swisscontrols.controls.PivotCtrl.PivotCube import PivotCube, PivotDelta
+from swisscontrols.controls.PivotCtrl.PivotLayout import PivotLayout, split_layout, unstack_pivot
+from swisscontrols.controls.PivotCtrl.PivotParallel import ShardedAggregator
+from swisscontrols.controls.PivotCtrl.PivotResult import PivotResult
+from swisscontrols.controls.PivotCtrl.PivotStats import PivotStats, time_stage
+from swisscontrols.controls.UserScripts.user_scripts import create_combined_mask
+
+class PivotCancelled(Exception):
+    """
+    Raised inside a background pivot that was superseded by a newer request.
+    """
+    pass
+
+@dataclasses.dataclass
+class PivotWindow:
+    """
+    A rectangular slice of a pivot result, see `PivotBroker.get_pivot_window`.
+    """
+    data: pd.DataFrame          # the cells in the window, with their row and column labels
+    n_rows: int                 # the number of rows of the full result
+    n_cols: int                 # the number of columns of the full result
+    row_range: Tuple[int, int]  # [start, stop) of the window rows in the full result
+    col_range: Tuple[int, int]  # [start, stop) of the window columns in the full result
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return (self.n_rows, self.n_cols)
 
 class PivotBroker:
     # mediator between PivotCtrl and DataSource
@@ -17,36 +49,322 @@ class PivotBroker:
     # handles all pandas operations separately from UI 
     # tells the UI the available fields names and types
 
-    df: pd.DataFrame
+    _df: pd.DataFrame
     field_data: Dict[str, PivotField]
+    data_source: DataSource
+    load_stats: LoadStats
+    cube: PivotCube
+
+    def __init__(self, 
+                 data_source: DataSource = None, 
+                 cache_entries: int = 32, 
+                 cache_bytes: int = 256 * 2**20,
+                 auto_cube: bool = False,
+                 n_workers: int = 1,
+                 collect_stats: bool = False,
+                 stats_hook: Callable[[PivotStats], None] = None,
+                 pushdown: bool = False,
+                 compact: bool = False,
+                 chunk_rows: int = None):
+        """
+        :param data_source: Where the flat data and the field catalog come from, random demo data by default
+        :param cache_entries: The maximum number of pivot results kept in the LRU caches, 0 to disable caching
+        :param cache_bytes: The approximate memory budget of each LRU cache
+        :param auto_cube: Materialize a cube for every pivot that the current cube can't answer, 
+                          so that later, coarser pivots are rolled up from it (see `materialize_cube`)
+        :param n_workers: Aggregate large frames in this many worker processes, over shared memory
+                          (see PivotParallel). 1 aggregates in this process.
+        :param collect_stats: Time the stages of each `get_pivot` call, see `last_stats`
+        :param stats_hook: Called with the PivotStats of each `get_pivot` call, implies `collect_stats`.
+                           Called on the thread that computed the pivot.
+        :param pushdown: Don't load the flat data up front. Each aggregation scans only the columns 
+                         it needs and the rows its filters select from the data source, see `DataSource.scan`.
+                         The full data is loaded on first use of `df`, e.g. by `append_rows`.
+        :param compact: Store the flat data in compact dtypes (float32, small integers, interned strings), 
+                        see PivotCompact for the rules and the float tolerance of the results. 
+                        The memory of each column before and after is reported in `compact_report`.
+        :param chunk_rows: Evaluate filters and aggregate in blocks of this many rows, merging the partial 
+                           aggregates at the end, so that no full-length mask or filtered copy of the data 
+                           is built. Bounds the extra memory of a pivot by the block size instead of the 
+                           data size. Filter masks are then not cached. Each block has a fixed overhead, so blocks 
+                           of about 1e5 rows or more keep the time close to unchunked evaluation, see 
+                           benchmarks/bench_chunked.py. None evaluates the whole frame at once.
+        """
+
+        # pivot results are memoized by (filters, rows, cols, aggs) and dropped whenever the data changes
+        self.cache = PivotCache(max_entries=cache_entries, max_bytes=cache_bytes)
+        # the aggregate states behind those results, as PivotCubes keyed by (filters, keys, aggs)
+        # they survive `append_rows`, which merges the new rows into them
+        self.states_cache = PivotCache(max_entries=cache_entries, max_bytes=cache_bytes)
+        # the last mask of each filter, so editing one filter doesn't re-evaluate the others
+        self.mask_cache = FilterMaskCache()
+        self.auto_cube = auto_cube
+        self.cube = None
+        self.parallel = ShardedAggregator(n_workers) if n_workers > 1 else None
+        self.pushdown = pushdown
+        self.compact = compact
+        self.compact_report = None
+        self.chunk_rows = chunk_rows
+
+        # per-stage timings, see PivotStats
+        self.collect_stats = collect_stats
+        self.stats_hook = stats_hook
+        self.last_stats = None
+        self.data_version = 0
+
+        # background pivots, see `get_pivot_async`
+        # `_lock` guards the data, its version and the caches. It is only held to read or update them, 
+        # pivots are computed without it on a snapshot of the data, see `_snapshot`
+        self._lock = threading.RLock()
+        # held while the worker processes read the shared copy of the data
+        self._parallel_lock = threading.Lock()
+        self._executor = None
+        self._latest_request = 0
+        self._pending = None
+        self._local = threading.local()
+
+        # per-field (codes, sorted unique values), see `get_unique_counts`
+        self._unique_index = {}
+
+        # batches from `append_rows` that have not been concatenated to `_df` yet
+        self._chunks = []
 
-    def __init__(self):
+        self.set_data_source(data_source or RandomDataSource())
 
+    def set_data_source(self, data_source: DataSource):
+        """
+        Load the flat data and the field catalog from `data_source`.
+        Load time and memory are reported in `self.load_stats`.
+        """
+        self.data_source = data_source
+        self.field_data = data_source.get_field_data()
+        if self.pushdown:
+            # loaded on first use, see the `df` property
+            with self._lock:
+                self._df = None
+                self.load_stats = None
+                self._invalidate()
+            return
+        df, self.load_stats = data_source.load_with_stats()
+        self.set_data(df)
+
+    @property
+    def df(self) -> pd.DataFrame:
+        if self._df is None:
+            with self._lock:
+                if self._df is None:
+                    df, self.load_stats = self.data_source.load_with_stats()
+                    self._df = self._prepare(df)
+                    # states scanned so far have categories of only the scanned rows, 
+                    # so they can't take appended rows encoded like the full data
+                    self.data_version += 1
+                    self.states_cache.clear()
+                    self.mask_cache.clear(version=self.data_version)
+                    self.cube = None
+        # concatenate appended batches only when the raw rows are actually needed
+        if self._chunks:
+            with self._lock:
+                if self._chunks:
+                    self._df = pd.concat([self._df] + self._chunks, ignore_index=True)
+                    self._chunks = []
+        return self._df
+
+    @df.setter
+    def df(self, df: pd.DataFrame):
+        self.set_data(df)
+
+    def set_data(self, df: pd.DataFrame):
+        """
+        Replace the flat data and invalidate everything derived from it.
+
+        Note: the cache can't see in-place edits of the DataFrame, so always assign a new frame 
+        (or call `set_data` again) after modifying the data.
+        """
         # if df is multiindex raise exception
         # should be flat data
-        self.df = get_flat_data()
-        assert not isinstance(self.df.columns, pd.MultiIndex), "DataFrame columns should not be a MultiIndex"
-        assert not isinstance(self.df.index, pd.MultiIndex), "DataFrame index should not be a MultiIndex"
-        assert isinstance(self.df.index, pd.RangeIndex), "DataFrame index should be a default integer-based index (RangeIndex)"
+        assert not isinstance(df.columns, pd.MultiIndex), "DataFrame columns should not be a MultiIndex"
+        assert not isinstance(df.index, pd.MultiIndex), "DataFrame index should not be a MultiIndex"
+        assert isinstance(df.index, pd.RangeIndex), "DataFrame index should be a default integer-based index (RangeIndex)"
+
+        df = self._prepare(df)
+        with self._lock:
+            self._df = df
+            self._invalidate()
+
+    def _prepare(self, df: pd.DataFrame) -> pd.DataFrame:
+        # the frame as it is stored: GroupBy fields encoded, and compacted in compact mode
+        encoded = self._encode_groupby_fields(df)
+        if not self.compact:
+            return encoded
+        compacted = compact_frame(encoded, self.field_data)
+        self.compact_report = CompactReport.compare(df, compacted)
+        return compacted
+
+    def _invalidate(self):
+        # drop everything derived from the previous data
+        with self._lock:
+            self._chunks = []
+            self.data_version += 1
+            self.cache.clear()
+            self.states_cache.clear()
+            self.mask_cache.clear(version=self.data_version)
+            self.cube = None
+            self._unique_index = {}
+            # a running parallel aggregate still reads the shared copy, the next one replaces it anyway
+            if self.parallel is not None and self._parallel_lock.acquire(blocking=False):
+                try:
+                    self.parallel.release()
+                finally:
+                    self._parallel_lock.release()
+
+    def append_rows(self, frame: pd.DataFrame) -> List[PivotDelta]:
+        """
+        Append rows to the flat data and update cached aggregates incrementally.
+
+        The batch is encoded and queued in O(len(frame)); it is concatenated to `df` only when 
+        a pivot needs to scan the raw rows again. The materialized cube and every cached 
+        aggregate in `states_cache` merge the states of the batch, so SUM, COUNT and 
+        WEIGHTED_AVERAGE pivots over them are refreshed without a rescan. Cached filter masks 
+        are extended with the masks of the batch.
+
+        If the batch contains values that are new to a GroupBy field, the field's categories are
+        extended and kept sorted, which recodes that column once.
+
+        :param frame: New rows with the same columns as `df`
+        :returns: One PivotDelta per updated aggregate, listing the group keys (pivot cells) that changed
+        """
+        if self._df is None:
+            # load the data once, the batches are then queued after it
+            _ = self.df
+        # `_df` has the columns of the queued batches too, `df` would concatenate them
+        missing = set(self._df.columns) - set(frame.columns)
+        if missing:
+            raise Exception(f"Appended rows are missing the fields {sorted(missing)}.")
+        
+        with self._lock:
+            batch = frame[list(self._df.columns)].reset_index(drop=True)
+            batch = self._extend_categories(batch)
+            if self.compact:
+                batch = self._compact_batch(batch)
+
+            self._chunks.append(batch)
+            self.data_version += 1
+            self.mask_cache.extend(batch, version=self.data_version)
+            self.cache.clear()
+            self._unique_index = {}
+
+            deltas = []
+            if self.cube is not None:
+                deltas.append(self.cube.append(batch, self.field_data))
+                self.cube.data_version = self.data_version
+            for key, cube in self.states_cache.items():
+                deltas.append(cube.append(batch, self.field_data))
+                cube.data_version = self.data_version
+                # re-insert to account for the new size
+                self.states_cache.put(key, cube)
+
+            return deltas
+
+    def _snapshot(self) -> Tuple[Optional[pd.DataFrame], int]:
+        """
+        Return the data and its version, read together. The data is None until it is loaded in pushdown mode.
+
+        Frames are replaced rather than modified, so the snapshot can be read without the lock 
+        while other threads append rows.
+        """
+        with self._lock:
+            return (None if self._df is None else self.df), self.data_version
+
+    def _cache_get(self, key):
+        with self._lock:
+            return self.cache.get(key)
+
+    def _cache_put(self, key, value, version: int):
+        # results computed from data that changed meanwhile are dropped
+        with self._lock:
+            if version == self.data_version:
+                self.cache.put(key, value)
+
+    def _count_rows(self) -> Optional[int]:
+        # the number of rows, without concatenating the queued batches; None until the data is loaded
+        if self._df is None:
+            return None
+        return len(self._df) + sum(len(chunk) for chunk in self._chunks)
+
+    def _extend_categories(self, batch: pd.DataFrame) -> pd.DataFrame:
+        """
+        Encode the GroupBy fields of `batch` with the categorical dtypes of `_df`, 
+        adding any new values to the categories of `_df`, the pending batches and the cached states.
+        """
+        batch = batch.copy(deep=False)
+        changed = {}
+        for name in batch.columns:
+            dtype = self._df[name].dtype
+            if not isinstance(dtype, pd.CategoricalDtype):
+                continue
+
+            values = batch[name].dropna().unique()
+            new_values = values[~pd.Index(values).isin(dtype.categories)]
+            if len(new_values):
+                categories = dtype.categories.append(pd.Index(new_values))
+                try:
+                    categories = categories.sort_values()
+                except TypeError:
+                    pass
+                dtype = pd.CategoricalDtype(categories=categories, ordered=dtype.ordered)
+                changed[name] = dtype
+            batch[name] = batch[name].astype(dtype)
 
-        self.field_data = get_field_data()
+        if changed:
+            df = self._df.copy(deep=False)
+            for name, dtype in changed.items():
+                df[name] = df[name].astype(dtype)
+            self._df = df
+            self._chunks = [chunk.astype(changed) for chunk in self._chunks]
+            if self.cube is not None:
+                self.cube.recast(changed)
+            for _, cube in self.states_cache.items():
+                cube.recast(changed)
+        
+        return batch
 
-        # assign the aggregation functions to local PivotBroker functions
-        self.aggregation_functions = {
-            PivotFieldType.Aggregate.SUM: 'sum',
-            PivotFieldType.Aggregate.WEIGHTED_AVERAGE: self.custom_weighted_average,
-            PivotFieldType.Aggregate.COUNT: 'count',
-            # define other aggregation functions here...
-        }
+    def _compact_batch(self, batch: pd.DataFrame) -> pd.DataFrame:
+        """
+        Compact `batch` like `_df`, widening the columns of `_df` and the pending batches 
+        that are too narrow for its values.
+        """
+        batch, widened = compact_batch(batch, dict(self._df.dtypes), self.field_data)
+        if widened:
+            self._df = self._df.astype(widened)
+            self._chunks = [chunk.astype(widened) for chunk in self._chunks]
+        return batch
 
+    def _encode_groupby_fields(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Convert GroupBy fields to pandas categoricals, so that groupby, unstack and 
+        get_uniques work on small integer codes instead of strings or int64s.
+
+        ORDINAL fields get ordered categories, sorted by value. CATEGORY fields are unordered.
+        """
+        df = df.copy(deep=False)
         for name, field in self.field_data.items():
-            if isinstance(field.field_type, PivotFieldType.Aggregate):
-                field.agg_func = self.aggregation_functions[field.field_type]
+            if name not in df.columns or not isinstance(field.field_type, PivotFieldType.GroupBy):
+                continue
+
+            if field.field_type == PivotFieldType.GroupBy.ORDINAL:
+                categories = np.sort(df[name].dropna().unique())
+                dtype = pd.CategoricalDtype(categories=categories, ordered=True)
+            else:
+                dtype = 'category'
+            df[name] = df[name].astype(dtype)
+        return df
 
     def get_field_list(self):
         # return sorted(self.df.columns)
         # assume the data source, in its infinite wisdom, has given us pre-ordered columns
-        return self.df.columns
+        if self._df is None:
+            return pd.Index(list(self.data_source.get_dtypes()))
+        return self._df.columns
     
     def get_field_type(self, field_name):
         if (field_name == "(Data)"):
@@ -57,56 +375,474 @@ class PivotBroker:
         return self.field_data[field_name].field_type
 
     def get_uniques(self, field_name):
+        return self.get_unique_counts(field_name).index.to_numpy()
+
+    def get_unique_counts(self, field_name: str, filters: List[Callable] = None) -> pd.Series:
+        """
+        Return the sorted unique values of a field with their row counts.
+
+        The per-field index of values is computed once and dropped when the data changes.
+
+        :param field_name: The field to list
+        :param filters: If given, only count the rows selected by these filters, and drop 
+                        values that are no longer reachable. Typically the other active filters.
+        :returns: A Series of counts indexed by the unique values, in sort order
+        """
         if field_name not in self.field_data:
             raise Exception(f"The field '{field_name}' does not exist.")
-        return self.df[field_name].unique()
+        
+        with self._lock:
+            df, version = self._snapshot()
+            index = self._unique_index.get(field_name)
+
+        # computed without the lock, so a background pivot doesn't hold this up
+        if index is None:
+            index = self._build_unique_index(self._scan(None, [field_name])[field_name] if df is None else df[field_name])
+            with self._lock:
+                if version == self.data_version:
+                    self._unique_index[field_name] = index
+        codes, values = index
+        counts = None
 
-    def custom_weighted_average(self, series: pd.Series) -> float:
-        weight_col = self.field_data[series.name].weight_field
-        return np.average(series, weights=self.df.loc[series.index, weight_col])
+        if filters and self.chunk_rows and df is not None:
+            # count block by block, without a full-length mask
+            counts = np.zeros(len(values), dtype=np.int64)
+            for start in range(0, len(df), self.chunk_rows):
+                block_codes = codes[start:start + self.chunk_rows]
+                block_codes = block_codes[create_combined_mask(filters, df.iloc[start:start + self.chunk_rows])]
+                counts += np.bincount(block_codes[block_codes >= 0], minlength=len(values))
+        elif filters and df is None:
+            # scan only the rows the filters select, and look up their values
+            scanned = self._scan(filters, [field_name])[field_name]
+            codes = values.get_indexer(scanned.to_numpy())
+        elif filters:
+            codes = codes[self.mask_cache.get_combined_mask(filters, df, version)]
+
+        if counts is None:
+            counts = np.bincount(codes[codes >= 0], minlength=len(values))
+        observed = counts > 0
+        return pd.Series(counts[observed], index=values[observed], name=field_name)
+
+    def _scan(self, filters: List[Callable], columns: List[str]) -> pd.DataFrame:
+        """
+        Read `columns` of the rows selected by `filters` from the data source, encoded like `df`.
+        """
+        return self._encode_groupby_fields(self.data_source.scan(columns=columns, filters=filters))
+
+    def _build_unique_index(self, series: pd.Series):
+        """
+        Return (codes, sorted values), where codes[i] is the position of row i in values and -1 for missing values.
+        """
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            # categories are already sorted, ordered fields by value and unordered ones lexicographically
+            return series.cat.codes.to_numpy(), series.cat.categories
+
+        try:
+            codes, values = pd.factorize(series, sort=True)
+        except TypeError:
+            # mixed types that can't be compared, sort by their text instead
+            codes, values = pd.factorize(series)
+            order = np.argsort([str(value) for value in values], kind='stable')
+            codes = np.where(codes >= 0, np.argsort(order)[codes], -1)
+            values = values[order]
+        return codes, values
 
     def get_filtered(self, filter):
-        return self.df[self.df.apply(filter, axis=1)]
+        df, version = self._snapshot()
+        if df is None:
+            df, version = self.df, self.data_version
+        return df[self.mask_cache.get_mask(filter, df, version)]
+
+    def _filter(self, filters: List[Callable], df: pd.DataFrame, version: int) -> pd.DataFrame:
+        if not filters:
+            return df
+        # filters are evaluated column-wise where possible, see `MaskFilter`
+        # and only filters that changed since the last call are re-evaluated
+        return df[self.mask_cache.get_combined_mask(filters, df, version)]
+
+    def get_aggregate_fields(self) -> List[str]:
+        return [name for name, field in self.field_data.items() 
+                if isinstance(field.field_type, PivotFieldType.Aggregate) and name in self.get_field_list()]
+
+    def materialize_cube(self, filters: List[Callable], dims: List[str], aggs: List[str] = None) -> PivotCube:
+        """
+        Aggregate the filtered data at the finest grouping of `dims` and keep the result.
+
+        Later pivots with the same filters, grouped by any subset of `dims`, are rolled up from 
+        the cube instead of rescanning the flat data. Only one cube is kept at a time.
+
+        :param filters: The filters the cube is valid for. Opaque callables can't be matched later.
+        :param dims: The GroupBy fields of the finest grouping
+        :param aggs: The aggregate fields to include, all of them by default
+        """
+        snapshot = self._snapshot()
+        cube = self._build_cube(filters, dims, aggs, snapshot)
+        with self._lock:
+            # a cube of data that changed meanwhile would miss the appended rows
+            if snapshot[1] == self.data_version:
+                self.cube = cube
+        return cube
+
+    def _build_cube(self, filters: List[Callable], dims: List[str], aggs: List[str], snapshot: Tuple[Optional[pd.DataFrame], int]) -> PivotCube:
+        aggs = self.get_aggregate_fields() if aggs is None else list(aggs)
+        states = self._aggregate(filters, keys=list(dims), aggs=aggs, snapshot=snapshot)
+        return PivotCube(states, dims=dims, aggs=aggs, filters=filters, filters_key=get_filters_key(filters), data_version=snapshot[1])
+
+    def drop_cube(self):
+        self.cube = None
+
+    def _aggregate(self, filters: List[Callable], keys: List[str], aggs: List[str], snapshot: Tuple[Optional[pd.DataFrame], int]) -> pd.DataFrame:
+        """
+        Filter the data and compute its summed aggregate states, in worker processes if the frame is large enough.
+
+        :param snapshot: The data and its version, see `_snapshot`
+        """
+        df, version = snapshot
+        if df is None:
+            # pushdown: read only what this aggregate needs
+            with self._stage('scan') as stage:
+                filtered_df = self._scan(filters, list(dict.fromkeys(keys + get_source_columns(aggs, self.field_data))))
+                if stage:
+                    stage.rows = len(filtered_df)
+            self._check_cancelled()
+            with self._stage('aggregate') as stage:
+                states = aggregate_states(filtered_df, keys=keys, aggs=aggs, field_data=self.field_data)
+                if stage:
+                    stage.rows = len(states)
+            return states
+
+        if self.parallel is not None and self.parallel.get_n_shards(len(df)) > 1:
+            with self._stage(f'filter + aggregate ({self.parallel.get_n_shards(len(df))} shards)') as stage, self._parallel_lock:
+                states = self.parallel.aggregate(df, version, filters, keys=keys, aggs=aggs, 
+                                                 field_data=self.field_data,
+                                                 mask_func=lambda opaque: self.mask_cache.get_combined_mask(opaque, df, version),
+                                                 check_cancelled=self._check_cancelled)
+                if stage:
+                    stage.rows = len(states)
+            return states
+
+        if self.chunk_rows and len(df) > self.chunk_rows:
+            n_blocks = -(-len(df) // self.chunk_rows)
+            with self._stage(f'filter + aggregate ({n_blocks} blocks)') as stage:
+                states = aggregate_blocks(df, keys=keys, aggs=aggs, field_data=self.field_data, block_rows=self.chunk_rows,
+                                          mask_func=(lambda block: create_combined_mask(filters, block)) if filters else None,
+                                          on_block=self._check_cancelled)
+                if stage:
+                    stage.rows = len(states)
+            return states
+
+        with self._stage('filter') as stage:
+            filtered_df = self._filter(filters, df, version)
+            if stage:
+                stage.rows = len(filtered_df)
+        self._check_cancelled()
+        with self._stage('aggregate') as stage:
+            states = aggregate_states(filtered_df, keys=keys, aggs=aggs, field_data=self.field_data)
+            if stage:
+                stage.rows = len(states)
+        return states
+
+    def _stage(self, name: str):
+        # time a stage of the current `get_pivot` call, if stats are being collected on this thread
+        return time_stage(getattr(self._local, 'stats', None), name)
+
+    def _get_states(self, filters: List[Callable], keys: List[str], aggs: List[str]) -> pd.DataFrame:
+        """
+        Return the summed aggregate states of the filtered data grouped by `keys`,
+        rolled up from the cube when it can answer the query.
+        """
+        filters_key = get_filters_key(filters)
+        # the exact states are kept as well, so they can follow appended rows
+        states_key = None if filters_key is None else (filters_key, tuple(keys), tuple(aggs))
+
+        with self._lock:
+            cube = self.cube
+            if cube is None or not cube.can_answer(keys, aggs, filters_key, self.data_version):
+                cube = None
+                cached = self.states_cache.get(states_key)
+                if cached is not None:
+                    return cached.states
+
+        if cube is not None:
+            with self._stage('rollup'):
+                return cube.rollup(keys=keys, aggs=aggs)
+
+        # computed without the lock, and only kept if no rows were appended meanwhile
+        snapshot = self._snapshot()
+        if self.auto_cube and keys and filters_key is not None:
+            cube = self._build_cube(filters, dims=keys, aggs=None, snapshot=snapshot)
+            with self._lock:
+                if snapshot[1] == self.data_version:
+                    self.cube = cube
+            with self._stage('rollup'):
+                return cube.rollup(keys=keys, aggs=aggs)
+
+        cube = self._build_cube(filters, dims=keys, aggs=aggs, snapshot=snapshot)
+        with self._lock:
+            if snapshot[1] == self.data_version:
+                self.states_cache.put(states_key, cube)
+        return cube.states
 
     def get_pivot(self, 
                   filters: List[Callable], 
                   rows: List[str], 
                   cols: List[str], 
-                  aggs: List[str]):
+                  aggs: List[str],
+                  totals: bool = False):
         
         """
         :param rows: A list of fields to become index in the returned dataframe
         :param cols: A list of fields to become columns in the returned dataframe
         :param aggs: A list of fields to be grouped by rows and cols
+        :param totals: Add subtotals for every prefix of the row and column fields, and grand totals. 
+                       Their keys are 'Total' in the levels that are added up, and they sort after the
+                       groups they add up. All totals are rolled up from the finest aggregate, see
+                       `rollup_grouping_sets`. Ignored when there are no aggregate fields.
 
         A special string '(Data)' indicates the level of the `aggs` fields in one of the MultiIndexes.
+
+        Results are served from the LRU cache when the same configuration was computed before.
+        The returned dataframe may be shared with the cache and should not be modified.
         """
+
+        # don't modify the caller's lists
+        rows, cols, aggs = list(rows), list(cols), list(aggs)
+
+        with self._lock:
+            version = self.data_version
+            stats = None
+            if self.collect_stats or self.stats_hook is not None:
+                stats = PivotStats(rows=list(rows), cols=list(cols), aggs=list(aggs), source_rows=self._count_rows())
+                start = time.perf_counter()
+
+        key = get_pivot_key(filters, rows, cols, aggs)
+        if key is not None:
+            key = (version, 'totals', key) if totals else (version, key)
         
-        if not filters:
-            filtered_df = self.df
+        result = self._cache_get(key)
+        if result is None:
+            # computed without the lock, see `_snapshot`
+            self._local.stats = stats
+            try:
+                result = self._compute_pivot(filters, rows, cols, aggs, totals)
+            finally:
+                self._local.stats = None
+            self._cache_put(key, result, version)
+        elif stats is not None:
+            stats.cache_hit = True
+
+        if stats is not None:
+            stats.seconds = time.perf_counter() - start
+            stats.result_shape = result.shape
+            self.last_stats = stats
+            if self.stats_hook is not None:
+                self.stats_hook(stats)
+
+        return result
+
+    def get_pivot_window(self, 
+                         filters: List[Callable], 
+                         rows: List[str], 
+                         cols: List[str], 
+                         aggs: List[str],
+                         row_range: Tuple[int, int],
+                         col_range: Tuple[int, int] = None,
+                         sparse: bool = False,
+                         totals: bool = False) -> PivotWindow:
+        """
+        Return only the cells of a pivot in `row_range` x `col_range`, along with the shape of the full result.
+
+        The pivot is computed once and cached like `get_pivot`, so a table view can page and scroll 
+        through a large result without copying the whole frame on every scroll.
+
+        :param row_range: [start, stop) of the rows to return, clipped to the result
+        :param col_range: [start, stop) of the columns to return, all columns if None
+        :param sparse: Keep the pivot in long form and densify only the window, see `get_pivot_layout`
+        :param totals: Include subtotals and grand totals, see `get_pivot`
+        """
+        if sparse and aggs:
+            layout = self.get_pivot_layout(filters=filters, rows=rows, cols=cols, aggs=aggs, totals=totals)
+            n_rows, n_cols = layout.shape
         else:
-            combined_lambda = create_combined_lambdas(lambdas=filters)
-            filtered_df = self.df[self.df.apply(combined_lambda, axis=1)]
+            result = self.get_pivot(filters=filters, rows=rows, cols=cols, aggs=aggs, totals=totals)
+            n_rows, n_cols = result.shape
 
-        agg_dict = {field: self.field_data[field].agg_func for field in aggs}
-        # if 'Price/kg' in agg_dict:
-        #     agg_dict['Price/kg'] = self.custom_weighted_average
+        row_range = self._clip_range(row_range, n_rows)
+        col_range = self._clip_range(col_range or (0, n_cols), n_cols)
+        if sparse and aggs:
+            data = layout.densify(row_range, col_range)
+        else:
+            data = result.iloc[row_range[0]:row_range[1], col_range[0]:col_range[1]]
 
-        # before anything else, figure out the transpose situation
-        transpose = False
-        if('(Data)' in rows):
-            """
-            If '(Data)' is in the rows, then swap rows with columns and transpose at the end. 
-            """
-            cols, rows = rows, cols
-            transpose = True
-
-        cols_init = ['(Data)'] + [col for col in cols if col != '(Data)'] # initial dataframe.columns.names
-        col_levels_dict = {col: cols_init.index(col) for col in cols_init} # index of each item in initial df
-        col_level_order = [col_levels_dict[item] for item in cols] # where we want the cols to be
+        return PivotWindow(data=data, n_rows=n_rows, n_cols=n_cols, row_range=row_range, col_range=col_range)
+
+    def get_pivot_long(self, 
+                       filters: List[Callable], 
+                       rows: List[str], 
+                       cols: List[str], 
+                       aggs: List[str],
+                       totals: bool = False) -> pd.DataFrame:
+        """
+        Return a pivot in long form: one row per non-empty group, indexed by the row fields 
+        followed by the column fields (without '(Data)'), with one column per aggregate field.
+
+        Unlike `get_pivot`, the column fields are not unstacked, so memory scales with the 
+        number of non-empty groups rather than with the cross-product of the row and column keys.
+        """
+        return self.get_pivot_layout(filters=filters, rows=rows, cols=cols, aggs=aggs, totals=totals).long_result
+
+    def get_pivot_layout(self, 
+                         filters: List[Callable], 
+                         rows: List[str], 
+                         cols: List[str], 
+                         aggs: List[str],
+                         totals: bool = False) -> PivotLayout:
+        """
+        Return the long form of a pivot along with the axes of its dense table, see PivotLayout.
+        Layouts are cached like `get_pivot` results.
+
+        :param totals: Include subtotals and grand totals, see `get_pivot`
+        """
+        if not aggs:
+            raise ValueError("A pivot layout needs at least one aggregate field.")
+
+        rows, cols, aggs = list(rows), list(cols), list(aggs)
+
+        version = self.data_version
+        key = get_pivot_key(filters, rows, cols, aggs)
+        if key is not None:
+            key = (version, 'layout', totals, key)
         
-        # Remove '(Data)' from cols list
-        cols.remove('(Data)') 
+        layout = self._cache_get(key)
+        if layout is None:
+            self._check_cancelled()
+            rows, cols, col_level_order, transpose = split_layout(rows, cols)
+            long_result = self._compute_long(filters, rows, cols, aggs, totals)
+            layout = PivotLayout(long_result, cols, col_level_order, aggs, transpose)
+            self._cache_put(key, layout, version)
+
+        return layout
+
+    def get_pivot_result(self, 
+                         filters: List[Callable], 
+                         rows: List[str], 
+                         cols: List[str], 
+                         aggs: List[str],
+                         totals: bool = False) -> PivotResult:
+        """
+        Return a pivot as a PivotResult: its cells in one 2-D numpy array and its headers as label arrays.
+        
+        Pivots with aggregate fields are densified straight from the long form, so the DataFrame 
+        is only built if `PivotResult.to_frame` is called. Results are cached like `get_pivot` results.
+
+        :param totals: Include subtotals and grand totals, see `get_pivot`
+        """
+        rows, cols, aggs = list(rows), list(cols), list(aggs)
+
+        version = self.data_version
+        key = get_pivot_key(filters, rows, cols, aggs)
+        if key is not None:
+            key = (version, 'result', totals, key)
+
+        result = self._cache_get(key)
+        if result is None:
+            if aggs:
+                layout = self.get_pivot_layout(filters=filters, rows=rows, cols=cols, aggs=aggs, totals=totals)
+                result = PivotResult.from_layout(layout)
+            else:
+                # no cells, only the labels of the non-empty groups
+                result = PivotResult.from_frame(self.get_pivot(filters=filters, rows=rows, cols=cols, aggs=aggs))
+            self._cache_put(key, result, version)
+
+        return result
+
+    @staticmethod
+    def _clip_range(index_range: Tuple[int, int], n: int) -> Tuple[int, int]:
+        start, stop = index_range
+        start = min(max(start, 0), n)
+        stop = min(max(stop, start), n)
+        return (start, stop)
+
+    def get_pivot_async(self, 
+                        filters: List[Callable], 
+                        rows: List[str], 
+                        cols: List[str], 
+                        aggs: List[str],
+                        totals: bool = False) -> Future:
+        """
+        Compute `get_pivot` on a worker thread and return a Future of the result.
+
+        The latest request wins: submitting a new request cancels any request that has not 
+        started yet, and a request that is already running stops at the next stage boundary
+        by raising `PivotCancelled`. Use `is_latest` to ignore results of superseded requests.
+
+        The Future completes on the worker thread. UI code should poll it from the main thread
+        (e.g. once per frame) rather than touch widgets from a done-callback.
+        """
+        return self._submit(self.get_pivot, filters, rows, cols, aggs, totals)
+
+    def get_pivot_result_async(self, 
+                               filters: List[Callable], 
+                               rows: List[str], 
+                               cols: List[str], 
+                               aggs: List[str],
+                               totals: bool = False) -> Future:
+        """
+        Compute `get_pivot_result` on the worker thread, see `get_pivot_async`.
+        """
+        return self._submit(self.get_pivot_result, filters, rows, cols, aggs, totals)
+
+    def _submit(self, method: Callable, filters, rows, cols, aggs, totals) -> Future:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="PivotBroker")
+
+        self._latest_request += 1
+        if self._pending is not None:
+            self._pending.cancel()
+
+        # snapshot the arguments, the caller may keep editing its lists
+        self._pending = self._executor.submit(self._run_async, self._latest_request, method,
+                                              list(filters or []), list(rows), list(cols), list(aggs), totals)
+        return self._pending
+
+    def is_latest(self, future: Future) -> bool:
+        return future is self._pending
+
+    def _run_async(self, request: int, method: Callable, filters, rows, cols, aggs, totals):
+        self._local.request = request
+        try:
+            self._check_cancelled()
+            return method(filters=filters, rows=rows, cols=cols, aggs=aggs, totals=totals)
+        finally:
+            self._local.request = None
+
+    def _check_cancelled(self):
+        # only background requests can be cancelled
+        request = getattr(self._local, 'request', None)
+        if request is not None and request != self._latest_request:
+            raise PivotCancelled()
+
+    def shutdown(self):
+        """
+        Stop the worker thread used by `get_pivot_async` and the worker processes of `n_workers`.
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self.parallel is not None:
+            self.parallel.shutdown()
+
+    def _compute_pivot(self, 
+                       filters: List[Callable], 
+                       rows: List[str], 
+                       cols: List[str], 
+                       aggs: List[str],
+                       totals: bool = False):
+        
+        self._check_cancelled()
+
+        # before anything else, figure out the transpose situation
+        rows, cols, col_level_order, transpose = split_layout(rows, cols)
         
          # deal with special cases
         if not (rows+cols+aggs):
@@ -114,13 +850,33 @@ class PivotBroker:
             result = pd.DataFrame(index=[""], columns=[""]).fillna(0 )
 
             return result    
-        elif not (aggs):
+
+        result = self._compute_long(filters, rows, cols, aggs, totals)
+
+        self._check_cancelled()
+        
+        result = unstack_pivot(result, cols, col_level_order, aggs, stats=getattr(self._local, 'stats', None))
+
+        if(transpose):
+            with self._stage('transpose'):
+                result = result.T
+        
+        
+        return result
+
+    def _compute_long(self, 
+                      filters: List[Callable], 
+                      rows: List[str], 
+                      cols: List[str], 
+                      aggs: List[str],
+                      totals: bool = False) -> pd.DataFrame:
+        """
+        Compute the long form of a pivot, with `rows` and `cols` normalized by `split_layout`.
+        """
+        if not (aggs):
             # special case: [rows, cols] populated but [aggs] empty
-            result = (filtered_df[rows+cols+aggs]
-                        .groupby(rows+cols)
-                        .sum(numeric_only=True)
-                        # .agg(agg_dict)
-                    )
+            # the result has no columns, its index lists the non-empty groups
+            result = self._get_states(filters, keys=rows+cols, aggs=aggs)
             
             # if rows is empty list, insert a 'Value' level 
             if not rows:  
@@ -128,47 +884,26 @@ class PivotBroker:
 
         elif not (rows+cols):
             # special case: [aggs] populated but [rows, cols] empty
-            result = (filtered_df.copy()[aggs]
-                    #   .sum(numeric_only=True)
-                      .agg(agg_dict)
-                      .to_frame().T # convert series back to dataframe
-                    )
+            states = self._get_states(filters, keys=[], aggs=aggs)
+            with self._stage('finalize'):
+                result = finalize_states(states, aggs=aggs, field_data=self.field_data)
             
             # set column name to 'Value'
             result = result.rename(index={0: 'Value'})
         else:
             # general case: [rows, cols, aggs] populated
-            result = (filtered_df.copy()[rows+cols+aggs]
-                        .groupby(rows+cols)
-                        # .sum(numeric_only=True)
-                        .agg(agg_dict)
-                    )
+            # all aggregate fields are computed in a single groupby pass, see PivotAggregate
+            states = self._get_states(filters, keys=rows+cols, aggs=aggs)
+            if totals:
+                with self._stage('totals') as stage:
+                    states = rollup_grouping_sets(states, rows, cols)
+                    if stage:
+                        stage.rows = len(states)
+            with self._stage('finalize'):
+                result = finalize_states(states, aggs=aggs, field_data=self.field_data)
         
             # if rows is empty list, insert a 'Value' level 
             if not rows:  
                 result = pd.concat([result], axis=0, keys=['Value'])
-        
-        # unstack columns
-        result = result.unstack(cols).fillna(0)
-
-        # reorder cols if not empty list
-        if cols: 
-            # name the '(Data)' level
-            new_names = list(result.columns.names)
-            new_names[0] = "Field"
-            result.columns.set_names(new_names, inplace=True)
-            # order the columns
-            result = result.reorder_levels(order=col_level_order, axis=1)
-
-        # create a rename dict for custom field ordering
-        agg_order = {str: f'"@$%"+{idx}' for idx, str in enumerate(aggs)} 
-        result.rename(columns=agg_order, inplace=True)
-        result = result.sort_index(axis=1)
-        result.rename(columns={v: k for k, v in agg_order.items()}, inplace=True)
 
-        if(transpose):
-            result = result.T
-        
-        
         return result
-    
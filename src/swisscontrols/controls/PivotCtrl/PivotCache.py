@@ -0,0 +1,238 @@
+import threading
+from collections import OrderedDict
+from typing import List, Callable, Hashable, Optional
+
+import pandas as pd
+import numpy as np
+
+from swisscontrols.controls.PivotCtrl.PivotAggregate import widen_frame
+from swisscontrols.controls.UserScripts.user_scripts import MaskFilter, get_filter_key
+
+def get_filters_key(filters: List[Callable]) -> Optional[Hashable]:
+    """
+    Build a hashable signature for a list of filters.
+
+    Filters are AND-ed together, so their order does not matter and they are keyed as a set.
+
+    Returns:
+        A frozenset of filter keys, or None if any filter is an opaque callable without a `key`.
+    """
+    filter_keys = [get_filter_key(f) for f in (filters or [])]
+    if None in filter_keys:
+        return None
+    return frozenset(filter_keys)
+
+def get_pivot_key(filters: List[Callable], rows: List[str], cols: List[str], aggs: List[str]) -> Optional[Hashable]:
+    """
+    Build a canonical, hashable signature for a pivot configuration.
+
+    The order of rows, cols and aggs matters, because it determines the layout of the result.
+
+    Returns:
+        A hashable key, or None if any filter is an opaque callable without a `key`.
+    """
+    filters_key = get_filters_key(filters)
+    if filters_key is None:
+        return None
+    return (filters_key, tuple(rows), tuple(cols), tuple(aggs))
+
+def get_nbytes(value) -> int:
+    """
+    Estimate the memory held by a cached value. Object labels are not measured deeply.
+    """
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(index=True, deep=False).sum())
+    if isinstance(value, pd.Series):
+        return int(value.memory_usage(index=True, deep=False))
+    return int(getattr(value, 'nbytes', 0))
+
+class PivotCache:
+    """
+    A least-recently-used cache of pivot results.
+
+    The cache is bounded both by the number of entries and by the approximate memory of the
+    cached values. When either budget is exceeded, the least recently used entries are evicted.
+    Values larger than the whole memory budget are not cached at all.
+
+    Cached values are shared with the caller and should be treated as read-only.
+
+    Example:
+        cache = PivotCache(max_entries=32, max_bytes=256 * 2**20)
+        result = cache.get(key)
+        if result is None:
+            result = compute()
+            cache.put(key, result)
+        print(cache.hits, cache.misses)
+    """
+
+    def __init__(self, max_entries: int = 32, max_bytes: int = 256 * 2**20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = OrderedDict() # key -> (value, nbytes)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def items(self):
+        """
+        Return a snapshot of the (key, value) pairs, without touching their recency.
+        """
+        return [(key, value) for key, (value, _) in self._entries.items()]
+
+    def get(self, key):
+        if key is None or key not in self._entries:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key][0]
+
+    def put(self, key, value):
+        if key is None:
+            return
+        nbytes = get_nbytes(value)
+        if self.max_entries <= 0 or nbytes > self.max_bytes:
+            return
+
+        self.pop(key)
+        self._entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+
+        # evict least recently used entries until we are back within budget
+        while len(self._entries) > self.max_entries or self.nbytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+
+    def pop(self, key):
+        if key in self._entries:
+            value, nbytes = self._entries.pop(key)
+            self.nbytes -= nbytes
+            return value
+        return None
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+class FilterMaskCache:
+    """
+    Keeps the last boolean mask computed for each filter.
+
+    Masks are keyed by the filter's `key` when it has one, otherwise by the identity of the
+    filter object. Editing a filter in the UI creates a new filter (a new key or object),
+    so only the edited filter is re-evaluated and the combined mask is re-AND-ed from the
+    cached masks of the others. Removing a filter costs one AND less.
+
+    Opaque callables are assumed to be pure: the same object always selects the same rows.
+
+    Appended rows are evaluated on their own and their masks queued after the cached mask,
+    they are concatenated on the next lookup of that filter, like `PivotBroker` queues the rows.
+
+    Masks can be computed on several threads. Callers may pass the `version` of the data they
+    evaluate: masks are then only kept if that is still the version of the cache, see `clear`
+    and `extend`, so a mask of data that changed meanwhile is never stored.
+
+    Example:
+        mask_cache = FilterMaskCache(max_masks=16)
+        mask = mask_cache.get_combined_mask(filters, df)
+        filtered_df = df[mask]
+    """
+
+    def __init__(self, max_masks: int = 16):
+        self.max_masks = max_masks
+        self.hits = 0
+        self.misses = 0
+        # key -> (filter, [mask, masks of appended batches...]), holding the filter keeps its id() from being recycled
+        self._masks = OrderedDict()
+        # the version of the data the masks are valid for
+        self.version = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._masks)
+
+    def _get_key(self, f: Callable):
+        key = get_filter_key(f)
+        return ('key', key) if key is not None else ('id', id(f))
+
+    def get_mask(self, f: Callable, df: pd.DataFrame, version=None) -> np.ndarray:
+        """
+        Return the (read-only) mask of a single filter, computing it on a cache miss.
+
+        :param version: The version of the data in `df`, None if it is the current one
+        """
+        key = self._get_key(f)
+        with self._lock:
+            entry = self._masks.get(key) if version is None or version == self.version else None
+            if entry is not None and sum(len(part) for part in entry[1]) == len(df):
+                parts = entry[1]
+                if len(parts) > 1:
+                    # concatenate the masks of appended batches only when the mask is used
+                    mask = np.concatenate(parts)
+                    mask.flags.writeable = False
+                    parts = [mask]
+                    self._masks[key] = (f, parts)
+                self._masks.move_to_end(key)
+                self.hits += 1
+                return parts[0]
+            self.misses += 1
+
+        # evaluated without the lock, other threads keep using the cache meanwhile
+        mask = self._evaluate(f, df)
+        mask.flags.writeable = False
+
+        with self._lock:
+            if version is None or version == self.version:
+                self._masks[key] = (f, [mask])
+                self._masks.move_to_end(key)
+                while len(self._masks) > self.max_masks:
+                    self._masks.popitem(last=False)
+
+        return mask
+
+    def _evaluate(self, f: Callable, df: pd.DataFrame) -> np.ndarray:
+        if isinstance(f, MaskFilter):
+            return f.mask(df)
+        # opaque filters see 64-bit values, see PivotCompact
+        return np.asarray(widen_frame(df).apply(f, axis=1), dtype=bool) if len(df) else np.ones(0, dtype=bool)
+
+    def get_combined_mask(self, filters: List[Callable], df: pd.DataFrame, version=None) -> np.ndarray:
+        """
+        AND the cached masks of all filters together.
+        """
+        combined = np.ones(len(df), dtype=bool)
+        for f in filters:
+            combined &= self.get_mask(f, df, version)
+        return combined
+
+    def extend(self, batch: pd.DataFrame, version=None):
+        """
+        Follow rows appended to the data: evaluate each cached filter on `batch` only
+        and queue the result after its mask, in O(len(batch)).
+
+        :param version: The version of the data with the batch appended, None keeps the current one
+        """
+        with self._lock:
+            for f, parts in self._masks.values():
+                mask = self._evaluate(f, batch)
+                mask.flags.writeable = False
+                parts.append(mask)
+            if version is not None:
+                self.version = version
+
+    def clear(self, version=None):
+        """
+        Drop every mask.
+
+        :param version: The version of the new data, None keeps the current one
+        """
+        with self._lock:
+            self._masks.clear()
+            if version is not None:
+                self.version = version
@@ -0,0 +1,185 @@
+import dataclasses
+import sys
+from typing import List, Dict, Tuple
+
+import pandas as pd
+import numpy as np
+
+from swisscontrols.controls.PivotCtrl.PivotField import PivotField, PivotFieldType
+
+"""
+Compact column storage for the flat data, see `PivotBroker(compact=True)`.
+
+- GroupBy fields are dictionary-encoded as categoricals (PivotBroker always does this),
+  pandas stores their codes in the smallest integer type that fits the categories.
+- Integer columns are stored in the smallest integer type that holds their range. This is exact.
+- Float aggregate fields are stored as float32 when every value survives the round trip within
+  float32 precision (a relative error of at most 2**-24, about 6e-8), i.e. no value is out of
+  the float32 range or too small to be represented. DISTINCT_COUNT fields are only downcast
+  when the round trip is exact, because rounding could merge distinct values.
+- Object columns of strings, and `str` columns stored as Python objects, are interned: equal strings 
+  share one object. `str` columns backed by Arrow (the pandas 3 default when pyarrow is installed) 
+  already keep their text in one buffer and are kept.
+
+Every consumer widens compact columns back to 64 bits before computing on them: aggregation before 
+computing states (see PivotAggregate), so sums can't overflow and are accumulated at full precision, 
+arithmetic in filter expressions (see `user_scripts.get_values`), and opaque row filters, which see 
+the widened row. Comparisons are exact at any width. Pivot results then differ from
+those of the full-width data by at most about 6e-8 * sum(|x|) for sums and about 1.2e-7 relative
+for weighted averages and quantiles. Filters compare float32 values at float32 precision, so rows
+within that tolerance of a filter bound may fall on the other side of it.
+"""
+
+# the largest relative error of a value stored as float32
+FLOAT32_RTOL = 2.0**-24
+
+@dataclasses.dataclass
+class ColumnMemory:
+    name: str
+    dtype_before: str
+    dtype_after: str
+    bytes_before: int
+    bytes_after: int
+
+@dataclasses.dataclass
+class CompactReport:
+    """
+    The memory of each column before and after compaction.
+    """
+    columns: List[ColumnMemory]
+
+    @property
+    def bytes_before(self) -> int:
+        return sum(column.bytes_before for column in self.columns)
+
+    @property
+    def bytes_after(self) -> int:
+        return sum(column.bytes_after for column in self.columns)
+
+    @property
+    def ratio(self) -> float:
+        # how many times more rows fit in the same memory
+        return self.bytes_before / max(self.bytes_after, 1)
+
+    @classmethod
+    def compare(cls, before: pd.DataFrame, after: pd.DataFrame) -> 'CompactReport':
+        return cls([ColumnMemory(name, str(before[name].dtype), str(after[name].dtype),
+                                 get_column_nbytes(before[name]), get_column_nbytes(after[name]))
+                    for name in after.columns])
+
+    def __str__(self):
+        width = max([len(str(column.name)) for column in self.columns] + [5])
+        lines = [f"{'field':<{width}}  {'before':>12}  {'after':>12}  {'MB before':>10}  {'MB after':>10}"]
+        for column in self.columns:
+            lines.append(f"{str(column.name):<{width}}  {column.dtype_before:>12}  {column.dtype_after:>12}  "
+                         f"{column.bytes_before / 2**20:10.2f}  {column.bytes_after / 2**20:10.2f}")
+        lines.append(f"{'total':<{width}}  {'':>12}  {'':>12}  "
+                     f"{self.bytes_before / 2**20:10.2f}  {self.bytes_after / 2**20:10.2f}  ({self.ratio:.2f}x)")
+        return "\n".join(lines)
+
+def get_column_nbytes(series: pd.Series) -> int:
+    """
+    Return the memory held by a column. Objects shared by several rows, e.g. interned strings, count once.
+    """
+    if is_object_strings(series.dtype):
+        values = np.asarray(series.array._ndarray if isinstance(series.dtype, pd.StringDtype) else series.to_numpy(), dtype=object)
+        unique = {id(value): value for value in values}
+        return int(values.nbytes + sum(sys.getsizeof(value) for value in unique.values()))
+    return int(series.memory_usage(index=False, deep=True))
+
+def get_min_int_dtype(values: np.ndarray) -> np.dtype:
+    """
+    Return the smallest integer dtype that holds every value of an integer array.
+    """
+    if not len(values):
+        return np.dtype(np.int8)
+    low, high = values.min(), values.max()
+    candidates = [np.uint8, np.uint16, np.uint32, np.uint64] if low >= 0 else [np.int8, np.int16, np.int32, np.int64]
+    for dtype in candidates:
+        info = np.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return np.dtype(dtype)
+    return values.dtype
+
+def fits_float32(values: np.ndarray, exact: bool = False) -> bool:
+    """
+    Check that every value of a float array survives the round trip through float32,
+    within FLOAT32_RTOL or exactly.
+    """
+    with np.errstate(over='ignore', invalid='ignore'):
+        narrow = values.astype(np.float32).astype(np.float64)
+    same = (narrow == values) | (np.isnan(values) & np.isnan(narrow))
+    if exact:
+        return bool(same.all())
+    close = np.abs(narrow - values) <= FLOAT32_RTOL * np.abs(values)
+    return bool((same | close).all())
+
+def is_object_strings(dtype) -> bool:
+    """
+    Check if a column stores its values as Python objects: object columns, and `str` columns with Python storage.
+    """
+    return dtype == object or (isinstance(dtype, pd.StringDtype) and dtype.storage == 'python')
+
+def intern_strings(series: pd.Series) -> pd.Series:
+    """
+    Return a column of the same dtype where equal values share one object.
+    """
+    codes, uniques = pd.factorize(series)
+    # missing values have code -1, which picks the trailing NaN
+    values = np.append(np.asarray(uniques, dtype=object), [np.nan])[codes]
+    return pd.Series(values, index=series.index, name=series.name, dtype=series.dtype)
+
+def compact_column(series: pd.Series, field: PivotField = None) -> pd.Series:
+    """
+    Return a column in its compact dtype, see the module notes.
+    """
+    dtype = series.dtype
+    if isinstance(dtype, pd.StringDtype) and is_object_strings(dtype):
+        return intern_strings(series)
+    if not isinstance(dtype, np.dtype):
+        # categoricals, nullable and Arrow dtypes are kept
+        return series
+
+    if dtype.kind in 'iu':
+        return series.astype(get_min_int_dtype(series.to_numpy()))
+
+    is_aggregate = field is not None and isinstance(field.field_type, PivotFieldType.Aggregate)
+    if dtype.kind == 'f' and dtype.itemsize > 4 and is_aggregate:
+        exact = field.field_type == PivotFieldType.Aggregate.DISTINCT_COUNT
+        if fits_float32(series.to_numpy(), exact=exact):
+            return series.astype(np.float32)
+        return series
+
+    if dtype == object and pd.api.types.infer_dtype(series, skipna=True) == 'string':
+        return intern_strings(series)
+
+    return series
+
+def compact_frame(df: pd.DataFrame, field_data: Dict[str, PivotField]) -> pd.DataFrame:
+    """
+    Return `df` with every column in its compact dtype, see the module notes.
+    """
+    return pd.DataFrame({name: compact_column(df[name], field_data.get(name)) for name in df.columns},
+                        index=df.index, copy=False)
+
+def compact_batch(batch: pd.DataFrame, dtypes: Dict[str, object],
+                  field_data: Dict[str, PivotField]) -> Tuple[pd.DataFrame, Dict[str, np.dtype]]:
+    """
+    Compact a batch of rows that will be appended to a compact frame with `dtypes`.
+
+    Returns:
+        batch: The compacted batch, with the dtypes of the frame where they can hold its values.
+        widened: {column: dtype} of the columns of the frame that must be widened to hold the batch.
+    """
+    batch = compact_frame(batch, field_data)
+    widened = {}
+    for name in batch.columns:
+        dtype, batch_dtype = dtypes[name], batch[name].dtype
+        if not (isinstance(dtype, np.dtype) and isinstance(batch_dtype, np.dtype)) or dtype.kind not in 'iuf' or batch_dtype.kind not in 'iuf':
+            continue
+        common = np.promote_types(dtype, batch_dtype)
+        if common != batch_dtype:
+            batch[name] = batch[name].astype(common)
+        if common != dtype:
+            widened[name] = common
+    return batch, widened
@@ -0,0 +1,92 @@
+import dataclasses
+from typing import List, Dict, Callable, Hashable
+
+import pandas as pd
+
+from swisscontrols.controls.PivotCtrl.PivotField import PivotField
+from swisscontrols.controls.PivotCtrl.PivotAggregate import aggregate_states, rollup_states, merge_states, recast_states_index, get_states_nbytes
+from swisscontrols.controls.UserScripts.user_scripts import create_combined_mask
+
+@dataclasses.dataclass
+class PivotDelta:
+    """
+    The cells of a cached aggregate that changed when rows were appended.
+    """
+    dims: List[str]             # the fields the aggregate is grouped by
+    aggs: List[str]             # the aggregate fields
+    filters_key: Hashable       # the filters the aggregate was computed with
+    changed: pd.Index           # group keys whose values changed, including new ones
+    added: pd.Index             # group keys that didn't exist before (new pivot rows or columns)
+
+class PivotCube:
+    """
+    Aggregate states materialized at the finest grouping of a set of dimensions.
+
+    Any pivot that groups by a subset of `dims`, uses a subset of `aggs` and has the same
+    filters can be answered by rolling up the cube, instead of rescanning the flat data.
+    Rolling up works for every aggregate type because the states are mergeable (sums or summaries),
+    see PivotAggregate. For the same reason, appended rows can be merged into the cube
+    without rescanning the existing rows.
+
+    Example:
+        states = aggregate_states(filtered_df, keys=['Fruit', 'Shape', 'Year', 'Quarter'], aggs=aggs, field_data=field_data)
+        cube = PivotCube(states, dims=['Fruit', 'Shape', 'Year', 'Quarter'], aggs=aggs, filters=filters, filters_key=filters_key, data_version=1)
+        if cube.can_answer(keys=['Fruit', 'Year'], aggs=['Weight'], filters_key=filters_key, data_version=1):
+            states = cube.rollup(keys=['Fruit', 'Year'], aggs=['Weight'])
+    """
+
+    def __init__(self, states: pd.DataFrame, dims: List[str], aggs: List[str], filters: List[Callable], filters_key: Hashable, data_version: int):
+        self.states = states
+        self.dims = list(dims)
+        self.aggs = list(aggs)
+        self.filters = list(filters or [])
+        self.filters_key = filters_key
+        self.data_version = data_version
+
+    def __len__(self):
+        return len(self.states)
+
+    @property
+    def nbytes(self) -> int:
+        return get_states_nbytes(self.states)
+
+    def can_answer(self, keys: List[str], aggs: List[str], filters_key: Hashable, data_version: int) -> bool:
+        return (filters_key is not None
+                and filters_key == self.filters_key
+                and data_version == self.data_version
+                and set(keys) <= set(self.dims)
+                and set(aggs) <= set(self.aggs))
+
+    def rollup(self, keys: List[str], aggs: List[str]) -> pd.DataFrame:
+        """
+        Return the summed states of `aggs` grouped by `keys`, like `aggregate_states`.
+        """
+        return rollup_states(self.states, keys=keys, aggs=aggs)
+
+    def append(self, batch: pd.DataFrame, field_data: Dict[str, PivotField]) -> PivotDelta:
+        """
+        Filter and aggregate a batch of new rows and merge it into the cube.
+        The cost depends on the batch size and the number of groups, not on the rows already aggregated.
+        """
+        if self.filters and len(batch):
+            batch = batch[create_combined_mask(self.filters, batch)]
+        batch_states = aggregate_states(batch, keys=self.dims, aggs=self.aggs, field_data=field_data)
+
+        if not self.dims:
+            # a single group, present whenever any row passed the filters
+            changed = batch_states.index if len(batch) else batch_states.index[:0]
+            added = changed[:0]
+        else:
+            changed = batch_states.index
+            added = changed[~changed.isin(self.states.index)]
+        
+        if len(changed):
+            self.states = merge_states([self.states, batch_states], keys=self.dims)
+
+        return PivotDelta(dims=self.dims, aggs=self.aggs, filters_key=self.filters_key, changed=changed, added=added)
+
+    def recast(self, dtypes: Dict[str, pd.CategoricalDtype]):
+        """
+        Follow a change of the categories of GroupBy fields, see `recast_states_index`.
+        """
+        self.states = recast_states_index(self.states, dtypes)
@@ -26,11 +26,24 @@ class PivotFieldType:
         SUM = 3
         WEIGHTED_AVERAGE = 4
         COUNT = 5
+        DISTINCT_COUNT = 6
+        MEDIAN = 7
+        PERCENTILE = 8
 
 class PivotField:
-    def __init__(self, name, field_type, weight_field=None, agg_func='sum', format=None):
+    def __init__(self, name, field_type, weight_field=None, agg_func='sum', format=None, percentile=None, approximate=False):
+        """
+        :param percentile: The percentile (0-100) of a PERCENTILE field
+        :param approximate: Compute DISTINCT_COUNT, MEDIAN and PERCENTILE fields with bounded-size sketches, 
+                            see PivotSketch for the error bounds
+        """
         self.name = name
         self.field_type = field_type
         self.weight_field = weight_field
         self.agg_func = agg_func
         self.format = format
+        self.percentile = percentile
+        self.approximate = approximate
+
+        if field_type == PivotFieldType.Aggregate.PERCENTILE and not (percentile is not None and 0 <= percentile <= 100):
+            raise ValueError(f"PERCENTILE field '{name}' needs a percentile between 0 and 100.")
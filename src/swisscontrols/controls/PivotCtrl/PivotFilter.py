@@ -18,10 +18,12 @@ class PivotFilterButton:
     filter: Callable
     field_type: PivotFieldType
 
-def pivotFilterDialog(title: str, field: str, data: List[Tuple[bool, str]], sender: str, send_data: Callable[[List[Tuple[bool, str]]], None]):
+def pivotFilterDialog(title: str, field: str, data: List[Tuple[bool, str]], sender: str, send_data: Callable[[List[Tuple[bool, str]]], None],
+                      counts: List[int] = None):
     """
     :param data: A list of [checkbox state, item label] pairs
     :param callback: Callback to send back the user selection
+    :param counts: An optional row count per item, shown next to its label
 
     TODO: 
     - change Tuple[bool, str] to a dataclass
@@ -142,10 +144,10 @@ def pivotFilterDialog(title: str, field: str, data: List[Tuple[bool, str]], send
                         
                     # child checkboxes
                     dpg.add_separator()
-                    for [checkbox_state, item_label] in data:
+                    for i, [checkbox_state, item_label] in enumerate(data):
                         with dpg.group(horizontal=True):
                             b = dpg.add_checkbox(default_value=checkbox_state, callback=on_ccb_click)
-                            t = dpg.add_text(item_label)
+                            t = dpg.add_text(item_label if counts is None else f"{item_label} ({counts[i]})")
                             child_checkboxes.append((b, t))
 
                 # range filtering
@@ -0,0 +1,334 @@
+import math
+from typing import List, Dict
+
+import dearpygui.dearpygui as dpg
+import numpy as np
+
+from swisscontrols.controls.DpgHelpers.MvStyleVar import MvStyleVar
+from swisscontrols.controls.GridSelector.GridSelector import GridSelector
+from swisscontrols.controls.PivotCtrl.PivotResult import PivotResult, get_span_starts
+
+"""
+A virtualized pivot table.
+
+Only a pool of cells that covers the visible part of the pivot plus a margin is created,
+so the number of DearPyGui items depends on the size of the view, not of the result.
+
+The pool is one table inside a scrolling child window, between spacers that give the
+window the scroll range of the whole pivot. As the user scrolls, the spacers move the
+pool along so that it stays in view, and the cells are relabelled with the rows and columns
+under it, read from `PivotResult.values`. The header rows and the row label columns are
+part of the pool, so they stay in view too.
+
+Every cell lives in that one table: the column levels are stacked header rows and the row
+levels are the first columns, so data cell (i, j) of the pool is table cell
+(n_col_levels + i, n_row_levels + j). Header labels are shown once per span, see
+`PivotResult.row_spans` and `col_spans`, and again where a span continues into the view.
+"""
+
+# the height of a table row before the pool is measured on screen
+ROW_HEIGHT = MvStyleVar.TextHeight.value + 2 * MvStyleVar.CellPadding.value[1]
+
+def get_first_visible(scroll: float, pitch: float, n_items: int, n_pool: int) -> int:
+    """
+    Return the first item shown by a pool of `n_pool` items scrolled to `scroll` pixels.
+    """
+    return max(0, min(int(scroll // pitch), n_items - n_pool))
+
+def format_value(value: float) -> str:
+    return "" if np.isnan(value) else "{:.2f}".format(value)
+
+class PivotGridView:
+    """
+    Shows a PivotResult in a scrolling child window, see the module notes.
+
+    Call `update` once per frame: DearPyGui has no scroll callback, so the view polls
+    the scroll position and the size of the window.
+
+    Example:
+        grid = PivotGridView(parent=window)
+        grid.set_result(broker.get_pivot_result(filters=None, rows=['Fruit'], cols=['(Data)', 'Year'], aggs=['Weight']))
+        while dpg.is_dearpygui_running():
+            grid.update()
+            dpg.render_dearpygui_frame()
+    """
+
+    def __init__(self, parent, tag=None, col_width: int = 70, label_width: int = 90, margin: int = 4):
+        """
+        :param parent: The container of the view
+        :param tag: The tag of the child window, generated if None
+        :param col_width: The width of the data columns, in pixels
+        :param label_width: The width of the row label columns, in pixels
+        :param margin: The number of rows and columns kept beyond the visible ones,
+                       so that small resizes don't rebuild the pool
+        """
+        self.tag = tag if tag is not None else dpg.generate_uuid()
+        self.col_width = col_width
+        self.label_width = label_width
+        self.margin = margin
+        self.result = None
+        self.grid_selector = None
+        self._row_starts: List[np.ndarray] = []     # [row level] True where a row label starts a span
+        self._col_starts: List[np.ndarray] = []     # [column level] True where a column label starts a span
+
+        # the distance between rows and columns on screen, measured once the pool is drawn
+        self.row_pitch = ROW_HEIGHT
+        self.col_pitch = col_width + 2 * MvStyleVar.CellPadding.value[0]
+        self.label_pitch = label_width + 2 * MvStyleVar.CellPadding.value[0]
+        self._measured = False
+
+        # the pool: one table of header rows and data rows, and its cells
+        self._table = None
+        self._pool_rows = 0
+        self._pool_cols = 0
+        self._header_rows: List[int] = []           # [level] table rows of the column headers
+        self._rows: List[int] = []                  # [pool row] table rows of the data
+        self._columns: List[int] = []               # [pool column] table columns of the data
+        self._header_cells: List[List[int]] = []    # [level][label columns + data columns]
+        self._label_cells: List[List[int]] = []     # [pool row][row level]
+        self._cells: List[List[int]] = []           # [pool row][pool column]
+        self._labels: Dict[int, str] = {}           # the label on screen of every cell
+        self._origin = None                         # (first row, first column) shown by the pool
+
+        with dpg.child_window(tag=self.tag, parent=parent, horizontal_scrollbar=True, border=False):
+            self._top = dpg.add_spacer(width=0, height=0)
+            with dpg.group(horizontal=True) as self._row_group:
+                self._left = dpg.add_spacer(width=0, height=0)
+                self._right = dpg.add_spacer(width=0, height=0)
+            self._bottom = dpg.add_spacer(width=0, height=0)
+
+    @property
+    def n_rows(self) -> int:
+        return self.result.shape[0] if self.result is not None else 0
+
+    @property
+    def n_cols(self) -> int:
+        return self.result.shape[1] if self.result is not None else 0
+
+    @property
+    def n_row_levels(self) -> int:
+        return len(self.result.row_labels) if self.result is not None else 0
+
+    @property
+    def n_col_levels(self) -> int:
+        return len(self.result.col_labels) if self.result is not None else 0
+
+    def set_result(self, result: PivotResult):
+        """
+        Show a new result on the next `update`.
+
+        The widgets on screen are reused: cells are only relabelled where their text changes,
+        and rows and columns of the pool are only added or removed where the new result has
+        fewer or more of them in view. The pool is rebuilt when the number of levels changes.
+        """
+        if (len(result.row_labels), len(result.col_labels)) != (self.n_row_levels, self.n_col_levels):
+            self._delete_pool()
+        self.result = result
+        self._row_starts = get_span_starts(result.row_spans, result.shape[0])
+        self._col_starts = get_span_starts(result.col_spans, result.shape[1])
+        self._origin = None
+        if self.grid_selector is not None:
+            self.grid_selector.clear()
+
+    def update(self):
+        """
+        Follow the scroll position and the size of the window. Call once per frame.
+        """
+        if self.result is None:
+            return
+        width, height = dpg.get_item_rect_size(self.tag)
+        if width <= 0 or height <= 0:
+            # not laid out yet
+            return
+
+        if self._table is not None and not self._measured:
+            self._measure()
+
+        # the pool covers the window, less the header rows and label columns that are always shown.
+        # It grows with the window but doesn't shrink with it, only with the result.
+        label_width = self.n_row_levels * self.label_pitch
+        pool_rows = max(0, math.ceil(height / self.row_pitch) - self.n_col_levels) + self.margin
+        pool_cols = max(0, math.ceil((width - label_width) / self.col_pitch)) + self.margin
+        pool_rows = min(self.n_rows, max(pool_rows, self._pool_rows))
+        pool_cols = min(self.n_cols, max(pool_cols, self._pool_cols))
+        if self._table is None:
+            self._build_pool()
+        if (pool_rows, pool_cols) != (self._pool_rows, self._pool_cols):
+            self._resize_pool(pool_rows, pool_cols)
+
+        scroll_x, scroll_y = dpg.get_x_scroll(self.tag), dpg.get_y_scroll(self.tag)
+        first_row = get_first_visible(scroll_y, self.row_pitch, self.n_rows, self._pool_rows)
+        first_col = get_first_visible(scroll_x, self.col_pitch, self.n_cols, self._pool_cols)
+        if self._origin != (first_row, first_col):
+            self._origin = (first_row, first_col)
+            self._fill()
+        self._place(scroll_x, scroll_y)
+
+    def _measure(self):
+        """
+        Measure the row and column pitch of the pool on screen, once it has been drawn.
+        """
+        width, height = dpg.get_item_rect_size(self._table)
+        if width <= 0 or height <= 0:
+            return
+        n_lines = self.n_col_levels + self._pool_rows
+        n_columns = self.n_row_levels + self._pool_cols
+        self.row_pitch = height / n_lines
+        # the padding and borders of a column, spread evenly
+        padding = (width - self.n_row_levels * self.label_width - self._pool_cols * self.col_width) / max(n_columns, 1)
+        self.col_pitch = self.col_width + padding
+        self.label_pitch = self.label_width + padding
+        self._measured = True
+
+    def _place(self, scroll_x: float, scroll_y: float):
+        """
+        Move the pool to the scroll position and size the spacers around it to the whole pivot.
+        """
+        pool_height = (self.n_col_levels + self._pool_rows) * self.row_pitch
+        pool_width = self.n_row_levels * self.label_pitch + self._pool_cols * self.col_pitch
+        total_height = (self.n_col_levels + self.n_rows) * self.row_pitch
+        total_width = self.n_row_levels * self.label_pitch + self.n_cols * self.col_pitch
+
+        # past the last pool position the pool scrolls with the content, to show its margin
+        top = min(scroll_y, (self.n_rows - self._pool_rows) * self.row_pitch)
+        left = min(scroll_x, (self.n_cols - self._pool_cols) * self.col_pitch)
+        top, left = int(max(top, 0)), int(max(left, 0))
+
+        dpg.configure_item(self._top, height=top, width=int(total_width))
+        dpg.configure_item(self._left, width=left)
+        dpg.configure_item(self._right, width=int(max(total_width - left - pool_width, 0)))
+        dpg.configure_item(self._bottom, height=int(max(total_height - top - pool_height, 0)))
+
+    def _build_pool(self):
+        """
+        Create the table of the pool, with its header rows and row label columns but no data yet.
+        """
+        self._delete_pool()
+
+        with dpg.table(parent=self._row_group, before=self._right, header_row=False,
+                       policy=dpg.mvTable_SizingFixedFit, no_host_extendX=True,
+                       borders_outerH=True, borders_outerV=True, borders_innerV=True) as self._table:
+            for _ in range(self.n_row_levels):
+                dpg.add_table_column(width_fixed=True, init_width_or_weight=self.label_width)
+            for _ in range(self.n_col_levels):
+                with dpg.table_row() as row:
+                    self._header_rows.append(row)
+                    self._header_cells.append([self._add_cell(row) for _ in range(self.n_row_levels)])
+
+        # range selection over the data cells of the pool, addressed by their position in the table
+        self.grid_selector = GridSelector(self._table, width=0, height=0, table_offset=(self.n_col_levels, self.n_row_levels))
+
+    def _resize_pool(self, pool_rows: int, pool_cols: int):
+        """
+        Add or remove data rows and columns at the end of the pool.
+        """
+        # columns first, so that new rows are created at the new width
+        while self._pool_cols > pool_cols:
+            dpg.delete_item(self._columns.pop())
+            for cells in self._header_cells + self._cells:
+                self._delete_cell(cells.pop())
+            self._pool_cols -= 1
+        while self._pool_cols < pool_cols:
+            self._columns.append(dpg.add_table_column(parent=self._table, width_fixed=True, init_width_or_weight=self.col_width))
+            for row, cells in zip(self._header_rows + self._rows, self._header_cells + self._cells):
+                cells.append(self._add_cell(row))
+            self._pool_cols += 1
+
+        while self._pool_rows > pool_rows:
+            dpg.delete_item(self._rows.pop())
+            for cell in self._label_cells.pop() + self._cells.pop():
+                self._labels.pop(cell, None)
+            self._pool_rows -= 1
+        while self._pool_rows < pool_rows:
+            with dpg.table_row(parent=self._table) as row:
+                self._rows.append(row)
+                self._label_cells.append([self._add_cell(row) for _ in range(self.n_row_levels)])
+                self._cells.append([self._add_cell(row) for _ in range(pool_cols)])
+            self._pool_rows += 1
+
+        self.grid_selector.resize(width=pool_cols, height=pool_rows)
+        for i, cells in enumerate(self._cells):
+            self.grid_selector.widget_grid[i][:] = cells
+        self._origin = None
+
+    def _add_cell(self, row) -> int:
+        cell = dpg.add_selectable(label="", parent=row)
+        self._labels[cell] = ""
+        return cell
+
+    def _delete_cell(self, cell):
+        dpg.delete_item(cell)
+        self._labels.pop(cell, None)
+
+    def _set_label(self, cell, label: str):
+        # only the cells whose text changes are sent to DearPyGui
+        if self._labels[cell] != label:
+            dpg.set_item_label(cell, label)
+            self._labels[cell] = label
+
+    def _delete_pool(self):
+        if self.grid_selector is not None:
+            self.grid_selector.deregister()
+            self.grid_selector = None
+        if self._table is not None:
+            dpg.delete_item(self._table)
+            self._table = None
+        self._pool_rows = self._pool_cols = 0
+        self._header_rows, self._rows, self._columns = [], [], []
+        self._header_cells, self._label_cells, self._cells = [], [], []
+        self._labels = {}
+        self._origin = None
+        self._measured = False
+
+    def _fill(self):
+        """
+        Label the cells of the pool with the rows and columns at its origin.
+        """
+        result = self.result
+        first_row, first_col = self._origin
+        rows = range(first_row, first_row + self._pool_rows)
+        cols = range(first_col, first_col + self._pool_cols)
+
+        # header rows: the column labels of each level where a span starts, and on the first column in view,
+        # with the level names over the row labels
+        for level, header in enumerate(self._header_cells):
+            last = level == self.n_col_levels - 1
+            for k in range(self.n_row_levels):
+                if last:
+                    name = result.row_names[k]
+                else:
+                    name = result.col_names[level] if k == self.n_row_levels - 1 else None
+                self._set_label(header[k], "" if name is None else str(name))
+            for j, col in enumerate(cols):
+                shown = j == 0 or self._col_starts[level][col]
+                self._set_label(header[self.n_row_levels + j], str(result.col_labels[level][col]) if shown else "")
+
+        # row labels: only where a span starts, and on the first row in view
+        for i, row in enumerate(rows):
+            for k, cell in enumerate(self._label_cells[i]):
+                shown = i == 0 or self._row_starts[k][row]
+                self._set_label(cell, str(result.row_labels[k][row]) if shown else "")
+            for j, col in enumerate(cols):
+                self._set_label(self._cells[i][j], format_value(result.values[row, col]))
+
+        # the selection is kept in result coordinates, move its highlight along
+        self.grid_selector.set_origin(first_row, first_col)
+
+    def get_cell(self, row: int, col: int):
+        """
+        Return the widget that shows cell (row, col) of the result, or None when it is out of view.
+        """
+        if self._origin is None:
+            return None
+        i, j = row - self._origin[0], col - self._origin[1]
+        if 0 <= i < self._pool_rows and 0 <= j < self._pool_cols:
+            return self._cells[i][j]
+        return None
+
+    def delete(self):
+        """
+        Delete the view and its widgets.
+        """
+        self._delete_pool()
+        if dpg.does_item_exist(self.tag):
+            dpg.delete_item(self.tag)
@@ -0,0 +1,189 @@
+from typing import List, Tuple, Optional
+
+import pandas as pd
+import numpy as np
+
+from swisscontrols.controls.PivotCtrl.PivotStats import PivotStats, time_stage
+
+"""
+A pivot is computed in "long" form first: one row per non-empty group, indexed by the row
+fields followed by the column fields, with one column per aggregate field.
+
+`unstack_pivot` turns the long form into the dense table shown by the UI. The dense table has
+a cell for every (row keys, column keys) pair, so with sparse column fields it can be far larger
+than the long form. `PivotLayout` computes the row and column axes of the dense table without
+building it, and densifies only a window of it.
+"""
+
+def split_layout(rows: List[str], cols: List[str]) -> Tuple[List[str], List[str], List[int], bool]:
+    """
+    Normalize a pivot layout so that the '(Data)' level is in the columns.
+
+    Returns:
+        rows: The row fields.
+        cols: The column fields, without '(Data)'.
+        col_level_order: The position of each column level after unstacking, '(Data)' first.
+        transpose: True if '(Data)' was in the rows, the dense result must be transposed.
+    """
+    transpose = False
+    if('(Data)' in rows):
+        """
+        If '(Data)' is in the rows, then swap rows with columns and transpose at the end.
+        """
+        cols, rows = rows, cols
+        transpose = True
+
+    cols_init = ['(Data)'] + [col for col in cols if col != '(Data)'] # initial dataframe.columns.names
+    col_levels_dict = {col: cols_init.index(col) for col in cols_init} # index of each item in initial df
+    col_level_order = [col_levels_dict[item] for item in cols] # where we want the cols to be
+
+    # Remove '(Data)' from cols list
+    cols = list(cols)
+    cols.remove('(Data)')
+
+    return list(rows), cols, col_level_order, transpose
+
+def unstack_pivot(result: pd.DataFrame, cols: List[str], col_level_order: List[int], aggs: List[str], 
+                  stats: Optional[PivotStats] = None) -> pd.DataFrame:
+    """
+    Unstack the column fields of a long result and order the columns like the UI expects,
+    see `split_layout`. The result is not transposed.
+    """
+    # unstack columns
+    with time_stage(stats, 'unstack') as stage:
+        result = result.unstack(cols).fillna(0)
+        if stage:
+            stage.rows = len(result)
+
+    # reorder cols if not empty list
+    if cols:
+        with time_stage(stats, 'reorder_levels'):
+            # name the '(Data)' level
+            new_names = list(result.columns.names)
+            new_names[0] = "Field"
+            result.columns.set_names(new_names, inplace=True)
+            # order the columns
+            result = result.reorder_levels(order=col_level_order, axis=1)
+
+    with time_stage(stats, 'order columns'):
+        # create a rename dict for custom field ordering
+        agg_order = {str: f'"@$%"+{idx}' for idx, str in enumerate(aggs)}
+        result.rename(columns=agg_order, inplace=True)
+        result = result.sort_index(axis=1)
+        result.rename(columns={v: k for k, v in agg_order.items()}, inplace=True)
+
+    return result
+
+class PivotLayout:
+    """
+    The axes of a dense pivot table, backed by its long form.
+
+    Memory scales with the number of non-empty groups plus the length of the axes,
+    not with the number of cells of the dense table.
+
+    Example:
+        layout = PivotLayout(long_result, cols, col_level_order, aggs, transpose)
+        print(layout.shape)
+        window = layout.densify(row_range=(0, 100), col_range=(0, 20))
+    """
+
+    def __init__(self, long_result: pd.DataFrame, cols: List[str], col_level_order: List[int], aggs: List[str], transpose: bool):
+        """
+        :param long_result: Finalized aggregates indexed by the row levels followed by the `cols` levels, with columns `aggs`
+        """
+        self.long_result = long_result
+        self.cols = list(cols)
+        self.col_level_order = list(col_level_order)
+        self.aggs = list(aggs)
+        self.transpose = transpose
+
+        n_row_levels = long_result.index.nlevels - len(self.cols)
+        self._row_keys = self._get_keys(long_result.index, range(n_row_levels))
+        self._col_keys = self._get_keys(long_result.index, range(n_row_levels, long_result.index.nlevels))
+
+        self.row_axis = self._row_keys.unique().sort_values()
+        self.col_axis = self._get_col_axis()
+
+    @staticmethod
+    def _get_keys(index: pd.Index, levels) -> pd.Index:
+        levels = list(levels)
+        if not levels:
+            return None
+        if len(levels) == index.nlevels:
+            return index
+        return index.droplevel([i for i in range(index.nlevels) if i not in levels])
+
+    def _get_col_axis(self) -> pd.Index:
+        # lay out a single row holding every column key, so the columns are ordered like `unstack_pivot` does
+        if self._col_keys is None:
+            index = pd.Index([0])
+        else:
+            col_keys = self._col_keys.unique()
+            if isinstance(col_keys, pd.MultiIndex):
+                index = pd.MultiIndex.from_arrays([np.zeros(len(col_keys), dtype=int)] + [col_keys.get_level_values(i) for i in range(col_keys.nlevels)])
+            else:
+                index = pd.MultiIndex.from_arrays([np.zeros(len(col_keys), dtype=int), col_keys])
+            index = index.set_names([None] + self.cols)
+        dummy = pd.DataFrame(0.0, index=index, columns=self.aggs)
+        return unstack_pivot(dummy, self.cols, self.col_level_order, self.aggs).columns
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        shape = (len(self.row_axis), len(self.col_axis))
+        return shape[::-1] if self.transpose else shape
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.long_result.memory_usage(index=True, deep=False).sum())
+
+    def _get_col_positions(self, agg: str) -> np.ndarray:
+        # the column of `agg` in the dense table, for each long row
+        if self._col_keys is None:
+            return np.full(len(self.long_result), self.col_axis.get_loc(agg))
+        levels = []
+        for name in self.col_axis.names:
+            if name == 'Field':
+                levels.append(np.full(len(self.long_result), agg, dtype=object))
+            elif isinstance(self._col_keys, pd.MultiIndex):
+                levels.append(self._col_keys.get_level_values(name))
+            else:
+                levels.append(self._col_keys)
+        return self.col_axis.get_indexer(pd.MultiIndex.from_arrays(levels, names=self.col_axis.names))
+
+    def to_array(self) -> np.ndarray:
+        """
+        Return the cells of the whole dense table as a float64 array, without building its DataFrame.
+        Empty cells are 0, like in `unstack_pivot`.
+        """
+        values = np.zeros((len(self.row_axis), len(self.col_axis)))
+        rows = self.row_axis.get_indexer(self._row_keys)
+        for agg in self.aggs:
+            values[rows, self._get_col_positions(agg)] = self.long_result[agg].to_numpy(dtype=np.float64, na_value=np.nan)
+        values[np.isnan(values)] = 0
+        return np.ascontiguousarray(values.T) if self.transpose else values
+
+    def densify(self, row_range: Tuple[int, int], col_range: Tuple[int, int]) -> pd.DataFrame:
+        """
+        Return the cells of the dense table in [start, stop) ranges of its rows and columns,
+        equal to `dense_table.iloc[row_range[0]:row_range[1], col_range[0]:col_range[1]]`.
+        """
+        if self.transpose:
+            row_range, col_range = col_range, row_range
+
+        window_rows = self.row_axis[row_range[0]:row_range[1]]
+        window_cols = self.col_axis[col_range[0]:col_range[1]]
+
+        # only the groups that fall in the window are unstacked
+        mask = self._row_keys.isin(window_rows)
+        if self._col_keys is not None:
+            window_col_keys = window_cols.droplevel('Field') if isinstance(window_cols, pd.MultiIndex) else window_cols
+            mask &= self._col_keys.isin(window_col_keys)
+        window = self.long_result[mask]
+
+        if len(window):
+            window = unstack_pivot(window, self.cols, self.col_level_order, self.aggs)
+            window = window.reindex(index=window_rows, columns=window_cols, fill_value=0.0)
+        else:
+            window = pd.DataFrame(0.0, index=window_rows, columns=window_cols)
+
+        return window.T if self.transpose else window
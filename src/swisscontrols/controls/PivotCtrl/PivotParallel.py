@@ -0,0 +1,245 @@
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import List, Dict, Callable
+
+import pandas as pd
+import numpy as np
+
+from swisscontrols.controls.PivotCtrl.PivotField import PivotField
+from swisscontrols.controls.PivotCtrl.PivotAggregate import aggregate_states, merge_states, get_source_columns
+from swisscontrols.controls.UserScripts.user_scripts import create_combined_mask, create_filter_from_key, get_filter_key, get_key_columns
+
+"""
+Sharded aggregation on a pool of worker processes.
+
+The columns a query reads (its group keys, the sources of its aggregates and the columns of its 
+filters) are copied into `multiprocessing.shared_memory` on first use, and kept until the data 
+changes: numeric columns as they are, categorical columns as their integer codes, and other columns 
+(e.g. strings that are not a GroupBy field) as the codes of their factorized values. Only the 
+categories and the unique values are pickled to the workers. Each worker attaches to the shared 
+columns, views one range of rows (a shard) without copying, filters it and computes the partial 
+aggregate states of the shard. The parent merges the partial states, see PivotAggregate.
+
+Filters can't be pickled. Filters with a `key` are rebuilt in the workers with
+`create_filter_from_key`; the mask of opaque filters is computed in the parent and sent along.
+"""
+
+class SharedFrame:
+    """
+    Columns of a DataFrame, copied into shared memory blocks when they are first needed, see `share`.
+
+    `get_spec` returns a small picklable description of the blocks that workers use to
+    attach to them, see `attach_frame`. Call `close` to release the blocks.
+    """
+
+    def __init__(self, n_rows: int):
+        self.n_rows = n_rows
+        # identifies the frame in the workers, which detach from the blocks of older frames
+        self.id = uuid.uuid4().hex
+        self._blocks = []
+        # name -> the description of its block
+        self._columns = {}
+
+    def share(self, df: pd.DataFrame, names: List[str]):
+        """
+        Copy the columns `names` of `df` into shared memory, unless they already are.
+        """
+        for name in names:
+            if name not in self._columns:
+                self._columns[name] = self._share_column(df[name])
+
+    def _share_column(self, series: pd.Series) -> Dict:
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            values = series.cat.codes.to_numpy()
+            meta = {'categories': series.cat.categories, 'ordered': series.cat.ordered}
+        elif isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biuf':
+            values = series.to_numpy()
+            meta = {}
+        else:
+            # e.g. strings that are not a GroupBy field: their codes are shared, the workers decode them
+            codes, uniques = pd.factorize(series)
+            values = codes.astype(np.int32) if len(uniques) < 2**31 else codes
+            meta = {'uniques': np.asarray(uniques, dtype=object), 'decoded_dtype': series.dtype}
+
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        self._blocks.append(block)
+        np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+        return {'name': series.name, 'block': block.name, 'dtype': values.dtype.str, **meta}
+
+    def get_spec(self, names: List[str]) -> Dict:
+        """
+        Describe the shared columns `names` for `attach_frame`.
+        """
+        return {'frame': self.id, 'n_rows': self.n_rows, 'columns': [self._columns[name] for name in names]}
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self._columns)
+
+    @property
+    def nbytes(self) -> int:
+        return sum(block.size for block in self._blocks)
+
+    def close(self):
+        for block in self._blocks:
+            block.close()
+            block.unlink()
+        self._blocks = []
+
+# the blocks a worker process is attached to, by name, and the frame they belong to
+_attached_blocks: Dict[str, shared_memory.SharedMemory] = {}
+_attached_frame = [None]
+
+def attach_frame(spec: Dict, start: int, stop: int) -> pd.DataFrame:
+    """
+    Return rows [start, stop) of a SharedFrame as a DataFrame that views the shared memory.
+    Columns that aren't numeric or categorical are decoded into this process's memory.
+    """
+    if _attached_frame[0] != spec['frame']:
+        # detach from the blocks of older frames
+        for name in list(_attached_blocks):
+            try:
+                _attached_blocks.pop(name).close()
+            except BufferError:
+                # still viewed by a live frame, the mapping goes away with the process
+                pass
+        _attached_frame[0] = spec['frame']
+
+    columns = {}
+    for column in spec['columns']:
+        block = _attached_blocks.get(column['block'])
+        if block is None:
+            block = _attached_blocks[column['block']] = shared_memory.SharedMemory(name=column['block'])
+        values = np.ndarray((spec['n_rows'],), dtype=np.dtype(column['dtype']), buffer=block.buf)[start:stop]
+
+        if 'categories' in column:
+            dtype = pd.CategoricalDtype(categories=column['categories'], ordered=column['ordered'])
+            values = pd.Categorical.from_codes(values, dtype=dtype)
+        elif 'uniques' in column:
+            # missing values have code -1, which picks the trailing NaN
+            values = pd.array(np.append(column['uniques'], [np.nan])[values], dtype=column['decoded_dtype'])
+        columns[column['name']] = values
+
+    return pd.DataFrame(columns, copy=False)
+
+def aggregate_shard(spec: Dict, start: int, stop: int,
+                    filter_keys: List, opaque_mask: np.ndarray,
+                    keys: List[str], aggs: List[str], field_data: Dict[str, PivotField]) -> pd.DataFrame:
+    """
+    Filter one shard of a SharedFrame and compute its summed aggregate states. Runs in a worker process.
+    """
+    df = attach_frame(spec, start, stop)
+    mask = create_combined_mask([create_filter_from_key(key) for key in filter_keys], df)
+    if opaque_mask is not None:
+        mask &= opaque_mask
+    return aggregate_states(df[mask], keys=keys, aggs=aggs, field_data=field_data)
+
+class ShardedAggregator:
+    """
+    Computes aggregate states on several processes, one row shard per worker.
+
+    The columns of the data are shared on the first query that reads them, and dropped when the data changes.
+    The worker processes are started on the first query and kept until `shutdown`.
+
+    On platforms that spawn worker processes (Windows, macOS), the script that creates the
+    aggregator must guard its entry point with `if __name__ == '__main__':`.
+
+    Example:
+        aggregator = ShardedAggregator(n_workers=16)
+        states = aggregator.aggregate(df, data_version, filters, keys, aggs, field_data, mask_func)
+        aggregator.shutdown()
+    """
+
+    def __init__(self, n_workers: int, min_shard_rows: int = 250_000):
+        """
+        :param n_workers: The number of worker processes
+        :param min_shard_rows: Smaller frames are split into fewer shards, and aren't sharded at all
+                               below 2 * min_shard_rows, where the overhead outweighs the gain
+        """
+        self.n_workers = n_workers
+        self.min_shard_rows = min_shard_rows
+        self._executor = None
+        self._frame = None
+        self._frame_version = None
+
+    def get_n_shards(self, n_rows: int) -> int:
+        return max(1, min(self.n_workers, n_rows // self.min_shard_rows))
+
+    def _share(self, df: pd.DataFrame, data_version: int, columns: List[str]) -> SharedFrame:
+        if self._frame is None or self._frame_version != data_version:
+            self.release()
+            self._frame = SharedFrame(len(df))
+            self._frame_version = data_version
+        self._frame.share(df, columns)
+        return self._frame
+
+    def aggregate(self,
+                  df: pd.DataFrame,
+                  data_version: int,
+                  filters: List[Callable],
+                  keys: List[str],
+                  aggs: List[str],
+                  field_data: Dict[str, PivotField],
+                  mask_func: Callable[[List[Callable]], np.ndarray],
+                  check_cancelled: Callable = None) -> pd.DataFrame:
+        """
+        Compute `aggregate_states` of the filtered `df`, sharded over the worker processes.
+
+        :param data_version: Identifies the content of `df`, the shared columns are dropped when it changes
+        :param mask_func: Evaluates a list of opaque filters on the whole of `df` in this process
+        :param check_cancelled: Called while waiting for the shards, may raise to stop early
+        """
+        filters = list(filters or [])
+        filter_keys = [get_filter_key(f) for f in filters]
+        opaque = [f for f, key in zip(filters, filter_keys) if key is None]
+        filter_keys = [key for key in filter_keys if key is not None]
+        opaque_mask = mask_func(opaque) if opaque else None
+
+        # only the columns this query reads are shared
+        filter_columns = sorted(c for c in set().union(*(get_key_columns(key) for key in filter_keys)) if c in df.columns)
+        columns = list(dict.fromkeys(keys + get_source_columns(aggs, field_data) + filter_columns))
+        frame = self._share(df, data_version, columns)
+        spec = frame.get_spec(columns)
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.n_workers)
+
+        # only the field data the workers need is pickled
+        field_data = {name: field_data[name] for name in get_source_columns(aggs, field_data)}
+
+        n_shards = self.get_n_shards(frame.n_rows)
+        bounds = [frame.n_rows * i // n_shards for i in range(n_shards + 1)]
+        futures = [self._executor.submit(aggregate_shard, spec, start, stop, filter_keys,
+                                         None if opaque_mask is None else opaque_mask[start:stop],
+                                         keys, aggs, field_data)
+                   for start, stop in zip(bounds[:-1], bounds[1:])]
+
+        try:
+            parts = []
+            for future in futures:
+                if check_cancelled is not None:
+                    check_cancelled()
+                parts.append(future.result())
+        finally:
+            for future in futures:
+                future.cancel()
+
+        return merge_states(parts, keys=keys)
+
+    def release(self):
+        """
+        Free the shared copy of the data.
+        """
+        if self._frame is not None:
+            self._frame.close()
+            self._frame = None
+            self._frame_version = None
+
+    def shutdown(self):
+        """
+        Free the shared copy of the data and stop the worker processes.
+        """
+        self.release()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
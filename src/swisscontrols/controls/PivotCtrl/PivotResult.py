@@ -0,0 +1,140 @@
+import dataclasses
+from typing import List
+
+import pandas as pd
+import numpy as np
+
+from swisscontrols.controls.PivotCtrl.PivotLayout import PivotLayout
+
+"""
+An array-backed pivot result for renderers.
+
+Reading a DataFrame cell by cell with `df.iloc[i, j]` costs microseconds per call. A PivotResult
+holds the cells in one contiguous 2-D numpy array, so a renderer reads them with `values[i, j]`,
+along with the labels of each header level as plain arrays and the spans that header cells
+cover. The DataFrame is only built on demand, by `to_frame`.
+"""
+
+def get_level_labels(index: pd.Index) -> List[np.ndarray]:
+    """
+    Return one array of labels per level of `index`, each as long as the index.
+    """
+    if isinstance(index, pd.MultiIndex):
+        return [index.get_level_values(i).to_numpy(dtype=object) for i in range(index.nlevels)]
+    return [index.to_numpy(dtype=object)]
+
+def get_level_codes(index: pd.Index) -> List[np.ndarray]:
+    """
+    Return one array of integer codes per level of `index`, equal where the labels are equal.
+    """
+    if isinstance(index, pd.MultiIndex):
+        return [np.asarray(codes) for codes in index.codes]
+    return [pd.factorize(index)[0]]
+
+def get_spans(codes: List[np.ndarray]) -> List[np.ndarray]:
+    """
+    Return the spans of the header cells of each level: an (n_spans, 2) array of [start, stop)
+    per level. A span is a run of rows (or columns) that share the codes of that level and
+    of every level above it, see `get_level_codes`.
+    """
+    n = len(codes[0]) if codes else 0
+    spans = []
+    changed = np.zeros(max(n - 1, 0), dtype=bool)
+    for level in codes:
+        changed |= level[1:] != level[:-1]
+        starts = np.flatnonzero(np.concatenate([[n > 0], changed]))
+        stops = np.append(starts[1:], n)[:len(starts)]
+        spans.append(np.column_stack([starts, stops]).astype(np.intp))
+    return spans
+
+def get_span_starts(spans: List[np.ndarray], n: int) -> List[np.ndarray]:
+    """
+    Return one boolean array of length `n` per level, True where a span starts.
+    """
+    starts = []
+    for level_spans in spans:
+        level_starts = np.zeros(n, dtype=bool)
+        level_starts[level_spans[:, 0]] = True
+        starts.append(level_starts)
+    return starts
+
+@dataclasses.dataclass(eq=False)
+class PivotResult:
+    """
+    The cells and headers of a dense pivot table.
+
+    Example:
+        result = broker.get_pivot_result(filters=None, rows=['Fruit'], cols=['(Data)', 'Year'], aggs=['Weight'])
+        value = result.values[0, 3]
+        year = result.col_labels[1][3]
+        for start, stop in result.row_spans[0]:
+            ...  # one header cell over rows [start, stop)
+    """
+    values: np.ndarray                  # (n_rows, n_cols) float64, C-contiguous
+    row_index: pd.Index                 # the row keys, as in the DataFrame
+    col_index: pd.Index                 # the column keys, as in the DataFrame
+    row_labels: List[np.ndarray] = dataclasses.field(init=False)   # one array of labels per row level
+    col_labels: List[np.ndarray] = dataclasses.field(init=False)   # one array of labels per column level
+    row_spans: List[np.ndarray] = dataclasses.field(init=False)    # see `get_spans`
+    col_spans: List[np.ndarray] = dataclasses.field(init=False)
+
+    def __post_init__(self):
+        self.values = np.ascontiguousarray(self.values, dtype=np.float64)
+        self.row_labels = get_level_labels(self.row_index)
+        self.col_labels = get_level_labels(self.col_index)
+        self.row_spans = get_spans(get_level_codes(self.row_index))
+        self.col_spans = get_spans(get_level_codes(self.col_index))
+        self._frame = None
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame) -> 'PivotResult':
+        return cls(df.to_numpy(dtype=np.float64, na_value=np.nan), df.index, df.columns)
+
+    @classmethod
+    def from_layout(cls, layout: PivotLayout) -> 'PivotResult':
+        """
+        Build the result from the long form of a pivot, without unstacking it to a DataFrame.
+        """
+        if layout.transpose:
+            return cls(layout.to_array(), layout.col_axis, layout.row_axis)
+        return cls(layout.to_array(), layout.row_axis, layout.col_axis)
+
+    @property
+    def shape(self):
+        return self.values.shape
+
+    @property
+    def row_names(self) -> List:
+        return list(self.row_index.names)
+
+    @property
+    def col_names(self) -> List:
+        return list(self.col_index.names)
+
+    @property
+    def nbytes(self) -> int:
+        labels = sum(level.nbytes for level in self.row_labels + self.col_labels)
+        return int(self.values.nbytes + labels + self.row_index.memory_usage() + self.col_index.memory_usage())
+
+    def compact_labels(self, axis: int = 0) -> List[np.ndarray]:
+        """
+        Return the labels of each level with '' where a header cell continues the span above it,
+        e.g. for drawing row headers as one label per span.
+        """
+        labels, spans = (self.row_labels, self.row_spans) if axis == 0 else (self.col_labels, self.col_spans)
+        compact = []
+        for level, level_spans in zip(labels, spans):
+            level = level.copy()
+            continued = np.ones(len(level), dtype=bool)
+            continued[level_spans[:, 0]] = False
+            level[continued] = ''
+            compact.append(level)
+        return compact
+
+    def to_frame(self) -> pd.DataFrame:
+        """
+        Return the result as a DataFrame, built on the first call.
+        """
+        if self._frame is None:
+            self._frame = pd.DataFrame(self.values, index=self.row_index, columns=self.col_index)
+        return self._frame
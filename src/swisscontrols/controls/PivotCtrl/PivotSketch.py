@@ -0,0 +1,205 @@
+from functools import reduce
+from typing import List
+
+import pandas as pd
+import numpy as np
+
+"""
+Mergeable summaries for aggregates that are not sums: distinct counts and quantiles.
+
+Each aggregate has an exact summary and an approximate sketch. All of them are built from the
+values of one group with `from_values` and combined with `merge`, so they can be rolled up,
+cached, appended to and computed on shards like the summed states in PivotAggregate.
+
+Exact summaries keep the distinct values (DistinctSet) or all values (ExactQuantiles) of a
+group, their memory grows with the data. Sketches have a bounded size:
+
+HyperLogLog (distinct counts)
+    2**precision one-byte registers per group, 4 KB at the default precision of 12.
+    The relative standard error of the count is about 1.04 / sqrt(2**precision), 1.6% at
+    precision 12: 95% of estimates are within 3.3% of the true count. Small counts use linear
+    counting and are nearly exact. Merging is exact: a merged sketch is the sketch of the union.
+
+QuantileSketch (median, percentiles)
+    A KLL-style stack of compactors with capacity k per level. A level that exceeds k items is
+    sorted and every other item is promoted to the next level, at twice the weight, starting from
+    an offset that alternates between 0 and 1 with each compaction of the level, so that the same
+    values and merges always give the same sketch. Memory is at most about k * log2(n / k) values 
+    per group (32 KB for k=256 and 10M rows). The rank of a returned quantile differs from the 
+    requested rank by at most n * log2(n / k) / k in the worst case; because the alternating 
+    offsets round up and down in turn, the error is usually far smaller, on the order of 
+    n * sqrt(log2(n / k)) / k (about 1% of n for k=256 and 10M rows).
+    Merged sketches have the same bounds for the combined n.
+"""
+
+HLL_PRECISION = 12
+KLL_CAPACITY = 256
+
+def drop_missing(values) -> np.ndarray:
+    values = np.asarray(values)
+    return values[~pd.isna(values)] if len(values) else values
+
+def merge_summaries(summaries: List) -> object:
+    """
+    Merge the summaries of several groups or shards into one.
+    """
+    return reduce(lambda a, b: a.merge(b), summaries)
+
+class DistinctSet:
+    """
+    Exact distinct count: the distinct values of a group.
+    """
+
+    def __init__(self, values: np.ndarray):
+        self.values = values
+
+    @classmethod
+    def from_values(cls, values) -> 'DistinctSet':
+        return cls(pd.unique(drop_missing(values)))
+
+    def merge(self, other: 'DistinctSet') -> 'DistinctSet':
+        return DistinctSet(pd.unique(np.concatenate([self.values, other.values])))
+
+    def count(self) -> float:
+        return float(len(self.values))
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.values.nbytes)
+
+class HyperLogLog:
+    """
+    Approximate distinct count, see the module notes for the error bounds.
+    """
+
+    def __init__(self, registers: np.ndarray):
+        self.registers = registers
+
+    @property
+    def precision(self) -> int:
+        return int(np.log2(len(self.registers)))
+
+    @classmethod
+    def from_values(cls, values, precision: int = HLL_PRECISION) -> 'HyperLogLog':
+        registers = np.zeros(2**precision, dtype=np.uint8)
+        values = drop_missing(values)
+        if len(values):
+            hashes = pd.util.hash_array(values)
+            # the first `precision` bits pick a register, the position of the first 1 in the other bits is the rank
+            index = (hashes >> np.uint64(64 - precision)).astype(np.intp)
+            rest = hashes << np.uint64(precision)
+            bit_length = np.zeros(len(rest), dtype=np.int64)
+            for shift in (32, 16, 8, 4, 2, 1):
+                # bit length of `rest`, by binary search over the 64 bits
+                high = rest >> np.uint64(shift) > 0
+                rest = np.where(high, rest >> np.uint64(shift), rest)
+                bit_length += high * shift
+            bit_length += rest > 0
+            rank = np.minimum(64 - bit_length + 1, 64 - precision + 1).astype(np.uint8)
+            np.maximum.at(registers, index, rank)
+        return cls(registers)
+
+    def merge(self, other: 'HyperLogLog') -> 'HyperLogLog':
+        if len(self.registers) != len(other.registers):
+            raise ValueError("Can't merge HyperLogLog sketches of different precision.")
+        return HyperLogLog(np.maximum(self.registers, other.registers))
+
+    def count(self) -> float:
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        zeros = np.count_nonzero(self.registers == 0)
+        if estimate <= 2.5 * m and zeros:
+            # linear counting is more accurate for small cardinalities
+            estimate = m * np.log(m / zeros)
+        return float(estimate)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.registers.nbytes)
+
+class ExactQuantiles:
+    """
+    Exact quantiles: all values of a group.
+    """
+
+    def __init__(self, values: np.ndarray):
+        self.values = values
+
+    @classmethod
+    def from_values(cls, values) -> 'ExactQuantiles':
+        return cls(drop_missing(values).astype(np.float64))
+
+    def merge(self, other: 'ExactQuantiles') -> 'ExactQuantiles':
+        return ExactQuantiles(np.concatenate([self.values, other.values]))
+
+    def quantile(self, q: float) -> float:
+        # linear interpolation, like pandas' median and quantile
+        return float(np.quantile(self.values, q)) if len(self.values) else np.nan
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.values.nbytes)
+
+class QuantileSketch:
+    """
+    Approximate quantiles, see the module notes for the error bounds.
+
+    `levels[h]` holds items that each stand for 2**h values, and `offsets[h]` is the offset 
+    of the next compaction of that level.
+    """
+
+    def __init__(self, levels: List[np.ndarray], capacity: int = KLL_CAPACITY, offsets: List[int] = None):
+        self.levels = levels
+        self.capacity = capacity
+        self.offsets = [0] * len(levels) if offsets is None else offsets
+
+    @classmethod
+    def from_values(cls, values, capacity: int = KLL_CAPACITY) -> 'QuantileSketch':
+        sketch = cls([drop_missing(values).astype(np.float64)], capacity)
+        sketch._compact()
+        return sketch
+
+    def _compact(self):
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if len(level) > self.capacity:
+                level = np.sort(level)
+                # an odd item out stays on this level
+                n_pairs = len(level) // 2
+                promoted = level[self.offsets[h]:2 * n_pairs:2]
+                self.offsets[h] ^= 1
+                self.levels[h] = level[2 * n_pairs:]
+                if h + 1 == len(self.levels):
+                    self.levels.append(promoted)
+                    self.offsets.append(0)
+                else:
+                    self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+            h += 1
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        n_levels = max(len(self.levels), len(other.levels))
+        levels = [np.concatenate([sketch.levels[h] for sketch in (self, other) if h < len(sketch.levels)])
+                  for h in range(n_levels)]
+        # keep alternating where either sketch left off
+        offsets = [(self.offsets[h] if h < len(self.offsets) else 0) ^ (other.offsets[h] if h < len(other.offsets) else 0)
+                   for h in range(n_levels)]
+        sketch = QuantileSketch(levels, max(self.capacity, other.capacity), offsets)
+        sketch._compact()
+        return sketch
+
+    def quantile(self, q: float) -> float:
+        items = np.concatenate(self.levels)
+        if not len(items):
+            return np.nan
+        weights = np.concatenate([np.full(len(level), 2.0**h) for h, level in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        items, cumulative = items[order], np.cumsum(weights[order])
+        # the first item whose cumulative weight reaches the requested rank
+        rank = q * cumulative[-1]
+        return float(items[min(np.searchsorted(cumulative, rank), len(items) - 1)])
+
+    @property
+    def nbytes(self) -> int:
+        return int(sum(level.nbytes for level in self.levels))
@@ -0,0 +1,58 @@
+import dataclasses
+import time
+from contextlib import contextmanager, nullcontext
+from typing import List, Optional, Tuple
+
+@dataclasses.dataclass
+class PivotStage:
+    name: str
+    seconds: float = 0.0
+    rows: Optional[int] = None      # rows (or groups) produced by the stage, if it changes them
+
+@dataclasses.dataclass
+class PivotStats:
+    """
+    Where the time of one `PivotBroker.get_pivot` call went.
+
+    Example:
+        broker = PivotBroker(stats_hook=print)
+        broker.get_pivot(filters=None, rows=['Fruit'], cols=['(Data)'], aggs=['Weight'])
+    """
+    rows: List[str]
+    cols: List[str]
+    aggs: List[str]
+    source_rows: Optional[int]                  # rows of the flat data, None if it is scanned from the source
+    cache_hit: bool = False                     # the result came from the pivot cache
+    seconds: float = 0.0                        # total wall time of the call
+    result_shape: Optional[Tuple[int, int]] = None
+    stages: List[PivotStage] = dataclasses.field(default_factory=list)
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Time the body of a `with` block as one stage. The stage is yielded so that its `rows` can be set.
+        """
+        stage = PivotStage(name)
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            stage.seconds = time.perf_counter() - start
+            self.stages.append(stage)
+
+    def __str__(self):
+        source = "scanned" if self.source_rows is None else f"{self.source_rows:,} rows"
+        lines = [f"{self.seconds * 1000:9.2f} ms  total, {source}"
+                 + (" (cached)" if self.cache_hit else "")]
+        for stage in self.stages:
+            rows = "" if stage.rows is None else f" -> {stage.rows:,}"
+            lines.append(f"{stage.seconds * 1000:9.2f} ms  {stage.name}{rows}")
+        if self.result_shape is not None:
+            lines.append(f"result {self.result_shape[0]:,} x {self.result_shape[1]:,}")
+        return "\n".join(lines)
+
+def time_stage(stats: Optional[PivotStats], name: str):
+    """
+    `stats.stage(name)`, or a context that does nothing when stats are not being collected.
+    """
+    return nullcontext() if stats is None else stats.stage(name)
@@ -11,11 +11,12 @@ from swisscontrols.controls.DpgHelpers.MvItemTypes import MvItemTypes
 from swisscontrols.controls.DpgHelpers.MvThemeCol import MvThemeCol
 from swisscontrols.controls.DpgHelpers.Layouts import calc_single_window_height_from_items, calc_multi_window_height_in_table_rows
 from swisscontrols.controls.Textures.TextureIds import TextureIds
-from swisscontrols.controls.GridSelector.GridSelector import GridSelector
-from swisscontrols.controls.PivotCtrl.PivotBroker import PivotBroker
+from swisscontrols.controls.PivotCtrl.PivotBroker import PivotBroker, PivotCancelled
 from swisscontrols.controls.PivotCtrl.PivotField import PivotFieldType 
+from swisscontrols.controls.PivotCtrl.PivotGrid import PivotGridView
 from swisscontrols.controls.CheckListCtrl.CheckListCtrl import checkListCtrl
 from swisscontrols.controls.PivotCtrl.PivotFilter import PivotFilterButton, pivotFilterDialog
+from swisscontrols.controls.UserScripts.user_scripts import create_lambda_accept_all, get_filter_key
 
 """
 DONE
@@ -49,7 +50,6 @@ TODO
   - account for minimum height of field list -> multiple columns in a group
 - enable sorting?
 - move the 'failed drag' code into a method
-- fix whatever bug is in the compact_index method 
 - put a border or background or placeholder on the lanes when they are empty. 
 - theming?
 """
@@ -72,6 +72,10 @@ ID_GRID_SELECT = dpg.generate_uuid()
 ID_PIVOT_TABLE = dpg.generate_uuid()
 ID_PIVOT_CONFIG_WINDOW = dpg.generate_uuid()
 ID_PIVOT_FILTER_WINDOW = dpg.generate_uuid()
+ID_PIVOT_COMPUTING = dpg.generate_uuid()
+ID_PIVOT_TOTALS = dpg.generate_uuid()
+ID_PIVOT_STATS_WINDOW = dpg.generate_uuid()
+ID_PIVOT_STATS_TEXT = dpg.generate_uuid()
 
 # just to get this thing working
 DROP_TARGET = {
@@ -93,11 +97,13 @@ load_textures()
 # print(dpg.does_alias_exist('3215'))
 # print(dpg.does_item_exist('3215'))
 
-pivotBroker = PivotBroker()
-df = pivotBroker.get_pivot(filters=None, 
+pivotBroker = PivotBroker(collect_stats=True)
+pivot = pivotBroker.get_pivot_result(filters=None, 
                         rows=['Fruit', '(Data)', 'Shape'], # '(Data)', 
                         cols=['Year'],
                         aggs=['Weight', 'Volume'])
+# the grid only creates widgets for the cells in view, see PivotGrid
+pivot_grid = None
 
 # print(df)
 # print(df.columns)
@@ -107,185 +113,6 @@ df = pivotBroker.get_pivot(filters=None,
 # w_h_c_data = dpg.load_image("controls/assets/partial_check.png")
 # print(w_h_c_data)
 
-def get_column_to_index_treedict(df):
-    """
-    Get a mapping from hierarchical column levels to DataFrame column indices.
-
-    Args:
-    df (pandas.DataFrame): The DataFrame to map.
-
-    Returns:
-    dict: A nested dictionary where the keys at each level correspond to the
-    values at each level of the DataFrame's columns. The values at the deepest
-    level are the indices of the corresponding columns in the DataFrame.
-    """
-
-    # Initialize an empty dictionary
-    lookup = {}
-
-    if isinstance(df.columns, pd.MultiIndex):
-        # Iterate over the DataFrame's columns
-        for i, col in enumerate(df.columns):
-
-            # Extract the values at each level of the column
-            level_values = col[:len(df.columns.names)]
-            
-            # Traverse the lookup dictionary, creating new dictionaries as needed
-            current_dict = lookup
-            for value in level_values[:-1]:
-                if value not in current_dict:
-                    current_dict[value] = {}
-                current_dict = current_dict[value]
-
-            # Add the final level to the lookup dictionary
-            if level_values[-1] not in current_dict:
-                current_dict[level_values[-1]] = i
-
-    else:
-        lookup = { item: i for i, item in enumerate(df.columns)}
-
-    return lookup
-
-def get_index_to_columnnames_dict(column_map, current_keys=[], index_map={}):
-    """
-    Recursively create an index map for a nested column structure.
-    
-    Args:
-    column_map (dict): The column map dict.
-    current_keys (list): The current position within the column map, at each level of the hierarchy.
-    index_map (dict): The index map to populate. This is also the return value.
-    
-    Returns:
-    dict: The populated index map, mapping indices to positions.
-    """
-    current_level = column_map
-    for key in current_keys:
-        current_level = current_level[key]
-        
-    for key, value in current_level.items():
-        if isinstance(value, dict):
-            get_index_to_columnnames_dict(column_map, current_keys + [key], index_map)
-        else:
-            index_map[value] = current_keys + [key]
-
-    return index_map
-
-def compact_index(df):
-    """
-    Compacts a DataFrame MultiIndex by replacing consecutive identical values with ''.
-
-    Args:
-    df (pandas.DataFrame): The DataFrame with the MultiIndex to compact.
-
-    Returns:
-    list: A list of lists, each containing the compacted values from each level of the MultiIndex.
-    """
-
-    if not isinstance(df.index, pd.MultiIndex):
-        # If the index is not a MultiIndex, just convert it to a list and wrap it in another list
-        compact_index = [[item] for item in df.index.tolist()]
-    else:
-
-        index_list = df.index.tolist()  # Convert the MultiIndex to a list of tuples
-
-        # Use a list comprehension to replace consecutive identical values with ''
-        compact_index = [[col if j == 0 or col != index_list[j - 1][i] else '' for i, col in enumerate(row)] for j, row in enumerate(index_list)]
-
-    return compact_index
-
-def add_df_multilevelindex_recursive(column_names, depth):
-    # called inside a row
-
-    if depth < len(column_names)-1:
-        with dpg.table(parent=dpg.last_item(), header_row=True, resizable=True, no_host_extendX=True):
-            dpg.add_table_column() #label=column_names[depth])
-            with dpg.table_row():
-                add_df_multilevelindex_recursive(column_names, depth+1)
-    else:
-        with dpg.table(header_row=True, resizable=True, no_host_extendX=True):
-            for name in df.index.names:
-                dpg.add_table_column(label=name)
-            prev_keytuple = None
-            for keytuple in df.index:
-                with dpg.table_row():
-                    for i in range(len(df.index.names)):
-                        label = keytuple[i] if prev_keytuple is None or keytuple[i] != prev_keytuple[i] else ""
-                        dpg.add_selectable(label=label)
-                    prev_keytuple = keytuple
-
-def add_df_monolevelindex_recursive(depth):
-    """
-    - is called inside a row
-    - is called when isinstance(df.columns, pd.MultiIndex) 
-    """
-    # col_btns = [item for item in dpg.get_item_children(ID_COLSLIST, 1) if (dpg.get_item_type(item) == MvItemTypes.Button.value)]
-
-    if depth < len(df.columns.names)-2:
-        with dpg.table():
-            dpg.add_table_column() # label=dpg.get_item_label(col_btns[depth+1]))
-            with dpg.table_row():
-                add_df_monolevelindex_recursive(depth+1)
-    else:
-        with dpg.table():
-            dpg.add_table_column(label=df.index.name)
-            
-            for i in range(len(df.index)):
-                with dpg.table_row():
-                    dpg.add_selectable(label=df.index[i])
-        
-        
-def add_df_multicolumndata_recursive(column_map, keys):
-    """
-    Recursively build nested table structure for DearPyGui based on a multi-level column map.
-
-    Args:
-    column_map (dict): Multi-level column map from DataFrame column hierarchy to indices. 
-                        The values of the map are either further dictionaries (for non-leaf nodes)
-                        or integers (for leaf nodes), referring to column indices in the DataFrame.
-    keys (list): Keys to the current level in the column map.
-    """
-    # Retrieve current level dictionary from column map
-    current_level = column_map
-    for key in keys:
-        current_level = current_level[key]
-
-    # implicitly, we are in a row at this step
-    # adding a table to each column in the row
-    for key in current_level.keys():
-        with dpg.table(header_row=True, resizable=True, policy=dpg.mvTable_SizingStretchProp,
-                row_background=False, no_host_extendX=True, no_pad_innerX=False,
-                borders_outerH=False, borders_innerV=True):
-            nx_level = current_level[key]
-            for nx_key in nx_level:
-                dpg.add_table_column(label=nx_key)
-
-            if isinstance(next(iter(nx_level.values())), dict):
-                # if the values of nx_level are dicts, keep going 
-                with dpg.table_row():
-                    add_df_multicolumndata_recursive(column_map, keys + [key])              
-            else:
-                # if the values of nx_level are strings, write table 
-                for row_index in range(df.shape[0]):
-                    with dpg.table_row():
-                        for relative_column_index, absolute_column_index in enumerate(nx_level.values()):
-                            val = df.iloc[row_index, absolute_column_index]
-                            cell = dpg.add_selectable(label="{:.2f}".format(val))
-                            grid_selector.widget_grid[row_index][absolute_column_index] = cell
-                            grid_selector.dpg_lookup[row_index][absolute_column_index] = [
-                                dpg.get_item_parent(dpg.get_item_parent(cell)), 
-                                row_index , # offset for multi-index row
-                                relative_column_index # + len(df.index[0])
-                            ]
-
-
-
-column_names_to_absolute_column_index = get_column_to_index_treedict(df)
-# print(column_map)
-absolute_column_index_to_column_names = get_index_to_columnnames_dict(column_names_to_absolute_column_index)
-# print(index_to_column_names)  
-# grid_selector = GridSelector(ID_GRID_SELECT, width=df.shape[1], height=df.shape[0])
-
-
 # ===========================
 
 def swap_button_labels(selected_tag, forward=True):
@@ -550,7 +377,7 @@ def create_pivot_filter(parent, field: str, label: str, field_type: PivotFieldTy
         # indent=10
     )
 
-    dict_of_pivot_filter_buttons[b] = PivotFilterButton(id=b, field=field, label=label, filter=lambda row: True, field_type=field_type)
+    dict_of_pivot_filter_buttons[b] = PivotFilterButton(id=b, field=field, label=label, filter=create_lambda_accept_all(), field_type=field_type)
 
     # TODO move this into its own method
     # and account for min height set by field list
@@ -584,11 +411,19 @@ def show_pivotFilterDialog(sender):
 
     # we need to check if this field has already been filtered
     # and if so, build the filter list for the dialog
-    data = [(True, val) for val in pivotBroker.get_uniques(field)]
-    # sort the data alphabetically
-    data = sorted(data, key=lambda item: item[1])
+    # list every value, so that values hidden by the other filters stay selected once those filters change,
+    # along with the number of rows that are still reachable under the other active filters
+    other_filters = [item.filter for id, item in dict_of_pivot_filter_buttons.items() if id != sender]
+    # the broker returns the values pre-sorted
+    values = pivotBroker.get_uniques(field)
+    reachable = pivotBroker.get_unique_counts(field, filters=other_filters)
+    counts = [int(reachable.get(val, 0)) for val in values]
+
+    key = get_filter_key(dict_of_pivot_filter_buttons[sender].filter)
+    selected = key[2] if key is not None and key[0] == 'is in' and key[1] == field else None
+    data = [(selected is None or val in selected, val) for val in values]
     
-    pivotFilterDialog(title="Filter by", field=field, data=data, sender=sender, send_data=pivotFilterDialog_callback)
+    pivotFilterDialog(title="Filter by", field=field, data=data, sender=sender, send_data=pivotFilterDialog_callback, counts=counts)
 
 def pivotFilterDialog_callback(sender, user_lambda):
     # keep the lambdas in a dict, indexed by the ID of the filter button
@@ -638,107 +473,83 @@ with dpg.theme() as lane_theme:
 
 
 
-def delete_pivot():
-    if dpg.does_item_exist(ID_PIVOT_TABLE):
-        grid_selector.deregister()
-        dpg.delete_item(ID_PIVOT_TABLE)
-        
+
+pending_pivot = None
 
 def update_pivot():
-    delete_pivot()
-    
-    global grid_selector
-    global df 
-    global column_names_to_absolute_column_index
-    # global absolute_column_index_to_column_names
+    """
+    Request a new pivot on the broker's worker thread. 
+    The table is updated by `poll_pivot` once the result arrives.
+    """
+    global pending_pivot
 
     filters = [item.filter for item in dict_of_pivot_filter_buttons.values()]
     rows = [dpg.get_item_label(item) for item in dpg.get_item_children(ID_ROWSLIST_GROUP, 1) if (dpg.get_item_type(item) == MvItemTypes.Button.value)]
     cols = [dpg.get_item_label(item) for item in dpg.get_item_children(ID_COLSLIST_GROUP, 1) if (dpg.get_item_type(item) == MvItemTypes.Button.value)]
     aggs = [dpg.get_item_label(item) for item in dpg.get_item_children(ID_DATALIST_GROUP, 1) if (dpg.get_item_type(item) == MvItemTypes.Button.value)]
     
-    df = pivotBroker.get_pivot(filters=filters, 
-                                rows=rows, 
-                                cols=cols,
-                                aggs=aggs)
+    # superseded requests are cancelled by the broker, only the latest future is kept
+    pending_pivot = pivotBroker.get_pivot_result_async(filters=filters, 
+                                                       rows=rows, 
+                                                       cols=cols,
+                                                       aggs=aggs,
+                                                       totals=dpg.get_value(ID_PIVOT_TOTALS))
+    dpg.set_value(ID_PIVOT_COMPUTING, "computing...")
+    dpg.show_item(ID_PIVOT_COMPUTING)
+
+def poll_pivot():
+    """
+    Called once per frame on the main thread. Updates the table when the latest pivot is ready.
+    """
+    global pending_pivot
+
+    if pending_pivot is None or not pending_pivot.done():
+        return
     
-    grid_selector = GridSelector(ID_GRID_SELECT, width=df.shape[1], height=df.shape[0])
-    # print(df)
-    column_names_to_absolute_column_index = get_column_to_index_treedict(df)
-    # print(column_names_to_absolute_column_index)
-    # absolute_column_index_to_column_names = get_index_to_columnnames_dict(column_names_to_absolute_column_index)
-    # print(absolute_column_index_to_column_names)
-    pretty_df_index = compact_index(df)
-    # print(pretty_df_index)
-        
-    if not isinstance(df.columns, pd.MultiIndex):
-        with dpg.table(tag=ID_PIVOT_TABLE, parent=ID_PIVOT_PARENT_WINDOW,
-                header_row=True, resizable=True, policy=dpg.mvTable_SizingStretchProp,
-                row_background=False, no_host_extendX=True, no_pad_innerX=False,
-                borders_outerH=True, 
-                borders_outerV=True,
-                borders_innerV=True):
-            # case where columns are not multi-index
-            for name in df.index.names:
-                dpg.add_table_column(label=name)
-            for key in column_names_to_absolute_column_index.keys():
-                dpg.add_table_column(label=key)
-            for row_index in range(df.shape[0]):
-                with dpg.table_row() as trow:
-                    for name in pretty_df_index[row_index]:
-                        # TODO figure out why putting text here messes up the widget heights in grid_selector
-                        dpg.add_selectable(label=name)
-                    for relative_column_index, absolute_column_index in enumerate(column_names_to_absolute_column_index.values()):
-                        val = df.iloc[row_index, absolute_column_index]
-                        
-                        # pivot tables shall display numbers only
-                        if not isinstance(val, (int, float, np.number)):
-                            raise ValueError(f"Expected a numeric value, but got {val} of type {type(val)}")
-                        
-                        cell = dpg.add_selectable(label="{:.2f}".format(val)) 
-                        grid_selector.widget_grid[row_index][absolute_column_index] = cell
-                        grid_selector.dpg_lookup[row_index][absolute_column_index] = [
-                            dpg.get_item_parent(dpg.get_item_parent(cell)), 
-                            row_index , 
-                            relative_column_index + len(df.index.names) 
-                        ]
-    else:
-        # case where columns are multi-index
-        with dpg.table(tag=ID_PIVOT_TABLE, parent=ID_PIVOT_PARENT_WINDOW,
-                header_row=True, resizable=True, policy=dpg.mvTable_SizingStretchProp,
-                row_background=False, no_host_extendX=True, no_pad_innerX=False,
-                borders_outerH=True, 
-                borders_outerV=True,
-                borders_innerV=True):
-            # first level name
-            dpg.add_table_column() # label=df.columns.names[0])
-
-            # first level values
-            top_level = column_names_to_absolute_column_index.keys()
-            
-            for key0 in top_level:
-                dpg.add_table_column(label=key0)
-
-            # a single row that contains all data in the table
-            with dpg.table_row():
-                
-                # insert df.index into first column
-                if isinstance(df.index, pd.MultiIndex):
-                    column_names = df.columns.names[1:]
-                    add_df_multilevelindex_recursive(column_names, 0)
-                else:
-                    add_df_monolevelindex_recursive(0)
-
-                # if isinstance(df.columns, pd.MultiIndex):
-                add_df_multicolumndata_recursive(column_names_to_absolute_column_index, keys=[])
-                # else:
-                #     print(column_map)
+    future, pending_pivot = pending_pivot, None
+    dpg.hide_item(ID_PIVOT_COMPUTING)
+
+    if future.cancelled() or not pivotBroker.is_latest(future):
+        return
+    try:
+        result = future.result()
+    except PivotCancelled:
+        return
+    except Exception as e:
+        # keep the last table, and say why it wasn't updated in the status line
+        dpg.set_value(ID_PIVOT_COMPUTING, f"Failed to compute pivot: {e}")
+        dpg.show_item(ID_PIVOT_COMPUTING)
+        return
+    
+    build_pivot_table(result)
+    show_pivot_stats()
+
+def show_pivot_stats():
+    """
+    Show the stage timings of the last pivot in the stats overlay.
+    """
+    if pivotBroker.last_stats is not None:
+        dpg.set_value(ID_PIVOT_STATS_TEXT, str(pivotBroker.last_stats))
+
+def build_pivot_table(result):
+    global pivot_grid
+    global pivot
+
+    pivot = result
+    # the grid is created once, later results only relabel the cells that change
+    if pivot_grid is None:
+        pivot_grid = PivotGridView(parent=ID_PIVOT_PARENT_WINDOW, tag=ID_PIVOT_TABLE)
+    pivot_grid.set_result(pivot)
 
 # ===========================
 
 with dpg.window(tag=ID_PIVOT_PARENT_WINDOW, width=700, height=600):
     
     # dpg.add_button(label='Update table', callback=update_pivot)
+    # the status line: shown while a pivot is computed, or with the error of the last one
+    dpg.add_text("computing...", tag=ID_PIVOT_COMPUTING, show=False)
+    # subtotal and grand total rows and columns are labelled 'Total'
+    dpg.add_checkbox(label="Totals", tag=ID_PIVOT_TOTALS, callback=lambda: update_pivot())
     
     with dpg.collapsing_header(label="Setup"):
         with dpg.child_window(tag=ID_PIVOT_CONFIG_WINDOW):
@@ -860,6 +671,9 @@ with dpg.window(tag=ID_PIVOT_PARENT_WINDOW, width=700, height=600):
 
     update_pivot()
 
+with dpg.window(label="Pivot stats", tag=ID_PIVOT_STATS_WINDOW, pos=(500, 20), width=280, height=200, no_focus_on_appearing=True):
+    dpg.add_text("", tag=ID_PIVOT_STATS_TEXT)
+
 dpg.show_style_editor()
 dpg.show_item_registry()
 
@@ -867,6 +681,10 @@ dpg.show_viewport()
 
 while dpg.is_dearpygui_running():
     
+    poll_pivot()
+    if pivot_grid is not None:
+        pivot_grid.update()
     dpg.render_dearpygui_frame()
 
+pivotBroker.shutdown()
 dpg.destroy_context()
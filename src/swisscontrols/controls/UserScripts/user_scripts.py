@@ -1,12 +1,96 @@
 import ast
+import numbers
 import operator as op
+from functools import lru_cache
 from typing import List, Union, Tuple, Callable
 
+import numpy as np
+import pandas as pd
+
+from swisscontrols.controls.PivotCtrl.PivotAggregate import widen, widen_frame
+
 """
 TODO
 - return error messages instead of raising exceptions
 """
 
+class MaskFilter:
+    """
+    A row filter that can also be evaluated column-wise.
+
+    Calling the filter with a DataFrame row returns a bool, exactly like the plain lambdas 
+    this module used to return. Calling `mask(df)` returns a boolean numpy array with one 
+    entry per row of `df`, computed with vectorized column operations instead of a Python 
+    call per row.
+
+    `key` is an optional hashable description of the filter. Two filters with the same key 
+    select the same rows, which lets PivotBroker cache results per filter configuration.
+
+    Usage:
+    >>> f = create_lambda_from_checklist('Fruit', ['Pear'])
+    >>> f(df.iloc[0])            # row-wise
+    >>> df[f.mask(df)]           # column-wise
+    >>> f.key                    # ('is in', 'Fruit', frozenset({'Pear'}))
+
+    Filters can be rebuilt from their key with `create_filter_from_key`.
+    """
+
+    def __init__(self, row_func: Callable, mask_func: Callable, key=None):
+        self.row_func = row_func
+        self.mask_func = mask_func
+        self.key = key
+
+    def __call__(self, row) -> bool:
+        return self.row_func(row)
+
+    def mask(self, df) -> np.ndarray:
+        return np.asarray(self.mask_func(df), dtype=bool)
+
+def create_combined_mask(lambdas: List[Callable], df) -> np.ndarray:
+    """
+    Evaluate a list of filters against a DataFrame and AND the results together.
+
+    Filters that are `MaskFilter`s are evaluated column-wise. Any other callable is treated 
+    as an opaque row-wise lambda and is only applied to the rows that survived the 
+    column-wise filters.
+
+    Args:
+    lambdas: List[Callable]
+        A list of filters that take a DataFrame row and return a bool.
+    df: pd.DataFrame
+        The DataFrame to filter.
+
+    Returns:
+    np.ndarray
+        A boolean array with one entry per row of `df`.
+
+    Usage:
+    >>> filtered_df = df[create_combined_mask(list_of_lambdas, df)]
+    """
+    mask = np.ones(len(df), dtype=bool)
+    opaque = []
+
+    for f in lambdas:
+        if isinstance(f, MaskFilter):
+            mask &= f.mask(df)
+        else:
+            opaque.append(f)
+
+    # fall back to row-wise evaluation, but only on the rows that are still selected
+    if opaque and mask.any():
+        selected = np.flatnonzero(mask)
+        # opaque filters see 64-bit values, see PivotCompact
+        row_mask = widen_frame(df.iloc[selected]).apply(create_combined_lambdas(opaque), axis=1)
+        mask[selected] = np.asarray(row_mask, dtype=bool)
+
+    return mask
+
+def get_filter_key(f: Callable):
+    """
+    Return the hashable description of a filter, or None for opaque callables.
+    """
+    return getattr(f, 'key', None) if isinstance(f, MaskFilter) else None
+
 def create_combined_lambdas(lambdas: List[Callable]) -> Callable:
     """
     Takes a list of lambda functions and returns a new function that,
@@ -30,8 +114,21 @@ def create_combined_lambdas(lambdas: List[Callable]) -> Callable:
         # apply each lambda to the row and check if all return True
         return all(f(row) for f in lambdas)
 
+    if all(isinstance(f, MaskFilter) for f in lambdas):
+        keys = [get_filter_key(f) for f in lambdas]
+        key = ('and', frozenset(keys)) if None not in keys else None
+        return MaskFilter(filter_func, lambda df: create_combined_mask(lambdas, df), key=key)
+
     return filter_func
 
+def create_lambda_accept_all():
+    """
+    Create a filter that accepts every row. 
+    
+    Used as the initial filter of a new filter button.
+    """
+    return MaskFilter(lambda row: True, lambda df: np.ones(len(df), dtype=bool), key=('accept all',))
+
 def create_lambda_from_checklist(column: str, include_items: List[Union[str, int]]):
     """
     Create a lambda function to filter a DataFrame based on multiple conditions.
@@ -41,16 +138,27 @@ def create_lambda_from_checklist(column: str, include_items: List[Union[str, int
         include_items: A list of items to include from that column.
 
     Returns:
-        callable: A lambda function which when applied to a DataFrame, filters the DataFrame based 
-        on the conditions provided.
+        MaskFilter: A lambda function which when applied to a DataFrame, filters the DataFrame based 
+        on the conditions provided. Its `mask` method evaluates the filter with `Series.isin`.
 
     Usage:
     >>> lambda = construct_filter_lambda('Fruit',  ['Pear'])
     >>> filtered_df = df[df.apply(lambda, axis=1)]
+    >>> filtered_df = df[lambda.mask(df)]
     """
     def filter_func(row):
         return row[column] in include_items
-    return filter_func
+    
+    def mask_func(df):
+        return df[column].isin(include_items)
+    
+    try:
+        key = ('is in', column, frozenset(include_items))
+    except TypeError:
+        # unhashable items, the filter can't be cached
+        key = None
+
+    return MaskFilter(filter_func, mask_func, key=key)
 
 def create_lambda_from_expression(expr: str, allowed_vars: List[str]):
     """
@@ -76,18 +184,127 @@ def create_lambda_from_expression(expr: str, allowed_vars: List[str]):
     >>> expr = '((Fruit == "Apple") and (Year == 2023)) or (Quarter == 4)'
     >>> lambda_func = create_lambda_from_expression(expr, allowed_vars=['Fruit', 'Year', 'Quarter'])
     >>> filtered_df = df[df.apply(lambda_func, axis=1)]
+    >>> filtered_df = df[lambda_func.mask(df)]
 
     The filtered_df will contain only the rows where Fruit is "Apple" and Year is 2023,
     or where Quarter is 4.
 
+    Expressions can also use `in` / `not in` with a literal list, arithmetic (+ - * / // %) 
+    between columns and constants, `not`, and chained comparisons of any length, e.g.
+    `2022 <= Year < 2025 and Fruit not in ["Fig"] and Weight * 2 > Volume`.
+
     Note: The lambda function operates on a row-wise basis (i.e., axis=1 in df.apply()).
+    Its `mask` method evaluates the same expression column-wise.
     Each identifier in expr corresponds to a column in the DataFrame.
+    The expression is compiled once and memoized, see `compile_expression`.
     """
-    node = ast.parse(expr, mode='eval')
-    if not is_allowed(node, allowed_vars):
-        raise ValueError(f"Disallowed expression: {expr}")
+    compiled = compile_expression(expr, allowed_vars)
+    return MaskFilter(compiled.row, compiled.mask, key=compiled.key)
+
+def get_key_columns(key) -> set:
+    """
+    Return the names of the columns that the filter with this `key` reads.
+    """
+    kind = key[0]
+    if kind == 'accept all':
+        return set()
+    elif kind == 'is in':
+        return {key[1]}
+    elif kind == 'expression':
+        return {n.id for n in ast.walk(ast.parse(key[1], mode='eval')) if isinstance(n, ast.Name)}
+    elif kind == 'and':
+        return set().union(*[get_key_columns(k) for k in key[1]])
+    else:
+        raise ValueError(f"Unknown filter key: {key}")
+
+def get_filter_columns(filters: List[Callable]):
+    """
+    Return the names of the columns that a list of filters reads, or None if any filter is an opaque callable.
+    """
+    columns = set()
+    for f in filters or []:
+        key = get_filter_key(f)
+        if key is None:
+            return None
+        columns |= get_key_columns(key)
+    return columns
 
-    return ast_to_lambda(node)
+def create_filter_from_key(key) -> MaskFilter:
+    """
+    Rebuild a filter from its `key`.
+
+    Filters hold lambdas and can't be pickled, so this is how a filter is sent to another process.
+
+    Usage:
+    >>> f = create_lambda_from_checklist('Fruit', ['Pear'])
+    >>> g = create_filter_from_key(f.key)     # selects the same rows as f
+    """
+    kind = key[0]
+    if kind == 'accept all':
+        return create_lambda_accept_all()
+    elif kind == 'is in':
+        return create_lambda_from_checklist(key[1], list(key[2]))
+    elif kind == 'expression':
+        node = ast.parse(key[1], mode='eval')
+        names = [n.id for n in ast.walk(node) if isinstance(n, ast.Name)]
+        return create_lambda_from_expression(key[1], names)
+    elif kind == 'and':
+        return create_combined_lambdas([create_filter_from_key(k) for k in key[1]])
+    else:
+        raise ValueError(f"Unknown filter key: {key}")
+
+# comparison operators, with the operator to use when the operands are swapped
+COMPARE_OPS = {
+    ast.Lt: (op.lt, op.gt),
+    ast.LtE: (op.le, op.ge),
+    ast.Gt: (op.gt, op.lt),
+    ast.GtE: (op.ge, op.le),
+    ast.Eq: (op.eq, op.eq),
+    ast.NotEq: (op.ne, op.ne),
+}
+
+# membership tests, the right operand is a literal list, tuple or set
+MEMBERSHIP_OPS = (ast.In, ast.NotIn)
+
+# arithmetic between columns and constants
+BINARY_OPS = {
+    ast.Add: op.add,
+    ast.Sub: op.sub,
+    ast.Mult: op.mul,
+    ast.Div: op.truediv,
+    ast.FloorDiv: op.floordiv,
+    ast.Mod: op.mod,
+}
+
+UNARY_OPS = {
+    ast.USub: op.neg,
+    ast.UAdd: op.pos,
+}
+
+def is_literal_container(node) -> bool:
+    """
+    Check if a node is a list, tuple or set of constants, e.g. the right operand of `in`.
+    """
+    if not isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        return False
+    try:
+        ast.literal_eval(node)
+    except ValueError:
+        return False
+    return True
+
+def is_arithmetic_operand(node) -> bool:
+    """
+    Check if a node may be an operand of arithmetic: text constants may not, 
+    so that e.g. `"a" * 1000000000` can't allocate a huge string.
+    """
+    return not (isinstance(node, ast.Constant) and isinstance(node.value, (str, bytes)))
+
+def has_name(node) -> bool:
+    """
+    Check if a node refers to a field anywhere in its subtree.
+    """
+    return any(isinstance(child, ast.Name) for child in ast.walk(node))
 
 def is_allowed(node, allowed_vars):
     """
@@ -100,12 +317,21 @@ def is_allowed(node, allowed_vars):
     Returns:
     bool: True if the node is allowed, False otherwise.
     """
-    if isinstance(node, (ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)):
+    if isinstance(node, tuple(COMPARE_OPS) + MEMBERSHIP_OPS):
         return True
     elif isinstance(node, ast.BoolOp):
         return all(is_allowed(value, allowed_vars) for value in node.values)
     elif isinstance(node, ast.Compare):
-        return is_allowed(node.left, allowed_vars) and all(is_allowed(comp, allowed_vars) for comp in node.ops) and all(is_allowed(c, allowed_vars) for c in node.comparators)
+        # the right operand of `in` must be a literal, anything else must be an allowed operand
+        return is_allowed(node.left, allowed_vars) and all(is_allowed(comp, allowed_vars) for comp in node.ops) and \
+            all(is_literal_container(c) if isinstance(o, MEMBERSHIP_OPS) else is_allowed(c, allowed_vars) 
+                for o, c in zip(node.ops, node.comparators))
+    elif isinstance(node, ast.BinOp):
+        # arithmetic on constants alone is rejected, it would be evaluated once per row for nothing
+        return type(node.op) in BINARY_OPS and has_name(node) and \
+            all(is_arithmetic_operand(operand) and is_allowed(operand, allowed_vars) for operand in (node.left, node.right))
+    elif isinstance(node, ast.UnaryOp):
+        return (isinstance(node.op, ast.Not) or type(node.op) in UNARY_OPS) and is_allowed(node.operand, allowed_vars)
     elif isinstance(node, ast.Name):
         return node.id in allowed_vars
     elif isinstance(node, ast.Constant):
@@ -114,93 +340,215 @@ def is_allowed(node, allowed_vars):
         return is_allowed(node.body, allowed_vars)
     else:
         return False
-    
-def ast_to_lambda(node):
+
+class CompiledExpression:
     """
-    Convert an AST to a lambda function.
+    A validated filter expression, compiled once into a row-wise and a column-wise evaluator.
 
-    Parameters:
-    node (ast.AST): The AST node to convert.
+    The AST is walked only here: `row` and `mask` call a tree of prebuilt closures.
+    Use `compile_expression` to get one, it memoizes compiled expressions.
+
+    Usage:
+    >>> compiled = compile_expression('2022 < Year <= 2024 and Fruit in ["Apple", "Fig"]', ['Year', 'Fruit'])
+    >>> compiled.row(df.iloc[0])     # bool
+    >>> compiled.mask(df)            # boolean numpy array
+    """
+
+    def __init__(self, node: ast.Expression):
+        # the unparsed AST ignores whitespace and redundant parentheses in the expression
+        self.key = ('expression', ast.unparse(node))
+        self._row, self._column = compile_node(node.body)
+
+    def row(self, row) -> bool:
+        return bool(self._row(row))
+
+    def mask(self, df) -> np.ndarray:
+        return as_mask(self._column(df), len(df))
+
+@lru_cache(maxsize=256)
+def _compile_expression(expr: str, allowed_vars: Tuple[str, ...]) -> CompiledExpression:
+    node = ast.parse(expr, mode='eval')
+    if not is_allowed(node, allowed_vars):
+        raise ValueError(f"Disallowed expression: {expr}")
+    return CompiledExpression(node)
+
+def compile_expression(expr: str, allowed_vars: List[str]) -> CompiledExpression:
+    """
+    Validate and compile an expression, or return the compiled expression of an earlier call 
+    with the same text and allowed variables.
+
+    Raises:
+    ValueError: If the expression contains disallowed variables or operations.
+    """
+    return _compile_expression(expr, tuple(sorted(set(allowed_vars))))
+
+def as_mask(values, n: int) -> np.ndarray:
+    # a boolean array of length n, constants are broadcast
+    values = np.asarray(values, dtype=bool)
+    return np.broadcast_to(values, (n,)).copy() if values.ndim == 0 else values
+
+def get_values(operand):
+    """
+    Return the values of a column operand for arithmetic. Categoricals are decoded, and compact 
+    numeric columns (see PivotCompact) are widened to 64 bits, so that e.g. `Units * 10` can't wrap around.
+
+    Raises:
+    ValueError: If the column isn't numeric, e.g. `Fruit * 1000000000` would build huge strings.
+    """
+    if not isinstance(operand, pd.Series):
+        return operand
+    if isinstance(operand.dtype, pd.CategoricalDtype):
+        operand = pd.Series(operand.to_numpy(), index=operand.index, name=operand.name)
+    if not pd.api.types.is_numeric_dtype(operand.dtype):
+        raise ValueError(f"Arithmetic on the non-numeric field '{operand.name}'.")
+    return widen(operand)
+
+def get_row_value(value):
+    """
+    Return the value of one row for arithmetic, like `get_values`: numpy scalars become Python numbers.
+    """
+    if isinstance(value, np.generic):
+        value = value.item()
+    if not (isinstance(value, numbers.Number) or pd.isna(value)):
+        raise ValueError(f"Arithmetic on the non-numeric value {value!r}.")
+    return value
+
+def compile_node(node):
+    """
+    Compile an AST node of a validated expression.
 
     Returns:
-    function: A lambda function equivalent to the provided AST node.
+    (row_func, column_func): row_func(row) returns the value of the node for one row, 
+    column_func(df) returns it for every row of df, as a Series, an array or a constant.
     """
-    if isinstance(node, ast.Expression):
-        return ast_to_lambda(node.body)
+    if isinstance(node, ast.Constant):
+        value = node.value
+        return (lambda row: value), (lambda df: value)
+    elif isinstance(node, ast.Name):
+        name = node.id
+        return (lambda row: row[name]), (lambda df: df[name])
+    elif isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        values = tuple(ast.literal_eval(node))
+        return (lambda row: values), (lambda df: values)
+    elif isinstance(node, ast.BinOp):
+        func = BINARY_OPS[type(node.op)]
+        (left_row, left_column), (right_row, right_column) = compile_node(node.left), compile_node(node.right)
+        return (lambda row: func(get_row_value(left_row(row)), get_row_value(right_row(row))),
+                lambda df: func(get_values(left_column(df)), get_values(right_column(df))))
+    elif isinstance(node, ast.UnaryOp):
+        operand_row, operand_column = compile_node(node.operand)
+        if isinstance(node.op, ast.Not):
+            return (lambda row: not operand_row(row)), (lambda df: ~as_mask(operand_column(df), len(df)))
+        func = UNARY_OPS[type(node.op)]
+        return (lambda row: func(get_row_value(operand_row(row)))), (lambda df: func(get_values(operand_column(df))))
     elif isinstance(node, ast.BoolOp):
+        operands = [compile_node(value) for value in node.values]
+        rows = [row_func for row_func, _ in operands]
+        columns = [column_func for _, column_func in operands]
         if isinstance(node.op, ast.And):
-            return lambda row: all(ast_to_lambda(value)(row) for value in node.values)
+            return (lambda row: all(f(row) for f in rows), 
+                    lambda df: np.logical_and.reduce([as_mask(f(df), len(df)) for f in columns]))
         elif isinstance(node.op, ast.Or):
-            return lambda row: any(ast_to_lambda(value)(row) for value in node.values)
+            return (lambda row: any(f(row) for f in rows), 
+                    lambda df: np.logical_or.reduce([as_mask(f(df), len(df)) for f in columns]))
         else:
             raise ValueError(f"Unsupported boolean operator: {type(node.op)}")
     elif isinstance(node, ast.Compare):
-        if len(node.ops) == 1:
-            return make_compare_lambda(node.left, node.ops[0], node.comparators[0])
-        elif len(node.ops) == 2:
-            # print(ast.dump(node, indent=4))
-            # Compare(
-            #     left=Constant(value=2022),
-            #     ops=[
-            #         Lt(),
-            #         Lt()],
-            #     comparators=[
-            #         Name(id='Year', ctx=Load()),
-            #         Constant(value=2024)])
-            my_ast = ast.BoolOp(op=ast.And(),
-                values=[ast.Compare(left=node.left,
-                                    ops=[node.ops[0]],
-                                    comparators=[node.comparators[0]]),
-                        ast.Compare(left=node.comparators[0],
-                                    ops=[node.ops[1]],
-                                    comparators=[node.comparators[1]])])
-
-            return lambda row: ast_to_lambda(my_ast)(row)
-        else:
-            raise ValueError("More than two comparisons are not supported.")
+        return compile_compare(node)
     else:
         raise ValueError(f"Unsupported node type: {type(node)}")
-    
-def make_compare_lambda(left, op, right):
+
+def compile_compare(node: ast.Compare):
+    """
+    Compile a comparison with any number of operators, e.g. `a < b <= c != d`.
+    Like in Python, it is the AND of the pairwise comparisons, and each operand is evaluated once.
     """
-    Create a lambda function from a comparison AST node.
+    operands = [compile_node(operand) for operand in [node.left] + node.comparators]
+    rows = [row_func for row_func, _ in operands]
+    columns = [column_func for _, column_func in operands]
+    ops = [type(o) for o in node.ops]
+    for o in ops:
+        if o not in COMPARE_OPS and o not in MEMBERSHIP_OPS:
+            raise ValueError(f"Unsupported operator type: {o}")
+
+    def compare_row(left, o, right) -> bool:
+        if o is ast.In:
+            return left in right
+        elif o is ast.NotIn:
+            return left not in right
+        return COMPARE_OPS[o][0](left, right)
+
+    def row_func(row):
+        left = rows[0](row)
+        for o, f in zip(ops, rows[1:]):
+            right = f(row)
+            if not compare_row(left, o, right):
+                return False
+            left = right
+        return True
+
+    def column_func(df):
+        values = [f(df) for f in columns]
+        masks = [compare_operands(left, o, right, len(df)) for left, o, right in zip(values[:-1], ops, values[1:])]
+        return np.logical_and.reduce(masks)
+
+    return row_func, column_func
+
+def compare_operands(left, o, right, n: int) -> np.ndarray:
+    """
+    Compare two operands of a compiled expression column-wise.
+    """
+    if o in MEMBERSHIP_OPS:
+        if isinstance(left, (pd.Series, np.ndarray)):
+            mask = pd.Series(left, copy=False).isin(right).to_numpy()
+        else:
+            mask = left in right
+        return ~as_mask(mask, n) if o is ast.NotIn else as_mask(mask, n)
+
+    compare, swapped = COMPARE_OPS[o]
+    # a column compared with a constant is compared on its categories, see `compare_column`
+    if isinstance(left, pd.Series) and np.ndim(right) == 0:
+        return compare_column(left, compare, right)
+    if isinstance(right, pd.Series) and np.ndim(left) == 0:
+        return compare_column(right, swapped, left)
+    return as_mask(compare(get_values(left), get_values(right)), n)
+
+def ast_to_lambda(node):
+    """
+    Convert an AST to a lambda function.
 
     Parameters:
-    node (ast.Compare): The comparison AST node to convert.
+    node (ast.AST): The AST node to convert.
 
     Returns:
-    function: A lambda function equivalent to the provided comparison AST node.
-    """
-    if isinstance(left, ast.Name):
-        name = left.id
-        value = ast.literal_eval(right)
-    elif isinstance(right, ast.Name):
-        name = right.id
-        value = ast.literal_eval(left)
-        # Swap comparison operator for reversed operands
-        if isinstance(op, ast.Lt):
-            op = ast.Gt()
-        elif isinstance(op, ast.LtE):
-            op = ast.GtE()
-        elif isinstance(op, ast.Gt):
-            op = ast.Lt()
-        elif isinstance(op, ast.GtE):
-            op = ast.LtE()
-    else:
-        raise ValueError("Either left or right operand must be a column name.")
-
-    if isinstance(op, ast.Lt):
-        return lambda row: row[name] < value
-    elif isinstance(op, ast.LtE):
-        return lambda row: row[name] <= value
-    elif isinstance(op, ast.Gt):
-        return lambda row: row[name] > value
-    elif isinstance(op, ast.GtE):
-        return lambda row: row[name] >= value
-    elif isinstance(op, ast.Eq):
-        return lambda row: row[name] == value
-    elif isinstance(op, ast.NotEq):
-        return lambda row: row[name] != value
-    else:
-        raise ValueError(f"Unsupported operator type: {type(op)}")
+    MaskFilter: A lambda function equivalent to the provided AST node.
+    """
+    if not isinstance(node, ast.Expression):
+        node = ast.Expression(body=node)
+    compiled = CompiledExpression(node)
+    return MaskFilter(compiled.row, compiled.mask, key=compiled.key)
     
+
+def compare_column(series: pd.Series, compare: Callable, value) -> np.ndarray:
+    """
+    Compare every value of a column with a constant.
+
+    Categorical columns are compared on their categories, and each row then looks up 
+    the result by its category code. This compares by value even where pandas would 
+    refuse to compare a categorical, e.g. `Year < 100` when 100 is not a category.
+    """
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        category_mask = np.asarray(compare(series.cat.categories, value), dtype=bool)
+        # missing values have code -1, which picks the trailing result for a missing value
+        return np.append(category_mask, compare_missing(compare, value))[series.cat.codes.to_numpy()]
+    return np.asarray(compare(series, value), dtype=bool)
+
+def compare_missing(compare: Callable, value) -> bool:
+    """
+    Compare a missing value with a constant, as pandas does for plain columns: 
+    `NaN != x` is True and every other comparison is False.
+    """
+    try:
+        return bool(compare(np.nan, value))
+    except TypeError:
+        return False
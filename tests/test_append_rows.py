@@ -0,0 +1,91 @@
+import pandas as pd
+import numpy as np
+import pytest
+
+from swisscontrols.controls.PivotCtrl.DataSource import get_flat_data
+from swisscontrols.controls.PivotCtrl.PivotBroker import PivotBroker
+from swisscontrols.controls.UserScripts.user_scripts import create_lambda_from_expression
+
+CONFIGS = [
+    dict(rows=['Fruit'], cols=['(Data)', 'Year'], aggs=['Weight', 'Price/kg']),
+    dict(rows=['Fruit', 'Shape'], cols=['(Data)'], aggs=['Weight', 'Volume']),
+]
+
+def make_broker(df: pd.DataFrame, **kwargs) -> PivotBroker:
+    broker = PivotBroker(**kwargs)
+    broker.set_data(df)
+    return broker
+
+def get_batches(n_batches: int = 4, n_rows: int = 50) -> list:
+    batches = [get_flat_data(n_rows=n_rows, seed=seed) for seed in range(1, n_batches + 1)]
+    # a value that is new to the Fruit field
+    batches[-1].loc[0, 'Fruit'] = 'Durian'
+    return batches
+
+def test_append_does_not_concatenate_the_data(monkeypatch):
+    broker = make_broker(get_flat_data(n_rows=1000, seed=0))
+    for config in CONFIGS:
+        broker.get_pivot(filters=None, **config)
+    base = broker._df
+
+    concatenated = []
+    original_concat = pd.concat
+    def spy(objs, *args, **kwargs):
+        objs = list(objs)
+        concatenated.extend(obj for obj in objs if obj is base)
+        return original_concat(objs, *args, **kwargs)
+    monkeypatch.setattr(pd, 'concat', spy)
+
+    for batch in get_batches():
+        broker.append_rows(batch)
+        # cached configurations are served from the merged states
+        for config in CONFIGS:
+            broker.get_pivot(filters=None, **config)
+
+    assert not concatenated
+    assert len(broker._chunks) == 4
+
+@pytest.mark.parametrize('kwargs', [{}, {'cache_entries': 0}, {'compact': True}])
+def test_append_matches_a_full_rebuild(kwargs):
+    df = get_flat_data(n_rows=1000, seed=0)
+    broker = make_broker(df, **kwargs)
+    for config in CONFIGS:
+        broker.get_pivot(filters=None, **config)
+
+    batches = get_batches()
+    for batch in batches:
+        broker.append_rows(batch)
+
+    expected = make_broker(pd.concat([df] + batches, ignore_index=True), **kwargs)
+    for config in CONFIGS:
+        result = broker.get_pivot(filters=None, **config)
+        pd.testing.assert_frame_equal(result, expected.get_pivot(filters=None, **config), rtol=1e-5)
+    assert len(broker.df) == 1000 + sum(len(batch) for batch in batches)
+
+def test_append_queues_filter_masks():
+    df = get_flat_data(n_rows=1000, seed=0)
+    broker = make_broker(df)
+    f = create_lambda_from_expression('Weight > 0.5 and Fruit != "Apple"', ['Weight', 'Fruit'])
+    broker.get_filtered(f)
+    (_, (base,)), = broker.mask_cache._masks.values()
+
+    batches = get_batches()
+    for batch in batches:
+        broker.append_rows(batch)
+
+    # the cached mask is not copied on append, each batch gets a mask of its own
+    (_, parts), = broker.mask_cache._masks.values()
+    assert parts[0] is base
+    assert [len(part) for part in parts[1:]] == [len(batch) for batch in batches]
+
+    full = pd.concat([df] + batches, ignore_index=True)
+    hits = broker.mask_cache.hits
+    np.testing.assert_array_equal(broker.mask_cache.get_mask(f, broker.df), f.mask(full))
+    assert broker.mask_cache.hits == hits + 1
+    (_, parts), = broker.mask_cache._masks.values()
+    assert len(parts) == 1
+
+def test_append_rejects_missing_fields():
+    broker = make_broker(get_flat_data(n_rows=100, seed=0))
+    with pytest.raises(Exception, match='missing the fields'):
+        broker.append_rows(get_flat_data(n_rows=10, seed=1).drop(columns=['Weight']))
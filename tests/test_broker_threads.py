@@ -0,0 +1,73 @@
+import threading
+import time
+
+import pandas as pd
+
+from swisscontrols.controls.PivotCtrl.DataSource import get_flat_data
+from swisscontrols.controls.PivotCtrl.PivotBroker import PivotBroker
+
+CONFIG = dict(rows=['Fruit'], cols=['(Data)', 'Year'], aggs=['Weight', 'Price/kg'])
+
+def make_broker(df: pd.DataFrame, **kwargs) -> PivotBroker:
+    broker = PivotBroker(**kwargs)
+    broker.set_data(df)
+    return broker
+
+def make_blocking_filter():
+    # an opaque row filter that keeps the background pivot busy until `release` is set
+    started, release = threading.Event(), threading.Event()
+    def keep_row(row) -> bool:
+        started.set()
+        if not release.wait(timeout=5):
+            # don't hang the tests if the main thread is blocked
+            release.set()
+        return True
+    return keep_row, started, release
+
+def test_main_thread_is_not_blocked_by_a_background_pivot():
+    df = get_flat_data(n_rows=1000, seed=0)
+    broker = make_broker(df)
+    keep_row, started, release = make_blocking_filter()
+
+    try:
+        future = broker.get_pivot_async(filters=[keep_row], **CONFIG)
+        assert started.wait(timeout=10)
+
+        start = time.perf_counter()
+        counts = broker.get_unique_counts('Fruit')
+        deltas = broker.append_rows(get_flat_data(n_rows=50, seed=1))
+        assert time.perf_counter() - start < 1
+        assert not future.done()
+        assert counts.sum() == len(df)
+        assert deltas == []
+    finally:
+        release.set()
+
+    # the background result is of the data it started on
+    expected = make_broker(df).get_pivot(filters=None, **CONFIG)
+    pd.testing.assert_frame_equal(future.result(timeout=10), expected)
+    broker.shutdown()
+
+def test_results_of_changed_data_are_not_cached():
+    df = get_flat_data(n_rows=1000, seed=0)
+    batch = get_flat_data(n_rows=50, seed=1)
+    broker = make_broker(df)
+    keep_row, started, release = make_blocking_filter()
+
+    try:
+        future = broker.get_pivot_async(filters=[keep_row], **CONFIG)
+        assert started.wait(timeout=10)
+        broker.append_rows(batch)
+    finally:
+        release.set()
+    future.result(timeout=10)
+
+    assert len(broker.cache) == 0
+    assert len(broker.states_cache) == 0
+    assert len(broker.mask_cache) == 0
+
+    # the same filter now sees the appended rows
+    result = broker.get_pivot(filters=[keep_row], **CONFIG)
+    expected = make_broker(pd.concat([df, batch], ignore_index=True)).get_pivot(filters=None, **CONFIG)
+    pd.testing.assert_frame_equal(result, expected)
+    broker.shutdown()
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from swisscontrols.controls.PivotCtrl.DataSource import get_flat_data, get_field_data
+from swisscontrols.controls.PivotCtrl.PivotBroker import PivotBroker
+from swisscontrols.controls.PivotCtrl.PivotField import PivotField, PivotFieldType
+from swisscontrols.controls.UserScripts.user_scripts import create_lambda_from_checklist, create_lambda_from_expression
+
+# 'Price/kg' is a weighted average, the others are distinct counts and quantiles
+AGGS = ['Weight', 'Price/kg', 'Customer', 'Label', 'Size', 'Volume']
+
+def make_data(n_rows: int = 5000, seed: int = 0) -> pd.DataFrame:
+    df = get_flat_data(n_rows=n_rows, seed=seed)
+    rng = np.random.default_rng(seed)
+    df['Customer'] = rng.integers(0, 400, n_rows)
+    df['Size'] = rng.lognormal(size=n_rows)
+    df['Label'] = pd.Series(rng.choice(np.array(['a', 'b', 'c', None], dtype=object), n_rows), dtype=object)
+    return df
+
+def make_broker(df: pd.DataFrame, chunk_rows: int = None) -> PivotBroker:
+    broker = PivotBroker(chunk_rows=chunk_rows)
+    field_data = get_field_data()
+    field_data['Customer'] = PivotField('Customer', PivotFieldType.Aggregate.DISTINCT_COUNT)
+    field_data['Label'] = PivotField('Label', PivotFieldType.Aggregate.DISTINCT_COUNT)
+    field_data['Size'] = PivotField('Size', PivotFieldType.Aggregate.MEDIAN)
+    field_data['Volume'] = PivotField('Volume', PivotFieldType.Aggregate.PERCENTILE, percentile=90)
+    broker.field_data = field_data
+    broker.set_data(df)
+    return broker
+
+def get_filters():
+    return {
+        'none': None,
+        'checklist': [create_lambda_from_checklist('Shape', ['Star', 'Cone', 'Round'])],
+        'expression': [create_lambda_from_expression('Weight > 0.3 and Customer < 300', ['Weight', 'Customer'])],
+        'opaque': [lambda row: row['Volume'] > 0.4],
+    }
+
+# blocks that split the data unevenly, blocks that the filters leave empty, and one block for all rows
+@pytest.mark.parametrize('chunk_rows', [777, 2, 10_000])
+@pytest.mark.parametrize('filter_name', list(get_filters()))
+def test_chunked_pivots_match_unchunked(chunk_rows, filter_name):
+    df = make_data(n_rows=150 if chunk_rows == 2 else 5000)
+    filters = get_filters()[filter_name]
+    unchunked, chunked = make_broker(df), make_broker(df, chunk_rows=chunk_rows)
+    for rows, cols in [(['Fruit'], ['(Data)', 'Year']), (['Fruit', 'Shape'], ['(Data)']), ([], ['(Data)'])]:
+        expected = unchunked.get_pivot(filters=filters, rows=rows, cols=cols, aggs=AGGS)
+        result = chunked.get_pivot(filters=filters, rows=rows, cols=cols, aggs=AGGS)
+        assert len(expected) > 0
+        pd.testing.assert_frame_equal(result, expected)
+
+@pytest.mark.parametrize('filter_name', list(get_filters()))
+def test_chunked_unique_counts_match_unchunked(filter_name):
+    df = make_data()
+    filters = get_filters()[filter_name]
+    unchunked, chunked = make_broker(df), make_broker(df, chunk_rows=777)
+    for field in ('Fruit', 'Year', 'Customer'):
+        pd.testing.assert_series_equal(chunked.get_unique_counts(field, filters), unchunked.get_unique_counts(field, filters))
+
+def test_chunked_pivots_follow_appended_rows():
+    df, batch = make_data(), make_data(n_rows=500, seed=1)
+    config = dict(filters=get_filters()['checklist'], rows=['Fruit'], cols=['(Data)'], aggs=AGGS)
+    chunked = make_broker(df, chunk_rows=777)
+    chunked.get_pivot(**config)
+    chunked.append_rows(batch)
+    expected = make_broker(pd.concat([df, batch], ignore_index=True)).get_pivot(**config)
+    pd.testing.assert_frame_equal(chunked.get_pivot(**config), expected)
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from swisscontrols.controls.PivotCtrl.DataSource import get_flat_data, get_field_data
+from swisscontrols.controls.PivotCtrl.PivotBroker import PivotBroker
+from swisscontrols.controls.PivotCtrl.PivotCompact import FLOAT32_RTOL
+from swisscontrols.controls.PivotCtrl.PivotField import PivotField, PivotFieldType
+from swisscontrols.controls.UserScripts.user_scripts import (create_combined_mask, create_lambda_from_checklist,
+                                                              create_lambda_from_expression)
+
+AGGS = ['Weight', 'Price/kg', 'Units', 'Customer', 'Label', 'Size', 'Volume']
+
+def make_data(n_rows: int = 2000, seed: int = 0) -> pd.DataFrame:
+    df = get_flat_data(n_rows=n_rows, seed=seed)
+    rng = np.random.default_rng(seed)
+    df['Units'] = rng.integers(0, 200, n_rows)
+    df['Customer'] = rng.integers(0, 300, n_rows)
+    df['Size'] = rng.lognormal(size=n_rows)
+    df['Label'] = pd.Series(rng.choice(np.array(['a', 'b', 'c', None], dtype=object), n_rows), dtype=object)
+    df['Note'] = pd.Series([f"note {i % 7}" for i in range(n_rows)], dtype=pd.StringDtype('python', na_value=np.nan))
+    return df
+
+def make_field_data():
+    field_data = get_field_data()
+    field_data['Units'] = PivotField('Units', PivotFieldType.Aggregate.SUM)
+    field_data['Customer'] = PivotField('Customer', PivotFieldType.Aggregate.DISTINCT_COUNT)
+    field_data['Label'] = PivotField('Label', PivotFieldType.Aggregate.DISTINCT_COUNT)
+    field_data['Size'] = PivotField('Size', PivotFieldType.Aggregate.MEDIAN)
+    field_data['Volume'] = PivotField('Volume', PivotFieldType.Aggregate.PERCENTILE, percentile=90)
+    return field_data
+
+def make_broker(df: pd.DataFrame, compact: bool) -> PivotBroker:
+    broker = PivotBroker(compact=compact)
+    broker.field_data = make_field_data()
+    broker.set_data(df)
+    return broker
+
+def get_filters():
+    return {
+        'none': None,
+        'checklist': [create_lambda_from_checklist('Shape', ['Star', 'Cone', 'Round'])],
+        'compare': [create_lambda_from_expression('Weight > 0.5 and Units < 120', ['Weight', 'Units'])],
+        'arithmetic': [create_lambda_from_expression('Units * 10 > 1000 or -Units < -190', ['Units'])],
+        'opaque': [lambda row: row['Units'] * 10 > 1000],
+    }
+
+@pytest.mark.parametrize('filter_name', list(get_filters()))
+@pytest.mark.parametrize('rows, cols', [(['Fruit'], ['(Data)', 'Year']), (['Fruit', 'Shape'], ['(Data)']), ([], ['(Data)'])])
+def test_compact_pivots_match_full_width(filter_name, rows, cols):
+    df = make_data()
+    filters = get_filters()[filter_name]
+    full, compact = (make_broker(df, compact).get_pivot(filters=filters, rows=rows, cols=cols, aggs=AGGS)
+                     for compact in (False, True))
+    assert compact.shape == full.shape and len(full)
+    # sums of float32 values are within FLOAT32_RTOL * sum(|x|), the data is positive
+    np.testing.assert_allclose(compact.to_numpy(float), full.to_numpy(float), rtol=4 * FLOAT32_RTOL)
+
+def test_compact_dtypes():
+    df = make_data()
+    broker = make_broker(df, compact=True)
+    stored = broker.df
+    assert stored['Units'].dtype == np.uint8
+    assert stored['Customer'].dtype == np.uint16
+    assert stored['Weight'].dtype == np.float32
+    # equal strings share one object
+    assert len({id(value) for value in stored['Label'].dropna()}) == 3
+    assert stored['Note'].dtype == df['Note'].dtype
+    assert len({id(value) for value in stored['Note'].array._ndarray}) == 7
+    assert broker.compact_report.ratio > 1
+
+def test_opaque_filters_see_wide_values():
+    df = make_data()
+    # a numeric frame hands numpy scalars of the column dtype to row filters
+    stored = make_broker(df, compact=True).df[['Units']]
+    f = lambda row: row['Units'] * 10 > 1000
+    np.testing.assert_array_equal(create_combined_mask([f], stored), df['Units'].to_numpy() * 10 > 1000)
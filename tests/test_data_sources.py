@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from swisscontrols.controls.PivotCtrl.DataSource import (CsvDataSource, FeatherDataSource, LoadStats, ParquetDataSource,
+                                                         get_field_data, get_flat_data)
+from swisscontrols.controls.PivotCtrl.PivotBroker import PivotBroker
+from swisscontrols.controls.PivotCtrl.PivotField import PivotFieldType
+
+N_ROWS = 2000
+
+@pytest.fixture(scope='module')
+def flat_data():
+    return get_flat_data(n_rows=N_ROWS, seed=0)
+
+@pytest.fixture(scope='module')
+def sources(flat_data, tmp_path_factory):
+    path = tmp_path_factory.mktemp('sources')
+    flat_data.to_csv(path / 'data.csv', index=False)
+    sources = {
+        # small chunks, so that the categories of the chunks are merged
+        'csv': CsvDataSource(str(path / 'data.csv'), chunksize=300),
+        'csv with dtypes': CsvDataSource(str(path / 'data.csv'), dtype={'Fruit': 'category', 'Year': np.int64}, chunksize=300),
+    }
+    try:
+        flat_data.to_parquet(path / 'data.parquet')
+        flat_data.to_feather(path / 'data.feather')
+    except ImportError:
+        # Parquet and Feather need pyarrow, see `get_source`
+        return sources
+    sources['parquet'] = ParquetDataSource(str(path / 'data.parquet'))
+    sources['feather'] = FeatherDataSource(str(path / 'data.feather'))
+    return sources
+
+SOURCE_NAMES = ['csv', 'csv with dtypes', 'parquet', 'feather']
+
+def get_source(sources, name: str):
+    if name not in sources:
+        pytest.skip("pyarrow is not installed")
+    return sources[name]
+
+def make_broker(df: pd.DataFrame) -> PivotBroker:
+    broker = PivotBroker()
+    broker.set_data(df)
+    return broker
+
+@pytest.mark.parametrize('source_name', SOURCE_NAMES)
+def test_loaded_data_round_trips(flat_data, sources, source_name):
+    df = get_source(sources, source_name).load()
+    assert list(df.columns) == list(flat_data.columns)
+    assert isinstance(df.index, pd.RangeIndex) and len(df) == N_ROWS
+    for name in flat_data.columns:
+        expected = flat_data[name]
+        if pd.api.types.is_numeric_dtype(expected.dtype):
+            pd.testing.assert_series_equal(df[name], expected)
+            continue
+        # text comes back as str, or as categories from CSV files, with the same values
+        if source_name.startswith('csv'):
+            assert isinstance(df[name].dtype, pd.CategoricalDtype), name
+        assert list(df[name].astype(object)) == list(expected)
+
+    columns = get_source(sources, source_name).load(columns=['Weight', 'Fruit'])
+    assert list(columns.columns) == ['Weight', 'Fruit'] and len(columns) == N_ROWS
+
+@pytest.mark.parametrize('source_name', SOURCE_NAMES)
+def test_broker_encodes_loaded_data_like_flat_data(flat_data, sources, source_name):
+    expected = make_broker(flat_data).df
+    broker = PivotBroker(data_source=get_source(sources, source_name))
+    for name, dtype in expected.dtypes.items():
+        loaded = broker.df[name].dtype
+        if isinstance(dtype, pd.CategoricalDtype):
+            assert isinstance(loaded, pd.CategoricalDtype), name
+            assert list(loaded.categories) == list(dtype.categories) and loaded.ordered == dtype.ordered, name
+        else:
+            assert loaded == dtype, name
+    config = dict(filters=None, rows=['Fruit', 'Shape'], cols=['(Data)', 'Year'], aggs=['Weight', 'Volume'])
+    pd.testing.assert_frame_equal(broker.get_pivot(**config), make_broker(flat_data).get_pivot(**config), check_categorical=False)
+
+@pytest.mark.parametrize('source_name', SOURCE_NAMES)
+def test_inferred_field_types(sources, source_name):
+    field_data = get_source(sources, source_name).get_field_data()
+    assert list(field_data) == list(get_flat_data(n_rows=1).columns)
+    for name, field in get_field_data().items():
+        # a weighted average can't be told from a sum by its dtype
+        expected = PivotFieldType.Aggregate.SUM if name == 'Price/kg' else field.field_type
+        assert field_data[name].field_type == expected, name
+
+@pytest.mark.parametrize('source_name', SOURCE_NAMES)
+def test_load_stats(sources, source_name):
+    source = get_source(sources, source_name)
+    df, stats = source.load_with_stats()
+    assert isinstance(stats, LoadStats)
+    assert (stats.source, stats.rows, stats.columns) == (repr(source), N_ROWS, len(df.columns))
+    assert stats.memory_bytes == df.memory_usage(index=True, deep=True).sum()
+    assert stats.seconds > 0
+    if stats.peak_rss_bytes is not None:
+        assert stats.peak_rss_bytes > 0 and stats.peak_rss_increase_bytes >= 0
+
+    broker = PivotBroker(data_source=source)
+    assert broker.load_stats.rows == N_ROWS and broker.load_stats.source == repr(source)
@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from swisscontrols.controls.PivotCtrl.DataSource import get_flat_data, get_field_data
+from swisscontrols.controls.PivotCtrl.PivotBroker import PivotBroker
+from swisscontrols.controls.PivotCtrl.PivotField import PivotField, PivotFieldType
+from swisscontrols.controls.UserScripts.user_scripts import create_lambda_from_checklist, create_lambda_from_expression
+
+AGGS = ['Weight', 'Price/kg', 'Customer', 'Label', 'Size']
+
+def make_data(n_rows: int = 3000, seed: int = 0) -> pd.DataFrame:
+    df = get_flat_data(n_rows=n_rows, seed=seed)
+    rng = np.random.default_rng(seed)
+    df['Customer'] = rng.integers(0, 300, n_rows)
+    df['Size'] = rng.lognormal(size=n_rows)
+    df['Label'] = pd.Series(rng.choice(np.array(['a', 'b', 'c', None], dtype=object), n_rows), dtype=object)
+    df['Note'] = pd.Series([f"note {i % 7}" for i in range(n_rows)], dtype=str)
+    df['Unused'] = rng.random(n_rows)
+    return df
+
+def make_broker(df: pd.DataFrame, n_workers: int = 1) -> PivotBroker:
+    broker = PivotBroker(n_workers=n_workers)
+    if broker.parallel is not None:
+        broker.parallel.min_shard_rows = 500
+    field_data = get_field_data()
+    field_data['Customer'] = PivotField('Customer', PivotFieldType.Aggregate.DISTINCT_COUNT)
+    field_data['Label'] = PivotField('Label', PivotFieldType.Aggregate.DISTINCT_COUNT)
+    field_data['Size'] = PivotField('Size', PivotFieldType.Aggregate.MEDIAN)
+    broker.field_data = field_data
+    broker.set_data(df)
+    return broker
+
+def get_filters():
+    return {
+        'none': None,
+        'checklist': [create_lambda_from_checklist('Shape', ['Star', 'Cone', 'Round'])],
+        'string expression': [create_lambda_from_expression('Note in ["note 1", "note 3"] and Weight > 0.2', ['Note', 'Weight'])],
+        'opaque': [lambda row: row['Customer'] % 3 == 0],
+    }
+
+@pytest.fixture(scope='module')
+def brokers():
+    df = make_data()
+    serial, parallel = make_broker(df), make_broker(df, n_workers=2)
+    yield serial, parallel
+    parallel.shutdown()
+    serial.shutdown()
+
+@pytest.mark.parametrize('filter_name', list(get_filters()))
+@pytest.mark.parametrize('rows, cols', [(['Fruit'], ['(Data)', 'Year']), (['Fruit', 'Shape'], ['(Data)'])])
+def test_parallel_pivots_match_serial(brokers, filter_name, rows, cols):
+    serial, parallel = brokers
+    filters = get_filters()[filter_name]
+    expected = serial.get_pivot(filters=filters, rows=rows, cols=cols, aggs=AGGS)
+    result = parallel.get_pivot(filters=filters, rows=rows, cols=cols, aggs=AGGS)
+    assert parallel.parallel.get_n_shards(len(parallel.df)) == 2
+    pd.testing.assert_frame_equal(result, expected)
+
+def test_only_the_read_columns_are_shared():
+    df = make_data()
+    broker = make_broker(df, n_workers=2)
+    try:
+        broker.get_pivot(filters=get_filters()['checklist'], rows=['Fruit'], cols=['(Data)'], aggs=['Weight'])
+        assert set(broker.parallel._frame.columns) == {'Fruit', 'Shape', 'Weight'}
+
+        # a string column is shared as codes, only its unique values are sent to the workers
+        filters = get_filters()['string expression']
+        broker.get_pivot(filters=filters, rows=['Fruit'], cols=['(Data)'], aggs=['Label'])
+        frame = broker.parallel._frame
+        assert set(frame.columns) == {'Fruit', 'Shape', 'Weight', 'Label', 'Note'}
+        spec = frame.get_spec(['Note', 'Label'])
+        assert [len(column['uniques']) for column in spec['columns']] == [7, 3]
+        assert all(np.dtype(column['dtype']).kind == 'i' for column in spec['columns'])
+
+        # new data drops the shared columns
+        broker.append_rows(make_data(n_rows=100, seed=1))
+        result = broker.get_pivot(filters=None, rows=['Fruit'], cols=['(Data)'], aggs=['Weight'])
+        assert set(broker.parallel._frame.columns) == {'Fruit', 'Weight'}
+        np.testing.assert_allclose(result['Weight'].sum(), broker.df['Weight'].sum())
+    finally:
+        broker.shutdown()
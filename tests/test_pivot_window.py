@@ -0,0 +1,84 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from swisscontrols.controls.PivotCtrl.DataSource import get_flat_data
+from swisscontrols.controls.PivotCtrl.PivotBroker import PivotBroker
+
+AGGS = ['Weight', 'Price/kg']
+LAYOUTS = {
+    'data in cols': dict(rows=['Fruit', 'Shape'], cols=['(Data)', 'Year']),
+    'data last': dict(rows=['Fruit'], cols=['Year', 'Quarter', '(Data)']),
+    'data in rows': dict(rows=['Fruit', '(Data)'], cols=['Year']),
+    'data alone in rows': dict(rows=['(Data)'], cols=['Shape', 'Vibe']),
+    'no row fields': dict(rows=[], cols=['(Data)', 'Shape']),
+}
+RANGES = [((0, 5), (0, 3)), ((3, 17), (2, 40)), ((-4, 2), None), ((10_000, 20_000), (1, 1)), ((7, 3), (5, 8))]
+
+@pytest.fixture(scope='module')
+def broker():
+    # few rows over many groups, so that the dense table has empty cells
+    broker = PivotBroker()
+    broker.set_data(get_flat_data(n_rows=300, cardinality={'Fruit': 30}, seed=0))
+    return broker
+
+def clip(index_range: tuple, n: int) -> tuple:
+    # out of range windows are clipped to the result, and empty if they end before they start
+    start = min(max(index_range[0], 0), n)
+    return (start, min(max(index_range[1], start), n))
+
+def get_spans(labels: list) -> list:
+    # runs of equal labels of a level and every level above it
+    keys = list(zip(*labels))
+    spans = []
+    for depth in range(1, len(labels) + 1):
+        level_spans, start = [], 0
+        for _, run in itertools.groupby(keys, key=lambda key: key[:depth]):
+            n = len(list(run))
+            level_spans.append([start, start + n])
+            start += n
+        spans.append(np.array(level_spans, dtype=np.intp).reshape(-1, 2))
+    return spans
+
+@pytest.mark.parametrize('totals', [False, True])
+@pytest.mark.parametrize('sparse', [False, True])
+@pytest.mark.parametrize('layout_name', list(LAYOUTS))
+def test_windows_are_slices_of_the_pivot(broker, layout_name, sparse, totals):
+    config = dict(filters=None, aggs=AGGS, totals=totals, **LAYOUTS[layout_name])
+    full = broker.get_pivot(**config)
+    for row_range, col_range in RANGES:
+        window = broker.get_pivot_window(row_range=row_range, col_range=col_range, sparse=sparse, **config)
+        assert window.shape == full.shape
+
+        rows, cols = clip(row_range, full.shape[0]), clip(col_range or (0, full.shape[1]), full.shape[1])
+        assert (window.row_range, window.col_range) == (rows, cols)
+        expected = full.iloc[rows[0]:rows[1], cols[0]:cols[1]]
+        pd.testing.assert_frame_equal(window.data, expected)
+
+@pytest.mark.parametrize('totals', [False, True])
+@pytest.mark.parametrize('layout_name', list(LAYOUTS))
+def test_layout_and_result_match_the_pivot(broker, layout_name, totals):
+    config = dict(filters=None, aggs=AGGS, totals=totals, **LAYOUTS[layout_name])
+    full = broker.get_pivot(**config)
+    layout = broker.get_pivot_layout(**config)
+    assert layout.shape == full.shape
+    np.testing.assert_array_equal(layout.to_array(), full.to_numpy(dtype=float))
+
+    result = broker.get_pivot_result(**config)
+    np.testing.assert_array_equal(result.values, full.to_numpy(dtype=float))
+    assert list(result.row_index) == list(full.index) and list(result.col_index) == list(full.columns)
+    assert result.row_names == list(full.index.names) and result.col_names == list(full.columns.names)
+
+    for labels, spans, index in [(result.row_labels, result.row_spans, full.index), (result.col_labels, result.col_spans, full.columns)]:
+        expected_labels = [index.get_level_values(i) for i in range(index.nlevels)]
+        assert [list(level) for level in labels] == [list(level) for level in expected_labels]
+        for level_spans, expected in zip(spans, get_spans(expected_labels)):
+            np.testing.assert_array_equal(level_spans, expected)
+
+    # one label per header cell, at the start of its span
+    for compact, labels, level_spans in zip(result.compact_labels(axis=0), result.row_labels, result.row_spans):
+        starts = level_spans[:, 0]
+        assert list(compact[starts]) == list(labels[starts])
+        assert (np.delete(compact, starts) == '').all()
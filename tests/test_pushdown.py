@@ -0,0 +1,112 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+pa = pytest.importorskip('pyarrow')
+import pyarrow.feather
+import pyarrow.parquet
+
+from swisscontrols.controls.PivotCtrl.DataSource import (FeatherDataSource, ParquetDataSource, apply_filters, get_arrow_filter,
+                                                         get_field_data, get_flat_data)
+from swisscontrols.controls.PivotCtrl.PivotBroker import PivotBroker
+from swisscontrols.controls.PivotCtrl.PivotField import PivotField, PivotFieldType
+from swisscontrols.controls.UserScripts.user_scripts import (create_combined_lambdas, create_lambda_from_checklist,
+                                                              create_lambda_from_expression)
+
+CONFIGS = [
+    dict(rows=['Fruit'], cols=['(Data)', 'Year'], aggs=['Weight', 'Price/kg', 'Units']),
+    dict(rows=['Shape', 'Label'], cols=['(Data)'], aggs=['Volume']),
+]
+
+def make_data(n_rows: int = 3000, seed: int = 0) -> pd.DataFrame:
+    df = get_flat_data(n_rows=n_rows, seed=seed)
+    rng = np.random.default_rng(seed)
+    # missing values in a numeric and a text column
+    df['Units'] = rng.integers(0, 100, n_rows).astype(float)
+    df.loc[rng.random(n_rows) < 0.1, 'Units'] = np.nan
+    df['Label'] = pd.Series(rng.choice(np.array(['a', 'b', 'c', None], dtype=object), n_rows), dtype=object)
+    return df
+
+def make_field_data():
+    field_data = get_field_data()
+    field_data['Units'] = PivotField('Units', PivotFieldType.Aggregate.SUM)
+    field_data['Label'] = PivotField('Label', PivotFieldType.GroupBy.CATEGORY)
+    return field_data
+
+def get_filters():
+    expression = lambda text, columns: [create_lambda_from_expression(text, columns)]
+    return {
+        'none': None,
+        'checklist': [create_lambda_from_checklist('Fruit', ['Apple', 'Fig'])],
+        'compare with nulls': expression('Units >= 50', ['Units']),
+        'chained compare': expression('0.2 < Weight <= 0.7 and 2022 < Year', ['Weight', 'Year']),
+        'membership': expression('Label in ["a", "b"] or Year in (2025,)', ['Label', 'Year']),
+        'not equal': expression('Label != "a" and Units != 10', ['Label', 'Units']),
+        'not in': expression('Label not in ["c"]', ['Label']),
+        'arithmetic': expression('Fruit == "Pear" and Weight * 2 > Volume', ['Fruit', 'Weight', 'Volume']),
+        'and': [create_combined_lambdas([create_lambda_from_checklist('Vibe', ['Chill']),
+                                         create_lambda_from_expression('Quarter > 1', ['Quarter'])])],
+        'opaque': [lambda row: row['Volume'] > 0.5, create_lambda_from_checklist('Shape', ['Star', 'Cone'])],
+    }
+
+def assert_same_pivot(result: pd.DataFrame, expected: pd.DataFrame):
+    # scanned GroupBy fields have the categories of the scanned rows only
+    pd.testing.assert_frame_equal(result, expected, check_categorical=False)
+    assert len(expected) > 0
+
+@pytest.fixture(scope='module')
+def sources(tmp_path_factory):
+    df = make_data()
+    path = tmp_path_factory.mktemp('pushdown')
+    # small row groups, so that Parquet statistics skip some of them
+    pa.parquet.write_table(pa.Table.from_pandas(df), path / 'data.parquet', row_group_size=500)
+    pa.feather.write_feather(df, path / 'data.feather')
+    return {
+        'parquet': ParquetDataSource(str(path / 'data.parquet'), field_data=make_field_data()),
+        'feather': FeatherDataSource(str(path / 'data.feather'), field_data=make_field_data()),
+    }
+
+def test_exact_filters_are_not_applied_again():
+    filters = get_filters()
+    for name in ('checklist', 'compare with nulls', 'chained compare', 'membership', 'and'):
+        expression, residual = get_arrow_filter(filters[name])
+        assert expression is not None and residual == [], name
+    # missing values compare differently in pandas and Arrow, arithmetic can't be pushed down
+    for name in ('not equal', 'not in'):
+        assert get_arrow_filter(filters[name]) == (None, filters[name])
+    expression, residual = get_arrow_filter(filters['arithmetic'])
+    assert expression is not None and residual == filters['arithmetic']
+
+@pytest.mark.parametrize('source_name', ['parquet', 'feather'])
+@pytest.mark.parametrize('filter_name', list(get_filters()))
+def test_scan_matches_filtering_in_memory(sources, source_name, filter_name):
+    source = sources[source_name]
+    filters = get_filters()[filter_name]
+    columns = ['Fruit', 'Label', 'Units', 'Weight']
+    expected = apply_filters(source.load(), filters, columns)
+    result = source.scan(columns=columns, filters=filters)
+    assert len(expected) > 0
+    pd.testing.assert_frame_equal(result, expected)
+
+@pytest.mark.parametrize('source_name', ['parquet', 'feather'])
+def test_pushdown_pivots_match_loaded_data(sources, source_name):
+    source = sources[source_name]
+    loaded, pushdown = PivotBroker(data_source=source), PivotBroker(data_source=source, pushdown=True)
+    for filters in get_filters().values():
+        for config in CONFIGS:
+            assert_same_pivot(pushdown.get_pivot(filters=filters, **config), loaded.get_pivot(filters=filters, **config))
+    assert pushdown._df is None
+
+@pytest.mark.parametrize('source_name', ['parquet', 'feather'])
+def test_append_rows_after_a_pushdown_pivot(sources, source_name):
+    source = sources[source_name]
+    batch = make_data(n_rows=200, seed=1)
+    loaded, pushdown = PivotBroker(data_source=source), PivotBroker(data_source=source, pushdown=True)
+    filters = get_filters()['membership']
+    pushdown.get_pivot(filters=filters, **CONFIGS[0])
+
+    pushdown.append_rows(batch)
+    loaded.append_rows(batch)
+    for filters in get_filters().values():
+        for config in CONFIGS:
+            assert_same_pivot(pushdown.get_pivot(filters=filters, **config), loaded.get_pivot(filters=filters, **config))
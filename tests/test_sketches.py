@@ -0,0 +1,107 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from swisscontrols.controls.PivotCtrl.DataSource import get_flat_data, get_field_data
+from swisscontrols.controls.PivotCtrl.PivotBroker import PivotBroker
+from swisscontrols.controls.PivotCtrl.PivotField import PivotField, PivotFieldType
+from swisscontrols.controls.PivotCtrl.PivotSketch import (HLL_PRECISION, KLL_CAPACITY, DistinctSet, ExactQuantiles,
+                                                          HyperLogLog, QuantileSketch, merge_summaries)
+
+# three standard errors, see the notes of PivotSketch
+HLL_TOLERANCE = 3 * 1.04 / np.sqrt(2**HLL_PRECISION)
+QUANTILES = np.linspace(0.01, 0.99, 99)
+
+def get_rank_error(sketch: QuantileSketch, values: np.ndarray) -> float:
+    # the largest distance between requested and returned rank, as a fraction of the values
+    values = np.sort(values)
+    ranks = np.searchsorted(values, [sketch.quantile(q) for q in QUANTILES])
+    return float(np.max(np.abs(ranks - QUANTILES * len(values))) / len(values))
+
+def get_rank_bound(n: int) -> float:
+    # the worst case bound of the module notes, as a fraction of n
+    return np.log2(n / KLL_CAPACITY) / KLL_CAPACITY
+
+@pytest.mark.parametrize('n', [100, 5_000, 200_000])
+def test_hll_relative_error(n):
+    values = np.random.default_rng(n).permutation(n * 4)[:n]
+    estimate = HyperLogLog.from_values(np.concatenate([values, values[:n // 2]])).count()
+    assert abs(estimate / n - 1) < HLL_TOLERANCE
+
+def test_hll_merge_equals_one_sketch():
+    values = np.random.default_rng(0).integers(0, 50_000, 100_000)
+    parts = np.array_split(values, 7)
+    merged = merge_summaries([HyperLogLog.from_values(part) for part in parts])
+    np.testing.assert_array_equal(merged.registers, HyperLogLog.from_values(values).registers)
+
+@pytest.mark.parametrize('n', [10_000, 1_000_000])
+def test_kll_rank_error(n):
+    rng = np.random.default_rng(n)
+    for values in (rng.random(n), rng.lognormal(size=n), np.arange(n, dtype=float)):
+        sketch = QuantileSketch.from_values(values)
+        assert get_rank_error(sketch, values) < get_rank_bound(n)
+        assert sketch.nbytes < 8 * KLL_CAPACITY * (np.log2(n / KLL_CAPACITY) + 2)
+
+def test_kll_merge_is_as_accurate_as_one_sketch():
+    values = np.random.default_rng(0).normal(size=300_000)
+    merged = merge_summaries([QuantileSketch.from_values(part) for part in np.array_split(values, 10)])
+    assert get_rank_error(merged, values) < get_rank_bound(len(values))
+    # compactions keep the total weight
+    assert sum(len(level) * 2**h for h, level in enumerate(merged.levels)) == len(values)
+
+def test_kll_is_deterministic():
+    values = np.random.default_rng(0).random(100_000)
+    parts = np.array_split(values, 4)
+    first = [merge_summaries([QuantileSketch.from_values(part) for part in parts]) for _ in range(2)]
+    for a, b in zip(first[0].levels, first[1].levels):
+        np.testing.assert_array_equal(a, b)
+    assert [first[0].quantile(q) for q in QUANTILES] == [first[1].quantile(q) for q in QUANTILES]
+
+def test_exact_summaries_merge_like_one_summary():
+    values = np.random.default_rng(0).integers(0, 1000, 10_000).astype(float)
+    values[::17] = np.nan
+    parts = np.array_split(values, 5)
+    assert merge_summaries([DistinctSet.from_values(part) for part in parts]).count() == pd.Series(values).nunique()
+    merged = merge_summaries([ExactQuantiles.from_values(part) for part in parts])
+    for q in (0.1, 0.5, 0.9):
+        assert merged.quantile(q) == pd.Series(values).quantile(q)
+
+def make_sketch_broker(df: pd.DataFrame, approximate: bool) -> PivotBroker:
+    field_data = get_field_data()
+    field_data['Customer'] = PivotField('Customer', PivotFieldType.Aggregate.DISTINCT_COUNT, approximate=approximate)
+    field_data['Size'] = PivotField('Size', PivotFieldType.Aggregate.MEDIAN, approximate=approximate)
+    broker = PivotBroker()
+    broker.field_data = field_data
+    broker.set_data(df)
+    return broker
+
+def make_sketch_data(n_rows: int, seed: int) -> pd.DataFrame:
+    df = get_flat_data(n_rows=n_rows, seed=seed)
+    rng = np.random.default_rng(seed)
+    df['Customer'] = rng.integers(0, n_rows // 3, n_rows)
+    df['Size'] = rng.lognormal(size=n_rows)
+    return df
+
+@pytest.mark.parametrize('approximate', [False, True])
+def test_sketch_pivots_follow_appended_rows(approximate):
+    df, batch = make_sketch_data(20_000, seed=0), make_sketch_data(3_000, seed=1)
+    config = dict(filters=None, rows=['Fruit'], cols=['(Data)'], aggs=['Customer', 'Size'])
+    broker = make_sketch_broker(df, approximate)
+    broker.get_pivot(**config)
+    broker.append_rows(batch)
+
+    result = broker.get_pivot(**config)
+    full = pd.concat([df, batch], ignore_index=True)
+    groups = full.groupby('Fruit')
+    if approximate:
+        np.testing.assert_allclose(result['Customer'].to_numpy(float), groups['Customer'].nunique().to_numpy(), rtol=HLL_TOLERANCE)
+        for fruit, group in groups:
+            sizes = group['Size'].to_numpy()
+            assert abs(np.mean(sizes < result.loc[fruit, 'Size']) - 0.5) < get_rank_bound(len(sizes))
+    else:
+        np.testing.assert_array_equal(result['Customer'].to_numpy(float), groups['Customer'].nunique().to_numpy())
+        np.testing.assert_allclose(result['Size'].to_numpy(float), groups['Size'].median().to_numpy())
+
+    # merged distinct counts are exact, so appending gives the counts of building from all rows
+    rebuilt = make_sketch_broker(full, approximate).get_pivot(**config)
+    pd.testing.assert_series_equal(result['Customer'], rebuilt['Customer'])
@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+
+from swisscontrols.controls.PivotCtrl.DataSource import get_flat_data, get_field_data
+from swisscontrols.controls.PivotCtrl.PivotBroker import PivotBroker
+from swisscontrols.controls.PivotCtrl.PivotField import PivotField, PivotFieldType
+
+CONFIG = dict(rows=['Fruit', 'Shape'], cols=['(Data)', 'Year'], aggs=['Weight', 'Price/kg'])
+
+def make_broker(df: pd.DataFrame, field_data=None, **kwargs) -> PivotBroker:
+    broker = PivotBroker(**kwargs)
+    if field_data is not None:
+        broker.field_data = field_data
+    broker.set_data(df)
+    return broker
+
+def weighted_average(df: pd.DataFrame) -> float:
+    return (df['Price/kg'] * df['Weight']).sum() / df['Weight'].sum()
+
+def test_totals_add_up_the_data():
+    df = get_flat_data(n_rows=500, seed=0)
+    result = make_broker(df).get_pivot(filters=None, totals=True, **CONFIG)
+
+    assert result.index[-1] == ('Total', 'Total')
+    assert result.columns[-1] == ('Price/kg', 'Total')
+    np.testing.assert_allclose(result.loc[('Total', 'Total'), ('Weight', 'Total')], df['Weight'].sum())
+    np.testing.assert_allclose(result.loc[('Total', 'Total'), ('Price/kg', 'Total')], weighted_average(df))
+
+    for fruit, group in df.groupby('Fruit'):
+        np.testing.assert_allclose(result.loc[(fruit, 'Total'), ('Weight', 'Total')], group['Weight'].sum())
+        np.testing.assert_allclose(result.loc[(fruit, 'Total'), ('Price/kg', 'Total')], weighted_average(group))
+    for year, group in df.groupby('Year'):
+        np.testing.assert_allclose(result.loc[('Total', 'Total'), ('Weight', year)], group['Weight'].sum())
+
+def test_totals_keep_the_groups():
+    broker = make_broker(get_flat_data(n_rows=500, seed=0))
+    plain = broker.get_pivot(filters=None, **CONFIG)
+    result = broker.get_pivot(filters=None, totals=True, **CONFIG)
+    # the labels of the totals are added to the categories of the levels, compare the cells
+    np.testing.assert_allclose(result.loc[plain.index, plain.columns].to_numpy(), plain.to_numpy())
+    assert len(result) == len(plain) + plain.index.get_level_values('Fruit').nunique() + 1
+
+def test_totals_follow_appended_rows():
+    df = get_flat_data(n_rows=500, seed=0)
+    batch = get_flat_data(n_rows=50, seed=1)
+    broker = make_broker(df)
+    broker.get_pivot(filters=None, totals=True, **CONFIG)
+    broker.append_rows(batch)
+
+    result = broker.get_pivot(filters=None, totals=True, **CONFIG)
+    expected = make_broker(pd.concat([df, batch], ignore_index=True)).get_pivot(filters=None, totals=True, **CONFIG)
+    pd.testing.assert_frame_equal(result, expected)
+
+def test_distinct_count_totals_are_not_summed():
+    df = get_flat_data(n_rows=500, seed=0)
+    df['Customer'] = np.random.default_rng(0).integers(0, 40, len(df))
+    field_data = get_field_data()
+    field_data['Customer'] = PivotField('Customer', PivotFieldType.Aggregate.DISTINCT_COUNT)
+
+    result = make_broker(df, field_data).get_pivot(filters=None, rows=['Fruit'], cols=['(Data)', 'Year'],
+                                                   aggs=['Customer'], totals=True)
+    assert result.loc['Total', ('Customer', 'Total')] == df['Customer'].nunique()
+    for fruit, group in df.groupby('Fruit'):
+        assert result.loc[fruit, ('Customer', 'Total')] == group['Customer'].nunique()
@@ -0,0 +1,83 @@
+import pandas as pd
+import numpy as np
+import pytest
+
+from swisscontrols.controls.PivotCtrl.DataSource import get_flat_data, get_field_data
+from swisscontrols.controls.PivotCtrl.PivotBroker import PivotBroker
+from swisscontrols.controls.PivotCtrl.PivotField import PivotField, PivotFieldType
+from swisscontrols.controls.UserScripts.user_scripts import create_lambda_from_expression
+
+def get_frame_with_missing_values(n_rows: int = 300) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    fruit = rng.choice(np.array(['Apple', 'Pear', 'Fig', None], dtype=object), n_rows)
+    return pd.DataFrame({'Fruit': fruit, 'Year': rng.choice([2022, 2023], n_rows), 'Weight': rng.random(n_rows)})
+
+@pytest.mark.parametrize('expr', ['Fruit != "Apple"', 'Fruit == "Apple"', '"Apple" != Fruit', 
+                                  'Fruit in ["Apple", "Fig"]', 'Fruit not in ["Apple"]'])
+@pytest.mark.parametrize('categorical', [False, True])
+def test_mask_matches_rows_with_missing_values(expr, categorical):
+    df = get_frame_with_missing_values()
+    if categorical:
+        df['Fruit'] = df['Fruit'].astype('category')
+    f = create_lambda_from_expression(expr, ['Fruit', 'Year'])
+    np.testing.assert_array_equal(f.mask(df), df.apply(f, axis=1).to_numpy(dtype=bool))
+
+def test_not_equal_keeps_missing_values_in_pivots():
+    df = pd.DataFrame({'Year': [2022, 2022, 2023, 2023], 'Quarter': [1, 2, 3, 4],
+                       'Fruit': ['Apple', None, 'Pear', None], 'Shape': ['Round'] * 4, 'Vibe': ['Chill'] * 4,
+                       'Weight': [1.0, 2.0, 3.0, 4.0], 'Volume': [1.0] * 4, 'Price/kg': [1.0] * 4,
+                       'Customer': [1.0] * 4})
+    broker = PivotBroker()
+    broker.set_data(df)
+    f = create_lambda_from_expression('Fruit != "Apple"', ['Fruit'])
+    result = broker.get_pivot(filters=[f], rows=[], cols=['(Data)', 'Year'], aggs=['Weight'])
+    assert result.to_numpy().ravel().tolist() == [2.0, 7.0]
+
+@pytest.mark.parametrize('expr', ['"a" * 1000000000 == Fruit', 'Fruit == 1000000000 * "a"', 'Year == 10 * 10 * 10',
+                                  'Year + ("a" * 1000000000) > 0', 'Year * 2 == "a" + "b"', 'Fruit + "x" == "Applex"'])
+def test_arithmetic_on_constants_is_rejected(expr):
+    with pytest.raises(ValueError):
+        create_lambda_from_expression(expr, ['Fruit', 'Year'])
+
+@pytest.mark.parametrize('expr', ['Year * 2 > 4046', 'Year - 2000 == 22', '-Year < -2022', '(Year + 1) % 2 == 0'])
+def test_arithmetic_on_fields_is_allowed(expr):
+    df = get_frame_with_missing_values()
+    f = create_lambda_from_expression(expr, ['Fruit', 'Year'])
+    np.testing.assert_array_equal(f.mask(df), df.apply(f, axis=1).to_numpy(dtype=bool))
+
+@pytest.mark.parametrize('expr', ['Fruit * 1000000000 == "a"', '1000000000 * Fruit == "a"', 'Fruit + Fruit == "AppleApple"', 
+                                  '-Fruit == "a"'])
+@pytest.mark.parametrize('categorical', [False, True])
+def test_arithmetic_on_text_fields_is_rejected(expr, categorical):
+    df = get_frame_with_missing_values()
+    if categorical:
+        df['Fruit'] = df['Fruit'].astype('category')
+    f = create_lambda_from_expression(expr, ['Fruit', 'Year'])
+    with pytest.raises(ValueError):
+        f.mask(df)
+    with pytest.raises(ValueError):
+        f(df[df['Fruit'].notna()].iloc[0])
+
+@pytest.mark.parametrize('expr', ['Units * 10 > 1000', 'Units - 100 < -50', '-Units < -150', 'Units * Units > 10000 and Year > 2023'])
+def test_arithmetic_on_compact_columns(expr):
+    df = get_flat_data(n_rows=1000, seed=0)
+    df['Units'] = np.random.default_rng(0).integers(0, 200, len(df))
+    field_data = get_field_data()
+    field_data['Units'] = PivotField('Units', PivotFieldType.Aggregate.SUM)
+    brokers = []
+    for compact in (False, True):
+        broker = PivotBroker(compact=compact)
+        broker.field_data = field_data
+        broker.set_data(df)
+        brokers.append(broker)
+    assert brokers[1].df['Units'].dtype == np.uint8
+
+    f = create_lambda_from_expression(expr, ['Units', 'Year'])
+    compact_df = brokers[1].df
+    np.testing.assert_array_equal(f.mask(compact_df), compact_df.apply(f, axis=1).to_numpy(dtype=bool))
+    np.testing.assert_array_equal(f.mask(compact_df), f.mask(df))
+    assert f.mask(df).any()
+
+    config = dict(filters=[f], rows=['Fruit'], cols=['(Data)', 'Year'], aggs=['Units', 'Weight'])
+    full, compact = (broker.get_pivot(**config) for broker in brokers)
+    np.testing.assert_allclose(compact.to_numpy(float), full.to_numpy(float), rtol=1e-6)